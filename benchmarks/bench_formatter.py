@@ -0,0 +1,136 @@
+"""Compare the SQL formatting pipelines on generated queries of growing size.
+
+    python benchmarks/bench_formatter.py [--sizes 50,500,2000,5000] [--repeat 3]
+
+"sqlparse" is sqlparse.format(reindent=True) followed by align_sql_keywords,
+"single-pass" is format_sql_fast. For every size the script prints the best
+time of each pipeline and whether their outputs are identical, for the query
+as generated and with comments through it. A set of short statements covering
+comments and parenthesised WITH queries is compared at the end.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import sqlparse
+from main import align_sql_keywords, default_settings, format_sql_fast
+
+
+EDGE_CASES = [
+    "-- header comment\nSELECT a FROM t",
+    "/* owner: bi */ SELECT a FROM t",
+    "-- a\n/* b */ SELECT a FROM t; -- done\nSELECT b FROM u",
+    "SELECT a,\n  -- c\n  b FROM t",
+    "SELECT a, /* note */\n  /* note */ b FROM t",
+    "SELECT a FROM t WHERE c IN (SELECT 1) /* a */\n  /* b */\n  AND d = 1",
+    "SELECT a FROM t ORDER BY a -- newest first\n  DESC, b",
+    "SELECT x FROM t WHERE b IN (1, -- why\n 2, 3) AND c = 1",
+    "SELECT (SELECT a, -- why\n b, c FROM u WHERE u.id IN (1, -- why\n 2, 3)) AS sq FROM t",
+    "INSERT INTO t (a, b) VALUES (1, 2) -- row\n, (3, 4)",
+    "SELECT * FROM (WITH a AS (SELECT 1) SELECT * FROM a) x",
+    "SELECT x FROM t WHERE id IN (WITH a AS (SELECT 1 AS id) SELECT id FROM a)",
+    "SELECT x FROM t WHERE EXISTS (WITH a AS (SELECT 1) SELECT 1 FROM a WHERE a.x = t.x) AND y = 1",
+]
+
+
+def generate_query(columns, seed=0, comments=False):
+    """A reporting-style query: long SELECT list, many joins, mixed WHERE conditions,
+    with '--' and '/* */' comments where people put them if comments is true"""
+    rnd = random.Random(seed)
+    joins = max(1, columns // 10)
+    conditions = max(2, columns // 5)
+
+    items = [
+        f"sum(t0.amount_{i}) AS total_{i}" if i % 4 == 0 else f"t{rnd.randint(0, joins)}.col_{i}"
+        for i in range(columns)
+    ]
+    if comments:
+        for i in range(0, columns, 7):
+            items[i] = f"\n  -- section {i}\n  {items[i]}"
+        for i in range(3, columns, 11):
+            items[i] += " /* see ticket */"
+    select = ", ".join(items)
+    sql = f"select {select} from facts t0 "
+    for j in range(1, joins + 1):
+        sql += f"left join dim_{j} t{j} on t{j}.id = t0.dim_{j}_id and t{j}.active = 1 "
+
+    where = []
+    for k in range(conditions):
+        where.append(rnd.choice([
+            f"t0.a{k} = {k}",
+            f"t0.b{k} in (1, 2, 3)",
+            f"t0.c{k} between {k} and {k + 10}",
+            f"t0.d{k} like 'x{k}%'",
+            f"t0.id in (select fact_id from tags_{k} where tag = 'k{k}')",
+            f"case when t0.e{k} > 0 then 1 else 0 end = 1",
+            f"t0.id in (with x as (select fact_id from tags_{k}) select fact_id from x)",
+        ]))
+        if comments and k % 3 == 0:
+            where[-1] = f"-- filter {k}\n  {where[-1]}"
+    half = len(where) // 2
+    sql += "where " + " and ".join(where[:half]) + " or " + " and ".join(where[half:])
+    sql += " group by t0.region, t0.day order by 1 desc limit 1000"
+    if comments:
+        sql = "-- nightly report\n/* owner: bi */ " + sql
+    return sql
+
+
+def format_sqlparse(sql, settings):
+    return align_sql_keywords(sqlparse.format(sql, reindent=True, keyword_case="upper"), settings)
+
+
+def best_time(func, repeat):
+    best = None
+    result = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="50,500,2000,5000", help="SELECT columns per generated query")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    settings = default_settings()
+    print(f"{'columns':>8} {'comments':>8} {'chars':>8} {'lines':>7} {'sqlparse':>10} {'single-pass':>12} "
+          f"{'speedup':>8}  output")
+
+    differing = compared = 0
+    sizes = [int(n) for n in args.sizes.split(",")]
+    for columns in sizes:
+        for comments in (False, True):
+            sql = generate_query(columns, comments=comments)
+            fast_time, fast = best_time(lambda: format_sql_fast(sql, settings), args.repeat)
+            head = f"{columns:>8} {'yes' if comments else 'no':>8} {len(sql):>8} {fast.count(chr(10)) + 1:>7}"
+
+            try:
+                ref_time, ref = best_time(lambda: format_sqlparse(sql, settings), args.repeat)
+            except sqlparse.exceptions.SQLParseError as e:
+                print(f"{head} {'failed':>10} {fast_time:>11.3f}s {'-':>8}  ({e})")
+                continue
+
+            same = ref == fast
+            compared += 1
+            differing += not same
+            print(f"{head} {ref_time:>9.3f}s {fast_time:>11.3f}s "
+                  f"{ref_time / fast_time:>7.1f}x  {'identical' if same else 'DIFFERENT'}")
+
+    print(f"\n{differing} of {compared} compared outputs differ")
+
+    different_cases = [sql for sql in EDGE_CASES if format_sql_fast(sql, settings) != format_sqlparse(sql, settings)]
+    for sql in different_cases:
+        print(f"  DIFFERENT: {sql!r}")
+    print(f"{len(different_cases)} of {len(EDGE_CASES)} edge cases differ")
+
+
+if __name__ == "__main__":
+    main()
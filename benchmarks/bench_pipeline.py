@@ -0,0 +1,288 @@
+"""Measure QueryTune's own overhead, separately from model speed.
+
+    python benchmarks/bench_pipeline.py [--requests 30] [--tokens 800] [--only stream,history]
+                                        [--save-baseline [FILE]] [--compare [FILE]] [--tolerance 0.25]
+
+Starts the mock server (mock_server.py) with unthrottled answers and drives
+the real code paths against it:
+
+  stream-*       QueryOptimizer.run: HTTP, SSE/NDJSON parsing, JSON field decoding
+  render         StreamRenderer flushes into a text box (skipped without a display)
+  format         format_optimize_result on a finished Optimize answer (format cache cleared)
+  align          align_sql_keywords on sqlparse output
+  history-write  HistoryManager.save_many in writer-sized batches
+  history-read   HistoryManager search, page and item loads
+
+For every scenario it prints the number of operations, p50/p95/max latency,
+throughput and peak Python memory (from a second run under tracemalloc).
+--save-baseline stores the results (default benchmarks/baseline.json);
+--compare checks a run against them and exits with status 1 when a
+scenario got slower or bigger by more than --tolerance.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+sys.path.insert(0, BENCH_DIR)
+
+import sqlparse
+from bench_formatter import generate_query
+from main import (AppConfig, HistoryManager, QueryOptimizer, StreamRenderer, align_sql_keywords, default_settings,
+                  format_cache, format_optimize_result, percentile)
+from mock_server import MockLLMServer, make_answer, split_tokens
+
+DEFAULT_BASELINE = os.path.join(BENCH_DIR, "baseline.json")
+QUERY = generate_query(40)
+
+
+class Skipped(Exception):
+    pass
+
+
+def bench_stream(server, mode, backend, requests):
+    def run():
+        settings = default_settings()
+        settings.update(ollama_url=server.url, api_backend=backend, stream_optimize=True)
+        optimizer = QueryOptimizer(settings)
+        latencies, tokens = [], 0
+        for _ in range(requests):
+            start = time.perf_counter()
+            result = optimizer.run(mode, QUERY, "", "PostgreSQL", "mock-7b",
+                                   on_token=lambda text: None, on_field=lambda field, text: None)
+            latencies.append(time.perf_counter() - start)
+            tokens += result["telemetry"]["completion_tokens"] or 0
+        return latencies, tokens
+    return run, "tokens"
+
+
+def bench_render(tokens, frames):
+    def run():
+        import tkinter as tk
+        import customtkinter as ctk
+        try:
+            root = ctk.CTk()
+        except tk.TclError as e:
+            raise Skipped(f"no display ({e})")
+        try:
+            root.withdraw()
+            textbox = ctk.CTkTextbox(root)
+            renderer = StreamRenderer(textbox)
+            renderer.start(1)
+            per_frame = max(1, len(tokens) // frames)
+            latencies = []
+            for i in range(0, len(tokens), per_frame):
+                for token in tokens[i:i + per_frame]:
+                    renderer.push(token, 1)
+                start = time.perf_counter()
+                renderer.flush()
+                root.update_idletasks()
+                latencies.append(time.perf_counter() - start)
+            renderer.cancel()
+            return latencies, len(tokens)
+        finally:
+            root.destroy()
+    return run, "tokens"
+
+
+def bench_format(content, settings, repeat):
+    def run():
+        latencies = []
+        for _ in range(repeat):
+            format_cache.clear() # time the formatting, not the memoized copy
+            start = time.perf_counter()
+            format_optimize_result(content, settings)
+            latencies.append(time.perf_counter() - start)
+        return latencies, repeat
+    return run, "answers"
+
+
+def bench_align(sql, settings, repeat):
+    reindented = sqlparse.format(sql, reindent=True, keyword_case="upper")
+
+    def run():
+        latencies = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            align_sql_keywords(reindented, settings)
+            latencies.append(time.perf_counter() - start)
+        return latencies, repeat * (reindented.count("\n") + 1)
+    return run, "lines"
+
+
+def history_entries(count, seed=0):
+    rnd = random.Random(seed)
+    for i in range(count):
+        query = generate_query(rnd.randint(5, 60), seed=i)
+        yield dict(mode=rnd.choice(["optimize", "explain"]), db_type=rnd.choice(AppConfig.DB_OPTIONS[:3]),
+                   model=rnd.choice(["mock-7b", "mock-14b"]), query=query, context="",
+                   res_sql=query.upper(), res_idx="CREATE INDEX idx_facts_day ON facts (day);",
+                   res_expl=f"Entry {i}: filter on the indexed columns first.",
+                   telemetry={"endpoint": "http://127.0.0.1/v1/chat/completions", "http_status": 200, "retries": 0,
+                              "ttfb_s": 0.1, "first_token_s": 0.2, "total_s": 3.0, "prompt_tokens": 300,
+                              "completion_tokens": 400, "tokens_per_s": 140.0})
+
+
+def bench_history_write(count):
+    def run():
+        folder = tempfile.mkdtemp(prefix="querytune-bench-")
+        try:
+            history = HistoryManager(os.path.join(folder, "history.db"))
+            entries = list(history_entries(count))
+            latencies = []
+            for i in range(0, count, AppConfig.HISTORY_BATCH_SIZE):
+                start = time.perf_counter()
+                history.save_many(entries[i:i + AppConfig.HISTORY_BATCH_SIZE])
+                latencies.append(time.perf_counter() - start)
+            history.close()
+            return latencies, count
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+    return run, "entries"
+
+
+def bench_history_read(count, reads):
+    def run():
+        folder = tempfile.mkdtemp(prefix="querytune-bench-")
+        try:
+            history = HistoryManager(os.path.join(folder, "history.db"))
+            history.save_many(list(history_entries(count)))
+            rnd = random.Random(1)
+            operations = [
+                lambda: history.search("facts dim_3"),
+                lambda: history.search("region", model="mock-7b"),
+                lambda: history.search(offset=AppConfig.HISTORY_PAGE_SIZE * rnd.randint(0, 5)),
+                lambda: history.get_item(rnd.randint(1, count)),
+                lambda: history.telemetry_stats("model"),
+            ]
+            latencies = []
+            for i in range(reads):
+                start = time.perf_counter()
+                operations[i % len(operations)]()
+                latencies.append(time.perf_counter() - start)
+            history.close()
+            return latencies, reads
+        finally:
+            shutil.rmtree(folder, ignore_errors=True)
+    return run, "reads"
+
+
+def build_scenarios(server, args):
+    settings = default_settings()
+    content = json.loads(make_answer(True, args.tokens))
+    tokens = split_tokens(make_answer(False, args.tokens))
+    return {
+        "stream-chat-openai": bench_stream(server, "explain", "openai", args.requests),
+        "stream-chat-ollama": bench_stream(server, "explain", "ollama", args.requests),
+        "stream-optimize": bench_stream(server, "optimize", "openai", args.requests),
+        "render": bench_render(tokens * 10, frames=300),
+        "format": bench_format(content, settings, args.requests),
+        "align": bench_align(generate_query(500), settings, max(3, args.requests // 5)),
+        "history-write": bench_history_write(args.history),
+        "history-read": bench_history_read(args.history, args.requests * 10),
+    }
+
+
+def measure(run, unit, memory=True):
+    latencies, units = run()
+    result = {
+        "ops": len(latencies),
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "max_ms": max(latencies) * 1000,
+        "throughput": units / sum(latencies) if sum(latencies) else 0.0,
+        "unit": unit,
+        "peak_mb": None,
+    }
+    if memory:
+        tracemalloc.start()
+        try:
+            run()
+            result["peak_mb"] = tracemalloc.get_traced_memory()[1] / (1024 * 1024)
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def regressions(name, result, base, tolerance):
+    """Ways in which result is worse than the baseline entry (small absolute changes are noise)"""
+    found = []
+    if result["throughput"] < base["throughput"] * (1 - tolerance):
+        found.append(f"throughput {result['throughput']:.0f} < {base['throughput']:.0f} {result['unit']}/s")
+    if result["p95_ms"] > base["p95_ms"] * (1 + tolerance) and result["p95_ms"] - base["p95_ms"] > 1:
+        found.append(f"p95 {result['p95_ms']:.1f} > {base['p95_ms']:.1f} ms")
+    if (result["peak_mb"] is not None and base.get("peak_mb") is not None
+            and result["peak_mb"] > base["peak_mb"] * (1 + tolerance) and result["peak_mb"] - base["peak_mb"] > 1):
+        found.append(f"peak memory {result['peak_mb']:.1f} > {base['peak_mb']:.1f} MB")
+    return [f"{name}: {text}" for text in found]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=30, help="requests per streaming scenario")
+    parser.add_argument("--tokens", type=int, default=800, help="answer length in tokens")
+    parser.add_argument("--history", type=int, default=2000, help="history entries written / searched")
+    parser.add_argument("--only", default="", help="comma-separated scenario name prefixes")
+    parser.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    parser.add_argument("--save-baseline", nargs="?", const=DEFAULT_BASELINE, metavar="FILE")
+    parser.add_argument("--compare", nargs="?", const=DEFAULT_BASELINE, metavar="FILE")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown before --compare fails")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline["args"] != {k: vars(args)[k] for k in ("requests", "tokens", "history")}:
+            print(f"Warning: the baseline was recorded with {baseline['args']}", file=sys.stderr)
+
+    prefixes = [p.strip() for p in args.only.split(",") if p.strip()]
+    results = {}
+    failures = []
+    print(f"{'scenario':<20} {'ops':>6} {'p50 ms':>9} {'p95 ms':>9} {'max ms':>9} {'throughput':>20} {'peak MB':>8}  vs baseline")
+    with MockLLMServer(rate=0, tokens=args.tokens) as server:
+        for name, (run, unit) in build_scenarios(server, args).items():
+            if prefixes and not any(name.startswith(p) for p in prefixes):
+                continue
+            try:
+                result = measure(run, unit, memory=not args.no_memory)
+            except Skipped as e:
+                print(f"{name:<20} skipped: {e}")
+                continue
+            results[name] = result
+
+            compared = ""
+            base = (baseline or {}).get("results", {}).get(name)
+            if base:
+                compared = f"{(result['throughput'] / base['throughput'] - 1) * 100:+.0f}% throughput"
+                failures += regressions(name, result, base, args.tolerance)
+            peak = "-" if result["peak_mb"] is None else f"{result['peak_mb']:.1f}"
+            print(f"{name:<20} {result['ops']:>6} {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} {result['max_ms']:>9.2f} "
+                  f"{result['throughput']:>12.0f} {unit + '/s':<7} {peak:>8}  {compared}")
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding="utf-8") as f:
+            json.dump({"created": datetime.now().isoformat(timespec="seconds"),
+                       "python": platform.python_version(), "platform": platform.platform(),
+                       "args": {k: vars(args)[k] for k in ("requests", "tokens", "history")},
+                       "results": results}, f, indent=2)
+        print(f"\nBaseline saved to {args.save_baseline}")
+
+    if failures:
+        print(f"\n{len(failures)} regression(s) beyond {args.tolerance:.0%}:")
+        for failure in failures:
+            print(f"  {failure}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
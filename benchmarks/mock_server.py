@@ -0,0 +1,223 @@
+"""A local stand-in for an Ollama / OpenAI-compatible server.
+
+    python benchmarks/mock_server.py [--port 11435] [--rate 50] [--tokens 400] [--ttfb 0.2]
+
+Serves POST /v1/chat/completions (SSE when "stream" is set, JSON otherwise),
+POST /api/chat (native Ollama, NDJSON when streaming), the warm-up call of
+POST /api/generate, and GET /api/tags, /api/ps and /v1/models. Requests that
+ask for JSON (response_format or format) get an Optimize document with a
+generated query; the others get prose. Answers are cut into ~4-character
+tokens and sent at --rate tokens per second (0 = as fast as possible) after
+--ttfb seconds, so QueryTune can be pointed at it to measure its own
+overhead or to try the UI offline.
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_formatter import generate_query
+
+
+def split_tokens(text, size=4):
+    return [text[i:i + size] for i in range(0, len(text), size)]
+
+
+def make_answer(json_mode, tokens, seed=0):
+    """Roughly `tokens` tokens of Optimize JSON or of Chat prose"""
+    filler = ("The query scans the fact table once per joined dimension; filtering on the indexed date "
+              "column first and joining the small dimensions afterwards avoids the repeated scans. ")
+    if not json_mode:
+        text = "### Analysis\n\n"
+        while len(text) < tokens * 4:
+            text += filler
+        return text[:tokens * 4]
+
+    # Half of the answer is SQL, the rest explanation
+    columns = 5
+    while len(generate_query(columns, seed)) < tokens * 2 and columns < 5000:
+        columns *= 2
+    explanation = ""
+    while len(explanation) < tokens * 2:
+        explanation += filler
+    return json.dumps({
+        "optimized_query": generate_query(columns, seed),
+        "indices": "CREATE INDEX idx_facts_region_day ON facts (region, day);",
+        "explanation": explanation
+    })
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1" # keep-alive, like the real servers
+    disable_nagle_algorithm = True # small stream chunks must not wait for delayed ACKs
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def config(self):
+        return self.server.mock
+
+    def send_json(self, body, status=200):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_chunk(self, data):
+        self.wfile.write(f"{len(data):X}\r\n".encode("ascii") + data + b"\r\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        models = [{"name": m, "model": m, "size": 4_700_000_000} for m in self.config.models]
+        if self.path == "/api/tags":
+            self.send_json({"models": models})
+        elif self.path == "/api/ps":
+            self.send_json({"models": models})
+        elif self.path == "/v1/models":
+            self.send_json({"object": "list", "data": [{"id": m, "object": "model"} for m in self.config.models]})
+        else:
+            self.send_json({"error": "not found"}, 404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            request = json.loads(self.rfile.read(length) or b"{}")
+        except json.JSONDecodeError:
+            self.send_json({"error": "invalid JSON"}, 400)
+            return
+        if self.path == "/api/generate": # model warm-up (no prompt)
+            self.send_json({"model": request.get("model"), "response": "", "done": True})
+            return
+        native = self.path == "/api/chat"
+        if not native and self.path != "/v1/chat/completions":
+            self.send_json({"error": "not found"}, 404)
+            return
+        self.config.count_request()
+
+        json_mode = bool(request.get("format") or request.get("response_format"))
+        text = self.config.answer(json_mode)
+        tokens = split_tokens(text)
+        prompt_tokens = sum(len(m.get("content", "")) for m in request.get("messages", [])) // 4
+        model = request.get("model", self.config.models[0])
+        if self.config.ttfb:
+            time.sleep(self.config.ttfb)
+
+        start = time.time()
+        if not request.get("stream"):
+            self.pace(len(tokens), start)
+            if native:
+                self.send_json({"model": model, "message": {"role": "assistant", "content": text}, "done": True,
+                                "prompt_eval_count": prompt_tokens, "eval_count": len(tokens),
+                                "eval_duration": int((time.time() - start) * 1e9)})
+            else:
+                self.send_json({"model": model, "choices": [{"index": 0, "message": {"role": "assistant", "content": text},
+                                                             "finish_reason": "stop"}],
+                                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens)}})
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson" if native else "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for i, token in enumerate(tokens, 1):
+            if native:
+                event = {"model": model, "message": {"role": "assistant", "content": token}, "done": False}
+                self.send_chunk(json.dumps(event).encode("utf-8") + b"\n")
+            else:
+                event = {"model": model, "choices": [{"index": 0, "delta": {"content": token}}]}
+                self.send_chunk(b"data: " + json.dumps(event).encode("utf-8") + b"\n\n")
+            self.pace(i, start)
+        if native:
+            final = {"model": model, "message": {"role": "assistant", "content": ""}, "done": True,
+                     "prompt_eval_count": prompt_tokens, "eval_count": len(tokens),
+                     "eval_duration": int((time.time() - start) * 1e9)}
+            self.send_chunk(json.dumps(final).encode("utf-8") + b"\n")
+        else:
+            usage = {"model": model, "choices": [], "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens)}}
+            self.send_chunk(b"data: " + json.dumps(usage).encode("utf-8") + b"\n\ndata: [DONE]\n\n")
+        self.send_chunk(b"")
+
+    def pace(self, sent, start):
+        if self.config.rate > 0:
+            delay = start + sent / self.config.rate - time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+
+class MockLLMServer:
+    """Runs the mock in a daemon thread; use as a context manager or call start()/stop()"""
+    def __init__(self, host="127.0.0.1", port=0, rate=0, tokens=400, ttfb=0.0, models=("mock-7b",)):
+        self.rate = rate
+        self.tokens = tokens
+        self.ttfb = ttfb
+        self.models = list(models)
+        self.requests = 0
+        self._answers = {}
+        self._lock = threading.Lock()
+        self.httpd = ThreadingHTTPServer((host, port), MockHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.mock = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/v1/chat/completions"
+
+    def answer(self, json_mode):
+        with self._lock:
+            key = (json_mode, self.tokens)
+            if key not in self._answers:
+                self._answers[key] = make_answer(json_mode, self.tokens)
+            return self._answers[key]
+
+    def count_request(self):
+        with self._lock:
+            self.requests += 1
+
+    def start(self):
+        self._thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--rate", type=float, default=50, help="tokens per second (0 = unthrottled)")
+    parser.add_argument("--tokens", type=int, default=400, help="answer length in tokens")
+    parser.add_argument("--ttfb", type=float, default=0.2, help="seconds before the first byte")
+    parser.add_argument("--models", default="mock-7b,mock-14b", help="comma-separated names listed by /api/tags")
+    args = parser.parse_args()
+
+    server = MockLLMServer(args.host, args.port, args.rate, args.tokens, args.ttfb, args.models.split(","))
+    print(f"Mock server on {server.url} ({args.tokens} tokens at {args.rate or 'unlimited'} tokens/s); Ctrl+C to stop")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+
+
+if __name__ == "__main__":
+    main()
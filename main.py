@@ -1,17 +1,22 @@
+import time
+_IMPORT_STARTED = time.perf_counter() # origin of the --startup-report timings
 import tkinter as tk
-from tkinter import messagebox
+from tkinter import messagebox, filedialog
 import customtkinter as ctk
-import requests
 import threading
+import queue
 import json
+import hashlib
+import heapq
+import itertools
+import re
+from collections import OrderedDict
 import platform
 import os
 import sys
-import sqlparse
 import sqlite3
 from datetime import datetime
-import webbrowser
-from PIL import Image
+# requests, sqlparse, PIL and webbrowser are imported where they are first used: the window shows sooner
 
 # Patch for macOS version detection issues on newer/beta releases
 if platform.system() == "Darwin":
@@ -35,7 +40,12 @@ class AppConfig:
     
     # AI Options
     AI_TEMPERATURE = 0.1
-    AI_CTX_SIZE = 8192
+    AI_CTX_SIZE = 8192 # Context window (Ollama num_ctx)
+    AI_MAX_TOKENS = 0 # Answer length limit (max_tokens / num_predict), 0 = model default
+    AI_NUM_THREAD = 0 # Ollama CPU threads, 0 = auto
+    AI_NUM_GPU = -1 # Ollama layers offloaded to the GPU, -1 = auto, 0 = CPU only
+    API_BACKEND = "auto" # "openai", "ollama", or "auto" (native Ollama on port 11434 and /api/ URLs)
+    OLLAMA_PORT = 11434
     DEFAULT_SYSTEM_PROMPT_CHAT = "You are an expert {db_type} DBA. Explain the query and suggest improvements. Reply in English."
     
     # Links
@@ -65,80 +75,3919 @@ class AppConfig:
     SQL_INDENT_WIDTH = 2
     SQL_KEYWORD_CASE = "upper"
     SQL_COMPACT_SELECT = False
+    SQL_FAST_FORMAT_CHARS = 10000 # Longer queries use the single-pass formatter
+    FORMAT_CACHE_SIZE = 32 # Formatted queries kept in memory
+    # Schema catalog
+    SCHEMA_INDEX_FILE = os.path.expanduser("~/.querytune_schema.json")
+    SCHEMA_AUTO_INJECT = False
+    SCHEMA_TOKEN_BUDGET = 2000 # Max prompt tokens spent on injected DDL
+    SCHEMA_REFRESH_SECONDS = 5 # How often files are checked for changes
+
+    HIGHLIGHT_LINES_PER_PASS = 300 # Lines re-lexed per idle callback
+    HIGHLIGHT_COLORS = {"keyword": "#3B82F6", "string": "#16A34A", "comment": "#8B949E", "number": "#D97706"}
     
     DB_OPTIONS = ["PostgreSQL", "MySQL", "SQLite", "ClickHouse", "Standard SQL", "Oracle", "MS SQL Server"]
     # We switch to the standard Chat Completion endpoint which is compatible with both Ollama and OpenAI
     OLLAMA_URL = "http://localhost:11434/v1/chat/completions"
     SETTINGS_FILE = os.path.expanduser("~/.querytune_settings.json")
+    HISTORY_FILE = os.path.expanduser("~/.querytune_history.db")
+    HISTORY_PAGE_SIZE = 50
+    HISTORY_RANK_WINDOW = 2000 # Search ranks the newest N matches, not every row containing a common word
+    HISTORY_GROUP_QUERIES = False # Sidebar shows one row per query fingerprint
+
+    # History retention (0 = unlimited)
+    HISTORY_MAX_ROWS = 0
+    HISTORY_MAX_AGE_DAYS = 0
+    HISTORY_MAX_DB_MB = 0
+    HISTORY_PRUNE_INTERVAL = 600 # seconds
+    HISTORY_QUEUE_SIZE = 256 # Queued tasks before new ones spill into the overflow list
+    HISTORY_BATCH_SIZE = 64 # Entries committed in one transaction
+
+    # Response Cache
+    CACHE_FILE = os.path.expanduser("~/.querytune_cache.db")
+    CACHE_ENABLED = True
+    CACHE_MAX_ENTRIES = 500
+    CACHE_MAX_SIZE_MB = 50
+    CACHE_MAX_AGE_DAYS = 30
+
+    # Headless batch mode (parallel requests per endpoint)
+    BATCH_CONCURRENCY = 1
+
+    # HTTP connection pool
+    HTTP_POOL_SIZE = 4
+    CONNECT_TIMEOUT = 5
+    HTTP_COMPRESSION = True
+
+    # Endpoint pool (extra URLs serving the same models)
+    HEALTH_CHECK_INTERVAL = 30 # seconds
+    ENDPOINT_MAX_FAILURES = 3 # Consecutive failed requests before an endpoint is taken out of rotation
+    HEDGE_REQUESTS = False
+    HEDGE_DEFAULT_DELAY = 10 # seconds to first byte before hedging, until enough latencies are known
+    HEDGE_MIN_SAMPLES = 5
+    LATENCY_WINDOW = 50 # Recent samples kept per endpoint
+
+    # Ollama model warm-up
+    WARMUP_ENABLED = True
+    OLLAMA_KEEP_ALIVE = "30m" # How long Ollama keeps the model loaded after the last request
+    WARMUP_REFRESH = 120 # seconds between keep-alive refreshes while the app is open
+    MODEL_STATUS_INTERVAL = 10 # seconds between /api/ps polls
+
+    # In-app job queue
+    JOB_CONCURRENCY = 1 # Running jobs per endpoint (1 for a single local GPU)
+    JOB_LIST_SIZE = 30 # Finished jobs kept in the queue panel
+    JOB_PRIORITIES = {"High priority": 1, "Normal priority": 0, "Low priority": -1}
+
+    # Streaming: tokens are buffered and drawn once per frame (~30 fps)
+    STREAM_FLUSH_MS = 33
+    STREAM_OPTIMIZE = True
+    STREAM_USAGE = False # stream_options.include_usage; strict servers reject unknown fields
+
+class ResponseCache:
+    """Disk-backed LLM response cache keyed on the normalized request payload"""
+    def __init__(self, db_path=None, max_entries=AppConfig.CACHE_MAX_ENTRIES,
+                 max_size_mb=AppConfig.CACHE_MAX_SIZE_MB, max_age_days=AppConfig.CACHE_MAX_AGE_DAYS, open_db=True):
+        self.db_path = db_path or AppConfig.CACHE_FILE
+        self.configure(max_entries, max_size_mb, max_age_days)
+        if open_db:
+            self.init_db()
+
+    def configure(self, max_entries, max_size_mb, max_age_days):
+        self.max_entries = int(max_entries)
+        self.max_size_bytes = int(float(max_size_mb) * 1024 * 1024)
+        self.max_age_seconds = float(max_age_days) * 86400
+
+    def init_db(self):
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS response_cache (
+                        cache_key TEXT PRIMARY KEY,
+                        request_mode TEXT,
+                        model TEXT,
+                        created_at REAL,
+                        last_access REAL,
+                        size INTEGER,
+                        response TEXT
+                    )
+                """)
+                conn.execute("CREATE INDEX IF NOT EXISTS idx_cache_last_access ON response_cache (last_access)")
+        except Exception as e:
+            print(f"Cache database error: {e}")
+
+    @staticmethod
+    def make_key(url, payload):
+        # Streaming only changes the transport, not the answer; whitespace around
+        # the prompt texts should not produce a different entry either.
+        normalized = {k: v for k, v in payload.items() if k != "stream"}
+        normalized["messages"] = [
+            {"role": m.get("role"), "content": (m.get("content") or "").strip()}
+            for m in payload.get("messages", [])
+        ]
+        normalized["url"] = url.strip().rstrip("/")
+        raw = json.dumps(normalized, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        now = time.time()
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                row = conn.execute("SELECT response, created_at FROM response_cache WHERE cache_key = ?", (key,)).fetchone()
+                if row is None:
+                    return None
+                if self.max_age_seconds > 0 and now - row[1] > self.max_age_seconds:
+                    conn.execute("DELETE FROM response_cache WHERE cache_key = ?", (key,))
+                    return None
+                conn.execute("UPDATE response_cache SET last_access = ? WHERE cache_key = ?", (now, key))
+                return row[0]
+        except Exception as e:
+            print(f"Cache read failed: {e}")
+            return None
+
+    def put(self, key, mode, model, response):
+        if not response:
+            return
+        now = time.time()
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute("""
+                    INSERT OR REPLACE INTO response_cache (cache_key, request_mode, model, created_at, last_access, size, response)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                """, (key, mode, model, now, now, len(response.encode("utf-8")), response))
+                self._evict(conn, now)
+        except Exception as e:
+            print(f"Cache write failed: {e}")
+
+    def _evict(self, conn, now):
+        # 1. Age limit
+        if self.max_age_seconds > 0:
+            conn.execute("DELETE FROM response_cache WHERE created_at < ?", (now - self.max_age_seconds,))
+
+        # 2. Entry limit, least recently used first
+        if self.max_entries > 0:
+            conn.execute("""
+                DELETE FROM response_cache WHERE cache_key IN (
+                    SELECT cache_key FROM response_cache ORDER BY last_access DESC LIMIT -1 OFFSET ?
+                )
+            """, (self.max_entries,))
+
+        # 3. Size limit, least recently used first
+        if self.max_size_bytes > 0:
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM response_cache").fetchone()[0]
+            if total > self.max_size_bytes:
+                victims = []
+                for key, size in conn.execute("SELECT cache_key, size FROM response_cache ORDER BY last_access ASC"):
+                    if total <= self.max_size_bytes:
+                        break
+                    victims.append((key,))
+                    total -= size
+                conn.executemany("DELETE FROM response_cache WHERE cache_key = ?", victims)
+
+    def clear(self):
+        try:
+            with sqlite3.connect(self.db_path) as conn:
+                conn.execute("DELETE FROM response_cache")
+        except Exception as e:
+            print(f"Failed to clear cache: {e}")
+
+def percentile(values, q):
+    """Nearest-rank percentile of the values (q in 0..1); None when there are none"""
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+class HistoryManager:
+    """Optimization history in SQLite.
+
+    One connection is kept open for the whole session and shared by the Tk
+    thread and the worker threads (serialized by a lock). The schema is
+    versioned with PRAGMA user_version; MIGRATIONS[n] upgrades from version n.
+    """
+    SUMMARY_COLUMNS = "h.id, h.timestamp, h.request_mode, h.db_type, h.model, h.query_preview AS preview, h.fingerprint"
+    TEXT_COLUMNS = ["query_input", "context_input", "result_sql", "result_indices", "result_explanation"]
+    # Since schema v3 the texts live once each in the blobs table; history rows hold their hashes
+    REF_COLUMNS = {"query_input": "query_ref", "context_input": "context_ref", "result_sql": "sql_ref",
+                   "result_indices": "indices_ref", "result_explanation": "expl_ref"}
+    # Since schema v4: how the request went (NULL for answers replayed from the response cache)
+    TELEMETRY_COLUMNS = {"endpoint": "TEXT", "http_status": "INTEGER", "retries": "INTEGER", "ttfb_s": "REAL",
+                         "first_token_s": "REAL", "total_s": "REAL", "prompt_tokens": "INTEGER",
+                         "completion_tokens": "INTEGER", "tokens_per_s": "REAL"}
+    STATS_GROUPS = ("model", "endpoint", "db_type")
+    STATS_METRICS = ("ttfb_s", "first_token_s", "total_s", "tokens_per_s")
+    MIGRATION_BATCH = 500 # Rows rewritten per transaction by data migrations
+
+    def __init__(self, db_path=None, open_db=True):
+        self.db_path = db_path or AppConfig.HISTORY_FILE
+        self._lock = threading.RLock()
+        self.conn = None
+        self.has_fts = False
+        self.retention = (AppConfig.HISTORY_MAX_ROWS, AppConfig.HISTORY_MAX_AGE_DAYS, AppConfig.HISTORY_MAX_DB_MB)
+        self._prune_wakeup = threading.Event()
+        self._prune_thread = None
+        if open_db: # otherwise the caller runs init_db() (migrations can take a while)
+            self.init_db()
+
+    def init_db(self):
+        try:
+            self.conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=10)
+            self.conn.row_factory = sqlite3.Row
+            self.conn.create_function("qt_inflate", 1, self.inflate, deterministic=True)
+            # Only applies to a new file (set before its first table); older files switch in migrate()
+            self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.migrate()
+            self.has_fts = self.conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'history_fts'").fetchone() is not None
+        except Exception as e:
+            print(f"Database error: {e}")
+
+    def _migrate_v1(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS history (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+                request_mode TEXT,
+                db_type TEXT,
+                model TEXT,
+                query_input TEXT,
+                context_input TEXT,
+                result_sql TEXT,
+                result_indices TEXT,
+                result_explanation TEXT
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_history_timestamp ON history (timestamp, id)")
+
+    def _migrate_v2(self, conn):
+        # Filter lists (DISTINCT model / db_type) come straight from these indexes
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_history_model ON history (model)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_history_db_type ON history (db_type)")
+
+        # Full-text index over the text columns, kept in sync by triggers
+        cols = ", ".join(self.TEXT_COLUMNS)
+        new_vals = ", ".join(f"new.{c}" for c in self.TEXT_COLUMNS)
+        old_vals = ", ".join(f"old.{c}" for c in self.TEXT_COLUMNS)
+        try:
+            conn.execute(f"CREATE VIRTUAL TABLE history_fts USING fts5({cols}, content='history', content_rowid='id')")
+        except sqlite3.OperationalError as e:
+            print(f"Full-text search unavailable, falling back to LIKE: {e}")
+            return
+        conn.execute(f"""
+            CREATE TRIGGER history_fts_insert AFTER INSERT ON history BEGIN
+                INSERT INTO history_fts (rowid, {cols}) VALUES (new.id, {new_vals});
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER history_fts_delete AFTER DELETE ON history BEGIN
+                INSERT INTO history_fts (history_fts, rowid, {cols}) VALUES ('delete', old.id, {old_vals});
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER history_fts_update AFTER UPDATE ON history BEGIN
+                INSERT INTO history_fts (history_fts, rowid, {cols}) VALUES ('delete', old.id, {old_vals});
+                INSERT INTO history_fts (rowid, {cols}) VALUES (new.id, {new_vals});
+            END
+        """)
+        conn.execute("INSERT INTO history_fts (history_fts) VALUES ('rebuild')")
+
+    def _migrate_v3(self, conn):
+        # Content-addressed, compressed texts
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS blobs (
+                hash TEXT PRIMARY KEY,
+                size INTEGER,
+                data BLOB
+            ) WITHOUT ROWID
+        """)
+        self._add_columns(conn, {column: "TEXT" for column in list(self.REF_COLUMNS.values()) + ["query_preview"]})
+
+        # query_preview is set on every converted row, so a resumed upgrade skips them
+        assignments = ", ".join(f"{ref} = ?" for ref in self.REF_COLUMNS.values())
+        nulls = ", ".join(f"{c} = NULL" for c in self.TEXT_COLUMNS)
+
+        def convert(rows):
+            for row in rows:
+                refs = [self._store_blob(conn, row[c]) for c in self.TEXT_COLUMNS]
+                conn.execute(f"UPDATE history SET {assignments}, query_preview = ?, {nulls} WHERE id = ?",
+                             refs + [(row["query_input"] or "")[:41], row["id"]])
+        self._rewrite_in_batches(conn, ", ".join(f"h.{c} AS {c}" for c in self.TEXT_COLUMNS), "h.query_preview IS NULL", convert)
+
+        # Readable view of the texts, used as the external content of the FTS index
+        selects = ", ".join(f"{self._text_expr('h', c)} AS {c}" for c in self.TEXT_COLUMNS)
+        conn.execute(f"CREATE VIEW IF NOT EXISTS history_text AS SELECT h.id AS id, {selects} FROM history h")
+
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'history_fts'").fetchone() is None:
+            return
+        for trigger in ("history_fts_insert", "history_fts_delete", "history_fts_update"):
+            conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        conn.execute("DROP TABLE history_fts")
+
+        cols = ", ".join(self.TEXT_COLUMNS)
+        new_vals = ", ".join(self._text_expr("new", c) for c in self.TEXT_COLUMNS)
+        old_vals = ", ".join(self._text_expr("old", c) for c in self.TEXT_COLUMNS)
+        conn.execute(f"CREATE VIRTUAL TABLE history_fts USING fts5({cols}, content='history_text', content_rowid='id')")
+        conn.execute(f"""
+            CREATE TRIGGER history_fts_insert AFTER INSERT ON history BEGIN
+                INSERT INTO history_fts (rowid, {cols}) VALUES (new.id, {new_vals});
+            END
+        """)
+        # Blobs are only garbage collected by prune(), so old texts still exist here
+        conn.execute(f"""
+            CREATE TRIGGER history_fts_delete AFTER DELETE ON history BEGIN
+                INSERT INTO history_fts (history_fts, rowid, {cols}) VALUES ('delete', old.id, {old_vals});
+            END
+        """)
+        conn.execute(f"""
+            CREATE TRIGGER history_fts_update AFTER UPDATE ON history BEGIN
+                INSERT INTO history_fts (history_fts, rowid, {cols}) VALUES ('delete', old.id, {old_vals});
+                INSERT INTO history_fts (rowid, {cols}) VALUES (new.id, {new_vals});
+            END
+        """)
+        conn.execute("INSERT INTO history_fts (history_fts) VALUES ('rebuild')")
+
+    def _migrate_v4(self, conn):
+        self._add_columns(conn, self.TELEMETRY_COLUMNS)
+
+    def _migrate_v5(self, conn):
+        # Runs of the same query up to literals, IN-list lengths, spacing and case share a fingerprint
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'history_fts_update'").fetchone() is not None:
+            # Re-index on text changes only, not on this backfill
+            cols = ", ".join(self.TEXT_COLUMNS)
+            new_vals = ", ".join(self._text_expr("new", c) for c in self.TEXT_COLUMNS)
+            old_vals = ", ".join(self._text_expr("old", c) for c in self.TEXT_COLUMNS)
+            conn.execute("DROP TRIGGER history_fts_update")
+            conn.execute(f"""
+                CREATE TRIGGER history_fts_update AFTER UPDATE OF {", ".join(self.REF_COLUMNS.values())} ON history BEGIN
+                    INSERT INTO history_fts (history_fts, rowid, {cols}) VALUES ('delete', old.id, {old_vals});
+                    INSERT INTO history_fts (rowid, {cols}) VALUES (new.id, {new_vals});
+                END
+            """)
+        self._add_columns(conn, {"fingerprint": "TEXT"})
+        self._rewrite_in_batches(
+            conn, f"{self._text_expr('h', 'query_input')} AS query_input", "h.fingerprint IS NULL",
+            lambda rows: conn.executemany("UPDATE history SET fingerprint = ? WHERE id = ?",
+                                          [(query_fingerprint(row["query_input"]), row["id"]) for row in rows]))
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_history_fingerprint ON history (fingerprint, id)")
+
+    @staticmethod
+    def _add_columns(conn, columns):
+        """ALTER TABLE history ADD COLUMN for the {name: type} entries it lacks (a resumed upgrade has some)"""
+        existing = {row[1] for row in conn.execute("PRAGMA table_info(history)")}
+        for column, kind in columns.items():
+            if column not in existing:
+                conn.execute(f"ALTER TABLE history ADD COLUMN {column} {kind}")
+
+    def _rewrite_in_batches(self, conn, columns, where, rewrite):
+        """Call rewrite(rows) on the history rows (alias h) matching where, MIGRATION_BATCH at a time by id.
+        Each batch is committed: memory stays flat on large histories and an interrupted
+        upgrade keeps its finished batches (where must exclude rows already rewritten)."""
+        last_id = 0
+        while True:
+            rows = conn.execute(f"""
+                SELECT h.id AS id, {columns} FROM history h WHERE h.id > ? AND ({where}) ORDER BY h.id LIMIT ?
+            """, (last_id, self.MIGRATION_BATCH)).fetchall()
+            if not rows:
+                return
+            rewrite(rows)
+            last_id = rows[-1]["id"]
+            conn.execute("COMMIT")
+            conn.execute("BEGIN")
+
+    MIGRATIONS = [_migrate_v1, _migrate_v2, _migrate_v3, _migrate_v4, _migrate_v5]
+
+    @classmethod
+    def _text_expr(cls, alias, column):
+        ref = cls.REF_COLUMNS[column]
+        return f"qt_inflate((SELECT data FROM blobs WHERE hash = {alias}.{ref}))"
+
+    @staticmethod
+    def deflate(text):
+        """Compress a text; the first byte records the codec"""
+        raw = text.encode("utf-8")
+        try:
+            import zstandard
+            return b"Z" + zstandard.ZstdCompressor(level=6).compress(raw)
+        except ImportError:
+            import zlib
+            return b"z" + zlib.compress(raw, 6)
+
+    @staticmethod
+    def inflate(data):
+        if data is None:
+            return None
+        data = bytes(data)
+        codec, body = data[:1], data[1:]
+        if codec == b"z":
+            import zlib
+            return zlib.decompress(body).decode("utf-8")
+        if codec == b"Z":
+            try:
+                import zstandard
+            except ImportError:
+                return "[Stored with zstd compression: install the 'zstandard' package to read it]"
+            return zstandard.ZstdDecompressor().decompress(body).decode("utf-8")
+        return body.decode("utf-8")
+
+    def _store_blob(self, conn, text):
+        """Store a text once; returns its hash (None for empty texts)"""
+        if not text:
+            return None
+        key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+        if conn.execute("SELECT 1 FROM blobs WHERE hash = ?", (key,)).fetchone() is None:
+            conn.execute("INSERT INTO blobs (hash, size, data) VALUES (?, ?, ?)",
+                         (key, len(text), self.deflate(text)))
+        return key
+
+    @property
+    def schema_version(self):
+        return len(self.MIGRATIONS)
+
+    def migrate(self):
+        with self._lock:
+            version = self.conn.execute("PRAGMA user_version").fetchone()[0]
+            for target in range(version + 1, self.schema_version + 1):
+                self.conn.execute("BEGIN")
+                try:
+                    self.MIGRATIONS[target - 1](self, self.conn)
+                    self.conn.execute(f"PRAGMA user_version = {target}")
+                    self.conn.execute("COMMIT")
+                except Exception:
+                    self.conn.execute("ROLLBACK")
+                    raise
+            # prune() gives free pages back with incremental_vacuum. A database created before that
+            # is rebuilt once, as part of its schema upgrade (VACUUM cannot run inside a transaction)
+            if version < self.schema_version and self.conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                self.conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                self.conn.execute("VACUUM")
+
+    def save(self, mode, db_type, model, query, context, res_sql="", res_idx="", res_expl="", telemetry=None):
+        """Insert one entry and return its id (None on failure). telemetry is the
+        dict QueryOptimizer puts in its result (keys of TELEMETRY_COLUMNS)."""
+        return self.save_many([dict(mode=mode, db_type=db_type, model=model, query=query, context=context,
+                                    res_sql=res_sql, res_idx=res_idx, res_expl=res_expl, telemetry=telemetry)])[0]
+
+    def save_many(self, entries):
+        """Insert entries (dicts of save() arguments) in one transaction; returns their ids"""
+        try:
+            with self._lock, self.conn:
+                ids = []
+                for e in entries:
+                    texts = (e.get("query"), e.get("context"), e.get("res_sql"), e.get("res_idx"), e.get("res_expl"))
+                    refs = [self._store_blob(self.conn, text) for text in texts]
+                    telemetry = e.get("telemetry") or {}
+                    columns = (["request_mode", "db_type", "model", "query_preview", "fingerprint"]
+                               + list(self.REF_COLUMNS.values()) + list(self.TELEMETRY_COLUMNS))
+                    cursor = self.conn.execute(f"""
+                        INSERT INTO history ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})
+                    """, [e["mode"], e["db_type"], e["model"], (e.get("query") or "")[:41], query_fingerprint(e.get("query"))]
+                         + refs + [telemetry.get(c) for c in self.TELEMETRY_COLUMNS])
+                    ids.append(cursor.lastrowid)
+                return ids
+        except Exception as e:
+            print(f"Failed to save history: {e}")
+            return [None] * len(entries)
+
+    def get_summaries(self, limit=100, offset=0):
+        """Lightweight rows for the sidebar: no result texts, only a short query preview"""
+        try:
+            with self._lock:
+                return self.conn.execute(f"""
+                    SELECT {self.SUMMARY_COLUMNS} FROM history h
+                    ORDER BY h.timestamp DESC, h.id DESC LIMIT ? OFFSET ?
+                """, (limit, offset)).fetchall()
+        except Exception:
+            return []
+
+    def get_summary(self, item_id):
+        try:
+            with self._lock:
+                return self.conn.execute(f"SELECT {self.SUMMARY_COLUMNS} FROM history h WHERE h.id = ?", (item_id,)).fetchone()
+        except Exception:
+            return None
+
+    @staticmethod
+    def fts_query(text):
+        # Every word must match; quoting keeps SQL punctuation (a.b, col_name) from being FTS syntax
+        terms = ['"' + term.replace('"', '""') + '"' for term in text.split()]
+        if terms:
+            terms[-1] += "*" # Prefix match while typing
+        return " ".join(terms)
+
+    def search(self, text="", db_type=None, model=None, mode=None, limit=AppConfig.HISTORY_PAGE_SIZE, offset=0,
+               group=False):
+        """Summaries matching the text and filters: best matches first, newest first without text.
+        With group, one row per query fingerprint (its latest run, newest first) with the number of runs."""
+        where, params = [], []
+        for column, value in (("request_mode", mode), ("db_type", db_type), ("model", model)):
+            if value:
+                where.append(f"h.{column} = ?")
+                params.append(value)
+
+        text = text.strip()
+        if group:
+            if text and self.has_fts:
+                where.append("h.id IN (SELECT rowid FROM history_fts WHERE history_fts MATCH ?)")
+                params.append(self.fts_query(text))
+            else:
+                for term in text.split():
+                    where.append("(" + " OR ".join(f"{self._text_expr('h', c)} LIKE ?" for c in self.TEXT_COLUMNS) + ")")
+                    params.extend([f"%{term}%"] * len(self.TEXT_COLUMNS))
+            # Entries without a fingerprint (empty queries) stay on their own
+            sql = f"""
+                SELECT {self.SUMMARY_COLUMNS}, g.runs FROM (
+                    SELECT MAX(h.id) AS latest_id, COUNT(*) AS runs FROM history h
+                    {"WHERE " + " AND ".join(where) if where else ""}
+                    GROUP BY COALESCE(h.fingerprint, h.id)
+                ) g JOIN history h ON h.id = g.latest_id
+                ORDER BY h.timestamp DESC, h.id DESC LIMIT ? OFFSET ?
+            """
+        elif text and self.has_fts:
+            where.insert(0, "history_fts MATCH ?")
+            params.insert(0, self.fts_query(text))
+            # bm25 is costly for terms found in most rows: score a recency-bounded window only
+            params.append(max(AppConfig.HISTORY_RANK_WINDOW, offset + limit))
+            sql = f"""
+                SELECT {self.SUMMARY_COLUMNS} FROM (
+                    SELECT history_fts.rowid AS match_id, bm25(history_fts) AS score
+                    FROM history_fts JOIN history h ON h.id = history_fts.rowid
+                    WHERE {" AND ".join(where)}
+                    ORDER BY history_fts.rowid DESC LIMIT ?
+                ) m JOIN history h ON h.id = m.match_id
+                ORDER BY m.score, h.id DESC LIMIT ? OFFSET ?
+            """
+        else:
+            for term in text.split():
+                where.append("(" + " OR ".join(f"{self._text_expr('h', c)} LIKE ?" for c in self.TEXT_COLUMNS) + ")")
+                params.extend([f"%{term}%"] * len(self.TEXT_COLUMNS))
+            sql = f"""
+                SELECT {self.SUMMARY_COLUMNS} FROM history h
+                {"WHERE " + " AND ".join(where) if where else ""}
+                ORDER BY h.timestamp DESC, h.id DESC LIMIT ? OFFSET ?
+            """
+        try:
+            with self._lock:
+                return self.conn.execute(sql, params + [limit, offset]).fetchall()
+        except Exception as e:
+            print(f"History search failed: {e}")
+            return []
+
+    def get_distinct(self, column):
+        """Values used so far for a filterable column (model or db_type)"""
+        if column not in ("model", "db_type"):
+            raise ValueError(column)
+        try:
+            with self._lock:
+                rows = self.conn.execute(f"SELECT DISTINCT {column} FROM history WHERE {column} IS NOT NULL ORDER BY {column}")
+                return [r[0] for r in rows]
+        except Exception:
+            return []
+
+    def telemetry_stats(self, group_by="model"):
+        """Request count, retries and p50/p95 of each metric per model, endpoint or db_type,
+        busiest first. Answers replayed from the cache are left out."""
+        if group_by not in self.STATS_GROUPS:
+            raise ValueError(group_by)
+        groups = OrderedDict()
+        try:
+            with self._lock:
+                rows = self.conn.execute(f"""
+                    SELECT {group_by} AS grp, retries, {", ".join(self.STATS_METRICS)}
+                    FROM history WHERE total_s IS NOT NULL
+                """).fetchall()
+        except Exception as e:
+            print(f"Failed to read telemetry: {e}")
+            return []
+        for row in rows:
+            groups.setdefault(row["grp"] or "-", []).append(row)
+
+        stats = []
+        for key, items in groups.items():
+            entry = {group_by: key, "requests": len(items), "retries": sum(r["retries"] or 0 for r in items)}
+            for metric in self.STATS_METRICS:
+                values = [r[metric] for r in items if r[metric] is not None]
+                entry[f"{metric}_p50"] = percentile(values, 0.5)
+                entry[f"{metric}_p95"] = percentile(values, 0.95)
+            stats.append(entry)
+        stats.sort(key=lambda e: -e["requests"])
+        return stats
+
+    def export_telemetry(self, path):
+        """Write one CSV row per request that reached the server; returns the row count"""
+        import csv
+        columns = ["id", "timestamp", "request_mode", "db_type", "model"] + list(self.TELEMETRY_COLUMNS)
+        with self._lock:
+            rows = self.conn.execute(f"""
+                SELECT {", ".join(columns)} FROM history WHERE total_s IS NOT NULL ORDER BY timestamp, id
+            """).fetchall()
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            writer = csv.writer(f)
+            writer.writerow(columns)
+            writer.writerows(tuple(row) for row in rows)
+        return len(rows)
+
+    def get_item(self, item_id):
+        """The full entry, including query, context and results"""
+        try:
+            with self._lock:
+                texts = ", ".join(f"{self._text_expr('h', c)} AS {c}" for c in self.TEXT_COLUMNS)
+                return self.conn.execute(f"""
+                    SELECT h.id, h.timestamp, h.request_mode, h.db_type, h.model, h.fingerprint, {texts}
+                    FROM history h WHERE h.id = ?
+                """, (item_id,)).fetchone()
+        except Exception:
+            return None
+
+    def delete_item(self, item_id):
+        try:
+            with self._lock, self.conn:
+                self.conn.execute("DELETE FROM history WHERE id = ?", (item_id,))
+        except Exception as e:
+            print(f"Failed to delete item: {e}")
+        # Its texts are removed by the next prune() if no other entry uses them
+
+    def clear_all(self):
+        try:
+            with self._lock, self.conn:
+                self.conn.execute("DELETE FROM history")
+                self.conn.execute("DELETE FROM blobs")
+            self._prune_wakeup.set()
+        except Exception as e:
+            print(f"Failed to clear history: {e}")
+
+    def set_retention(self, max_rows, max_age_days, max_db_mb):
+        self.retention = (int(max_rows), float(max_age_days), float(max_db_mb))
+        self._prune_wakeup.set()
+
+    def db_size(self):
+        """Bytes in use (free pages excluded)"""
+        page_size = self.conn.execute("PRAGMA page_size").fetchone()[0]
+        used = self.conn.execute("PRAGMA page_count").fetchone()[0] - self.conn.execute("PRAGMA freelist_count").fetchone()[0]
+        return used * page_size
+
+    def _collect_blobs(self):
+        refs = " UNION ".join(f"SELECT {ref} FROM history WHERE {ref} IS NOT NULL" for ref in self.REF_COLUMNS.values())
+        return self.conn.execute(f"DELETE FROM blobs WHERE hash NOT IN ({refs})").rowcount
+
+    def prune(self):
+        """Apply the retention policy, drop unreferenced texts and give free pages back to the OS"""
+        max_rows, max_age_days, max_db_mb = self.retention
+        removed = 0
+        with self._lock:
+            with self.conn:
+                if max_age_days > 0:
+                    removed += self.conn.execute("DELETE FROM history WHERE timestamp < datetime('now', ?)",
+                                                 (f"-{max_age_days} days",)).rowcount
+                if max_rows > 0:
+                    removed += self.conn.execute("""
+                        DELETE FROM history WHERE id IN (
+                            SELECT id FROM history ORDER BY timestamp DESC, id DESC LIMIT -1 OFFSET ?
+                        )
+                    """, (max_rows,)).rowcount
+                self._collect_blobs()
+
+        # Size limit: drop the oldest 5% at a time until the database fits
+        while max_db_mb > 0:
+            with self._lock:
+                if self.db_size() <= max_db_mb * 1024 * 1024:
+                    break
+                with self.conn:
+                    total = self.conn.execute("SELECT COUNT(*) FROM history").fetchone()[0]
+                    if total == 0:
+                        break
+                    removed += self.conn.execute("""
+                        DELETE FROM history WHERE id IN (
+                            SELECT id FROM history ORDER BY timestamp ASC, id ASC LIMIT ?
+                        )
+                    """, (max(1, total // 20),)).rowcount
+                    self._collect_blobs()
+
+        with self._lock:
+            self.conn.execute("PRAGMA incremental_vacuum") # a no-op unless auto_vacuum is INCREMENTAL
+        return removed
+
+    def start_pruning(self, interval=AppConfig.HISTORY_PRUNE_INTERVAL, on_pruned=None):
+        """Run prune() now and then every interval seconds (or when woken up) in a daemon thread"""
+        def loop():
+            while self.conn is not None:
+                try:
+                    removed = self.prune()
+                    if removed and on_pruned:
+                        on_pruned(removed)
+                except Exception as e:
+                    print(f"History pruning failed: {e}")
+                self._prune_wakeup.wait(interval)
+                self._prune_wakeup.clear()
+
+        if self._prune_thread is None:
+            self._prune_thread = threading.Thread(target=loop, daemon=True)
+            self._prune_thread.start()
+
+    def close(self):
+        with self._lock:
+            if self.conn is not None:
+                self.conn.close()
+                self.conn = None
+
+class HistoryWriter:
+    """Owns all history I/O of the GUI on one background thread.
+
+    Saves are committed in batches; other calls (searches, loads, deletes)
+    run on the same thread in submission order. Queueing never blocks the
+    caller (the Tk thread): past max_pending, tasks wait in order in an
+    unbounded overflow list until the writer catches up.
+    Callbacks run on the writer thread, so GUI callers hand them to after().
+    """
+    def __init__(self, history_manager, max_pending=AppConfig.HISTORY_QUEUE_SIZE, batch_size=AppConfig.HISTORY_BATCH_SIZE):
+        from collections import deque
+        self.history_manager = history_manager
+        self.batch_size = batch_size
+        self.queue = queue.Queue(maxsize=max_pending)
+        self._overflow = deque()
+        self._overflow_lock = threading.Lock()
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def save(self, entry, on_saved=None):
+        """Queue an entry (dict of HistoryManager.save arguments); on_saved(summary) runs once it is committed"""
+        self._put(("save", entry, on_saved))
+
+    def call(self, func, on_done=None):
+        """Run func(history_manager) on the writer thread; on_done(result) receives its result"""
+        self._put(("call", func, on_done))
+
+    def _put(self, task):
+        with self._overflow_lock:
+            if not self._overflow: # otherwise the task would overtake the ones already waiting
+                try:
+                    self.queue.put_nowait(task)
+                    return
+                except queue.Full:
+                    print(f"History writer is behind: more than {self.queue.maxsize} tasks pending")
+            self._overflow.append(task)
+
+    def _refill(self):
+        """Move overflow tasks into the queue while it has room (writer thread, before task_done)"""
+        with self._overflow_lock:
+            while self._overflow:
+                try:
+                    self.queue.put_nowait(self._overflow[0])
+                except queue.Full:
+                    break
+                self._overflow.popleft()
+
+    def _loop(self):
+        task = self.queue.get()
+        while task[0] != "stop":
+            kind, payload, callback = task
+            if kind == "call":
+                try:
+                    result = payload(self.history_manager)
+                except Exception as e:
+                    print(f"History task failed: {e}")
+                    result = None
+                self._notify(callback, result)
+                self._refill()
+                self.queue.task_done()
+                task = self.queue.get()
+                continue
+
+            # Commit every save already waiting together with this one
+            batch = [task]
+            task = None
+            while len(batch) < self.batch_size:
+                try:
+                    pending = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if pending[0] != "save":
+                    task = pending # runs next, after the batch it was queued behind
+                    break
+                batch.append(pending)
+
+            ids = self.history_manager.save_many([entry for _, entry, _ in batch])
+            for (_, _, on_saved), item_id in zip(batch, ids):
+                if on_saved and item_id is not None:
+                    self._notify(on_saved, self.history_manager.get_summary(item_id))
+            self._refill()
+            for _ in batch:
+                self.queue.task_done()
+            if task is None:
+                task = self.queue.get()
+        self.queue.task_done()
+
+    @staticmethod
+    def _notify(callback, value):
+        if callback is None:
+            return
+        try:
+            callback(value)
+        except Exception as e:
+            print(f"History callback failed: {e}")
+
+    def flush(self):
+        """Block until every queued task has been processed"""
+        self.queue.join() # overflow tasks enter the queue before the last queued task is marked done
+
+    def close(self, timeout=5):
+        """Process what is queued, then stop the thread"""
+        if self.thread.is_alive():
+            self._put(("stop", None, None))
+            self.thread.join(timeout)
+
+_request_context = threading.local()
+
+class CancelToken:
+    """Lets another thread abort an in-flight request.
+
+    Connections used while the token is active register themselves (see
+    make_http_adapter); cancel() shuts their sockets down, which unblocks the
+    worker immediately and makes the server (e.g. Ollama) see the client go away
+    and stop generating.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._connections = set()
+        self._responses = []
+        self._children = []
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def attach_connection(self, conn):
+        with self._lock:
+            self._connections.add(conn)
+        if self.cancelled:
+            self._shutdown(conn)
+
+    def child(self):
+        """A token cancelled with this one that can also be cancelled on its own"""
+        token = CancelToken()
+        with self._lock:
+            self._children.append(token)
+        if self.cancelled:
+            token.cancel()
+        return token
+
+    def attach_response(self, response):
+        with self._lock:
+            self._responses.append(response)
+        if self.cancelled:
+            response.close()
+
+    @staticmethod
+    def _shutdown(conn):
+        import socket
+        sock = getattr(conn, "sock", None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass # Already closed
+
+    def cancel(self):
+        self._event.set()
+        with self._lock:
+            connections, responses = list(self._connections), list(self._responses)
+            children = list(self._children)
+        for token in children:
+            token.cancel()
+        for conn in connections:
+            self._shutdown(conn)
+        for response in responses:
+            try:
+                response.close()
+            except Exception:
+                pass
+
+    def release(self):
+        """The request is over: its pooled connections may now serve other requests"""
+        with self._lock:
+            self._connections.clear()
+            self._responses.clear()
+            children, self._children = self._children, []
+        for token in children:
+            token.release()
+
+_adapter_class = None
+
+def make_http_adapter(pool_size):
+    """HTTPAdapter whose connections register with the CancelToken of the calling thread"""
+    global _adapter_class
+    if _adapter_class is None:
+        import urllib3
+        from urllib3.connection import HTTPConnection, HTTPSConnection
+        from requests.adapters import HTTPAdapter
+
+        class CancellableMixin:
+            def connect(self):
+                super().connect()
+                token = getattr(_request_context, "cancel_token", None)
+                if token is not None:
+                    token.attach_connection(self)
+
+            def request(self, *args, **kwargs):
+                token = getattr(_request_context, "cancel_token", None)
+                if token is not None:
+                    token.attach_connection(self)
+                return super().request(*args, **kwargs)
+
+        class CancellableHTTPConnection(CancellableMixin, HTTPConnection):
+            pass
+
+        class CancellableHTTPSConnection(CancellableMixin, HTTPSConnection):
+            pass
+
+        class CancellableHTTPPool(urllib3.HTTPConnectionPool):
+            ConnectionCls = CancellableHTTPConnection
+
+        class CancellableHTTPSPool(urllib3.HTTPSConnectionPool):
+            ConnectionCls = CancellableHTTPSConnection
+
+        class CancellableAdapter(HTTPAdapter):
+            def init_poolmanager(self, *args, **kwargs):
+                super().init_poolmanager(*args, **kwargs)
+                self.poolmanager.pool_classes_by_scheme = {
+                    "http": CancellableHTTPPool,
+                    "https": CancellableHTTPSPool
+                }
+
+        _adapter_class = CancellableAdapter
+    return _adapter_class(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+
+class HttpSessionPool:
+    """Long-lived keep-alive sessions, one per endpoint (scheme://host:port), shared by all threads"""
+    def __init__(self, pool_size=AppConfig.HTTP_POOL_SIZE, connect_timeout=AppConfig.CONNECT_TIMEOUT,
+                 compression=AppConfig.HTTP_COMPRESSION):
+        self._sessions = {}
+        self._lock = threading.Lock()
+        self.pool_size = int(pool_size)
+        self.connect_timeout = float(connect_timeout)
+        self.compression = bool(compression)
+
+    @classmethod
+    def from_settings(cls, settings):
+        return cls(
+            settings.get("http_pool_size", AppConfig.HTTP_POOL_SIZE),
+            settings.get("connect_timeout", AppConfig.CONNECT_TIMEOUT),
+            settings.get("http_compression", AppConfig.HTTP_COMPRESSION)
+        )
+
+    def configure(self, pool_size, connect_timeout, compression):
+        # The connect timeout is applied per request; only pool shape changes need new sessions
+        self.connect_timeout = float(connect_timeout)
+        if int(pool_size) != self.pool_size or bool(compression) != self.compression:
+            self.pool_size = int(pool_size)
+            self.compression = bool(compression)
+            self.reset()
+
+    @staticmethod
+    def endpoint_key(url):
+        from urllib.parse import urlsplit
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}".lower()
+
+    def _new_session(self):
+        import requests
+        session = requests.Session()
+        adapter = make_http_adapter(self.pool_size)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        # Streams arrive token by token; "identity" avoids proxies buffering compressed chunks
+        session.headers["Accept-Encoding"] = "gzip, deflate" if self.compression else "identity"
+        session.headers["Connection"] = "keep-alive"
+        return session
+
+    def session_for(self, url):
+        key = self.endpoint_key(url)
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                session = self._sessions[key] = self._new_session()
+            return session
+
+    def timeout(self, read_timeout):
+        return (self.connect_timeout, float(read_timeout))
+
+    def request(self, method, url, read_timeout, cancel_token=None, **kwargs):
+        session = self.session_for(url)
+        if cancel_token is None:
+            return session.request(method, url, timeout=self.timeout(read_timeout), **kwargs)
+
+        _request_context.cancel_token = cancel_token
+        try:
+            response = session.request(method, url, timeout=self.timeout(read_timeout), **kwargs)
+        finally:
+            _request_context.cancel_token = None
+        cancel_token.attach_response(response)
+        return response
+
+    def post(self, url, read_timeout, **kwargs):
+        return self.request("POST", url, read_timeout, **kwargs)
+
+    def get(self, url, read_timeout, **kwargs):
+        return self.request("GET", url, read_timeout, **kwargs)
+
+    def reset(self):
+        with self._lock:
+            sessions, self._sessions = list(self._sessions.values()), {}
+        for session in sessions:
+            session.close()
+
+class EndpointPool:
+    """Spreads requests over several OpenAI-compatible endpoints serving the same models.
+
+    Each request goes to the healthy endpoint with the fewest outstanding
+    requests per unit of weight. A request failing with a connection error
+    or a 5xx answer fails over to the next endpoint; ENDPOINT_MAX_FAILURES
+    failures in a row (cancellations do not count) mark the endpoint down
+    until a later success or health check brings it back. With hedging, a request that has not received a
+    byte within its endpoint's p95 time to first byte is duplicated on a
+    second endpoint, and the slower of the two is cancelled.
+    """
+    def __init__(self, http_pool, entries=(), api_key=""):
+        self.http_pool = http_pool
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._health_thread = None
+        self.api_key = api_key
+        self.configure(entries, api_key)
+
+    @staticmethod
+    def parse_entries(primary_url, lines):
+        """(url, weight) pairs: the main URL first, then "URL [weight]" lines"""
+        entries = OrderedDict([(primary_url.strip(), 1.0)])
+        for line in lines:
+            parts = line.split()
+            if not parts or parts[0].startswith("#"):
+                continue
+            entries[parts[0]] = max(0.1, float(parts[1])) if len(parts) > 1 else 1.0
+        return list(entries.items())
+
+    def configure(self, entries, api_key=""):
+        # Statistics survive for URLs that stay in the pool
+        from collections import deque
+        with self._lock:
+            self.api_key = api_key
+            old, self._endpoints = self._endpoints, OrderedDict()
+            for url, weight in entries:
+                endpoint = old.get(url) or {"url": url, "outstanding": 0, "healthy": True, "requests": 0, "errors": 0,
+                                            "failures": 0, "ttfb": deque(maxlen=AppConfig.LATENCY_WINDOW)}
+                endpoint["weight"] = float(weight)
+                self._endpoints[url] = endpoint
+
+    def __len__(self):
+        return len(self._endpoints)
+
+    def pick(self, exclude=()):
+        """The least loaded healthy endpoint not in exclude, or None; it counts as outstanding until end()"""
+        with self._lock:
+            candidates = [e for e in self._endpoints.values() if e["url"] not in exclude]
+            healthy = [e for e in candidates if e["healthy"]] or candidates # all down: try anyway
+            if not healthy:
+                return None
+            best = min(healthy, key=lambda e: ((e["outstanding"] + 1) / e["weight"], self._percentile(e, 0.5) or 0))
+            best["outstanding"] += 1
+            return best["url"]
+
+    def end(self, url):
+        with self._lock:
+            endpoint = self._endpoints.get(url)
+            if endpoint is not None and endpoint["outstanding"] > 0:
+                endpoint["outstanding"] -= 1
+
+    def record(self, url, ttfb=None, ok=True):
+        with self._lock:
+            endpoint = self._endpoints.get(url)
+            if endpoint is None:
+                return
+            if ok:
+                endpoint["requests"] += 1
+                endpoint["failures"] = 0
+                endpoint["healthy"] = True
+                if ttfb is not None:
+                    endpoint["ttfb"].append(ttfb)
+            else:
+                # One transient error only fails this request over
+                endpoint["errors"] += 1
+                endpoint["failures"] += 1
+                if endpoint["failures"] >= AppConfig.ENDPOINT_MAX_FAILURES:
+                    endpoint["healthy"] = False
+
+    @staticmethod
+    def _percentile(endpoint, q):
+        return percentile(endpoint["ttfb"], q)
+
+    def hedge_delay(self, url):
+        with self._lock:
+            endpoint = self._endpoints.get(url)
+            if endpoint is None or len(endpoint["ttfb"]) < AppConfig.HEDGE_MIN_SAMPLES:
+                return AppConfig.HEDGE_DEFAULT_DELAY
+            return self._percentile(endpoint, 0.95)
+
+    def stats(self):
+        with self._lock:
+            return [{"url": e["url"], "weight": e["weight"], "healthy": e["healthy"], "outstanding": e["outstanding"],
+                     "requests": e["requests"], "errors": e["errors"],
+                     "p50": self._percentile(e, 0.5), "p95": self._percentile(e, 0.95)}
+                    for e in self._endpoints.values()]
+
+    def _attempt(self, url, token, state, results, read_timeout, endpoint, kwargs):
+        start = time.time()
+        try:
+            response = self.http_pool.post(endpoint(url), read_timeout, cancel_token=token, **kwargs)
+        except Exception as e:
+            self.end(url)
+            if not token.cancelled:
+                self.record(url, ok=False)
+            results.put((url, None, e))
+            return
+
+        if response.status_code >= 500:
+            import requests
+            response.close()
+            self.end(url)
+            if not token.cancelled:
+                self.record(url, ok=False)
+            results.put((url, None, requests.HTTPError(f"{response.status_code} Server Error for url: {url}", response=response)))
+            return
+
+        self.record(url, time.time() - start)
+        with state["lock"]:
+            won = state["winner"] is None and not token.cancelled
+            if won:
+                state["winner"] = url
+        if won:
+            results.put((url, response, None))
+        else:
+            response.close() # the other hedged request answered first
+            self.end(url)
+
+    def post(self, read_timeout, cancel_token, hedge=False, endpoint=None, info=None, **kwargs):
+        """POST to the best endpoint with failover (and hedging). Returns (url, response);
+        the caller must call end(url) once it has read the response. endpoint(url) maps
+        a pool URL to the one posted to (e.g. a backend's native API path). If given,
+        info["attempts"] receives the number of requests sent (failovers and hedges included)."""
+        info = {} if info is None else info
+        endpoint = endpoint or (lambda url: url)
+        results = queue.Queue()
+        state = {"winner": None, "lock": threading.Lock()}
+        attempts = OrderedDict()
+
+        def launch(url):
+            token = cancel_token.child()
+            attempts[url] = token
+            info["attempts"] = len(attempts)
+            threading.Thread(target=self._attempt, args=(url, token, state, results, read_timeout, endpoint, kwargs),
+                             daemon=True).start()
+
+        first = self.pick()
+        launch(first)
+        pending = 1
+        hedged = not hedge or len(self) < 2
+        last_error = None
+        while pending:
+            try:
+                url, response, error = results.get(timeout=None if hedged else self.hedge_delay(first))
+            except queue.Empty:
+                hedged = True
+                backup = self.pick(exclude=attempts)
+                if backup is not None:
+                    launch(backup)
+                    pending += 1
+                continue
+
+            pending -= 1
+            if response is not None:
+                for other, token in attempts.items():
+                    if other != url:
+                        token.cancel()
+                return url, response
+
+            last_error = error
+            if cancel_token.cancelled:
+                break
+            # Fail over, unless a hedged request is still running
+            if pending == 0:
+                backup = self.pick(exclude=attempts)
+                if backup is not None:
+                    first = backup
+                    launch(backup)
+                    pending += 1
+        raise last_error
+
+    @staticmethod
+    def health_url(url):
+        # /v1/models answers on Ollama and OpenAI-compatible servers without generating anything
+        if "/chat/completions" in url:
+            return url.split("/chat/completions")[0] + "/models"
+        return HttpSessionPool.endpoint_key(url) + "/"
+
+    def check_health(self):
+        headers = {"Authorization": f"Bearer {self.api_key}"} if self.api_key else {}
+        with self._lock:
+            urls = list(self._endpoints)
+        for url in urls:
+            try:
+                response = self.http_pool.get(self.health_url(url), self.http_pool.connect_timeout, headers=headers)
+                response.close()
+                healthy = response.status_code < 500
+            except Exception:
+                healthy = False
+            with self._lock:
+                if url in self._endpoints:
+                    self._endpoints[url]["healthy"] = healthy
+                    if healthy:
+                        self._endpoints[url]["failures"] = 0
+
+    def start_health_checks(self, interval=AppConfig.HEALTH_CHECK_INTERVAL):
+        """Probe every endpoint every interval seconds in a daemon thread, while there is more than one"""
+        def loop():
+            while True:
+                if len(self) > 1:
+                    self.check_health()
+                time.sleep(interval)
+
+        if self._health_thread is None:
+            self._health_thread = threading.Thread(target=loop, daemon=True)
+            self._health_thread.start()
+
+class ModelWarmer:
+    """Loads the selected model on every Ollama endpoint before it is needed.
+
+    A daemon thread sends an empty /api/generate request (which only loads the
+    model) whenever the model or endpoints change, and repeats it every
+    WARMUP_REFRESH seconds with the configured keep_alive so the model stays
+    resident while the app is open. /api/ps tells whether it is in memory;
+    on_status(state) is called with "loaded", "loading", "unloaded", "offline"
+    or None (not an Ollama endpoint) when that changes.
+    """
+    def __init__(self, http_pool, on_status=None):
+        self.http_pool = http_pool
+        self.on_status = on_status
+        self.urls = []
+        self.model = ""
+        self.keep_alive = AppConfig.OLLAMA_KEEP_ALIVE
+        self.enabled = AppConfig.WARMUP_ENABLED
+        self.read_timeout = AppConfig.TIMEOUT
+        self.state = None
+        self._is_ollama = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    @staticmethod
+    def ollama_base(url):
+        return re.sub(r"/(?:v1|api)(?:/.*)?$", "", url.strip()).rstrip("/")
+
+    @staticmethod
+    def keep_alive_value(text):
+        """Ollama takes a duration ("30m", "24h") or a number of seconds (-1 = forever)"""
+        text = str(text).strip()
+        try:
+            return int(text)
+        except ValueError:
+            return text
+
+    def configure(self, urls, model, keep_alive, enabled=True, read_timeout=AppConfig.TIMEOUT):
+        with self._lock:
+            changed = (list(urls), model, keep_alive, enabled) != (self.urls, self.model, self.keep_alive, self.enabled)
+            self.urls = list(urls)
+            self.model = model
+            self.keep_alive = keep_alive
+            self.enabled = enabled
+            self.read_timeout = read_timeout
+        if changed:
+            self._wakeup.set()
+
+    def _ollama_urls(self, urls):
+        # Endpoints without /api/ps (OpenAI and the like) are remembered and skipped
+        found = []
+        for url in urls:
+            base = self.ollama_base(url)
+            if base not in self._is_ollama:
+                try:
+                    response = self.http_pool.get(base + "/api/ps", self.http_pool.connect_timeout)
+                    response.close()
+                    self._is_ollama[base] = response.status_code == 200
+                except Exception:
+                    found.append(base) # down for now; asked again next time
+                    continue
+            if self._is_ollama[base]:
+                found.append(base)
+        return found
+
+    @staticmethod
+    def _names(model):
+        return {model, model if ":" in model else model + ":latest"}
+
+    def status(self, bases, model):
+        loaded, reachable = False, False
+        for base in bases:
+            try:
+                response = self.http_pool.get(base + "/api/ps", self.http_pool.connect_timeout)
+                response.raise_for_status()
+                running = response.json().get("models", [])
+            except Exception:
+                continue
+            reachable = True
+            names = self._names(model)
+            loaded = any(m.get("name") in names or m.get("model") in names for m in running)
+            if not loaded:
+                return "unloaded"
+        if not reachable:
+            return "offline"
+        return "loaded" if loaded else "unloaded"
+
+    def warm(self, bases, model, keep_alive, read_timeout):
+        payload = {"model": model, "keep_alive": self.keep_alive_value(keep_alive)}
+        for base in bases:
+            try:
+                response = self.http_pool.post(base + "/api/generate", read_timeout, json=payload)
+                response.close()
+            except Exception as e:
+                print(f"Model warm-up failed on {base}: {e}")
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.state = state
+            if self.on_status:
+                self.on_status(state)
+
+    def _loop(self):
+        warmed, last_warm = None, 0
+        while True:
+            with self._lock:
+                urls, model, keep_alive = self.urls, self.model, self.keep_alive
+                enabled, read_timeout = self.enabled, self.read_timeout
+            bases = self._ollama_urls(urls) if model else []
+            if not bases:
+                self._set_state(None)
+            else:
+                state = self.status(bases, model)
+                target = (tuple(bases), model, keep_alive)
+                due = target != warmed or time.time() - last_warm >= AppConfig.WARMUP_REFRESH
+                if enabled and state != "offline" and due:
+                    if state != "loaded":
+                        self._set_state("loading")
+                    self.warm(bases, model, keep_alive, read_timeout)
+                    warmed, last_warm = target, time.time()
+                    state = self.status(bases, model)
+                self._set_state(state)
+            self._wakeup.wait(AppConfig.MODEL_STATUS_INTERVAL)
+            self._wakeup.clear()
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, daemon=True)
+            self._thread.start()
+
+# --- Optimization Engine (shared by the GUI and the headless batch mode) ---
+def default_settings():
+    return {
+        "db_type": AppConfig.DB_OPTIONS[0],
+        "model": AppConfig.DEFAULT_MODEL,
+        "appearance": "System",
+        "ollama_url": AppConfig.OLLAMA_URL,
+        "timeout": AppConfig.TIMEOUT,
+        "temperature": AppConfig.AI_TEMPERATURE,
+        "ctx_size": AppConfig.AI_CTX_SIZE,
+        "max_tokens": AppConfig.AI_MAX_TOKENS,
+        "num_thread": AppConfig.AI_NUM_THREAD,
+        "num_gpu": AppConfig.AI_NUM_GPU,
+        "api_backend": AppConfig.API_BACKEND,
+        "font_mono": AppConfig.FONT_MONO,
+        "font_sans": AppConfig.FONT_SANS,
+        "size_query": AppConfig.SIZE_QUERY,
+        "size_indices": AppConfig.SIZE_INDICES,
+        "size_explanation": AppConfig.SIZE_EXPLANATION,
+        "system_prompt_chat": AppConfig.DEFAULT_SYSTEM_PROMPT_CHAT,
+        "available_models": [AppConfig.DEFAULT_MODEL],
+        "cache_enabled": AppConfig.CACHE_ENABLED,
+        "cache_max_entries": AppConfig.CACHE_MAX_ENTRIES,
+        "cache_max_size_mb": AppConfig.CACHE_MAX_SIZE_MB,
+        "cache_max_age_days": AppConfig.CACHE_MAX_AGE_DAYS,
+        "batch_concurrency": AppConfig.BATCH_CONCURRENCY,
+        "http_pool_size": AppConfig.HTTP_POOL_SIZE,
+        "connect_timeout": AppConfig.CONNECT_TIMEOUT,
+        "http_compression": AppConfig.HTTP_COMPRESSION,
+        "stream_flush_ms": AppConfig.STREAM_FLUSH_MS,
+        "stream_optimize": AppConfig.STREAM_OPTIMIZE,
+        "stream_usage": AppConfig.STREAM_USAGE,
+        "history_max_rows": AppConfig.HISTORY_MAX_ROWS,
+        "history_max_age_days": AppConfig.HISTORY_MAX_AGE_DAYS,
+        "history_max_db_mb": AppConfig.HISTORY_MAX_DB_MB,
+        "history_group_queries": AppConfig.HISTORY_GROUP_QUERIES,
+        "schema_paths": [],
+        "schema_auto_inject": AppConfig.SCHEMA_AUTO_INJECT,
+        "schema_token_budget": AppConfig.SCHEMA_TOKEN_BUDGET,
+        "compare_targets": [],
+        "endpoint_pool": [],
+        "hedge_requests": AppConfig.HEDGE_REQUESTS,
+        "job_concurrency": AppConfig.JOB_CONCURRENCY,
+        "warmup_enabled": AppConfig.WARMUP_ENABLED,
+        "keep_alive": AppConfig.OLLAMA_KEEP_ALIVE
+    }
+
+def load_settings_file(settings):
+    """Merge the saved preferences into settings (in place)"""
+    if os.path.exists(AppConfig.SETTINGS_FILE):
+        with open(AppConfig.SETTINGS_FILE, 'r') as f:
+            settings.update(json.load(f))
+    return settings
+
+# Offsets to achieve end-alignment at column 6 (length of SELECT)
+ALIGN_OFFSETS = {
+    'FROM': 2, 'JOIN': 2, 'LEFT': 2, 'RIGHT': 2, 'INNER': 2,
+    'WHERE': 1, 'AND': 3, 'OR': 4, 'ON': 4,
+    'GROUP': 1, 'ORDER': 1, 'HAVING': 1, 'LIMIT': 1,
+    'SET': 3, 'VALUES': 0, 'INSERT': 0, 'UPDATE': 0, 'DELETE': 0
+}
+# Same test as up.startswith(k) for any offset keyword, in one regex call
+_ALIGN_PREFIX_RE = re.compile("|".join(ALIGN_OFFSETS), re.IGNORECASE)
+_SELECT_RE = re.compile("SELECT", re.IGNORECASE)
+_FIRST_WORD_RE = re.compile(r"\S+")
+
+def align_lines(lines, settings):
+    """Soft right-alignment using nesting levels; consumes and yields lines one at a time"""
+    indent_width = settings.get("sql_indent_width", 2)
+    if settings.get("sql_compact_select", False):
+        lines = _compact_select_lines(lines)
+
+    nesting_level = 0
+    for line in lines:
+        stripped = line.lstrip()
+        if not stripped:
+            yield ""
+            continue
+
+        # Detect subquery start/end
+        is_subquery_start = stripped[0] == '(' and _SELECT_RE.search(stripped) is not None
+
+        # If the line starts with a closing paren, we are exiting a level
+        if stripped[0] == ')':
+            nesting_level = max(0, nesting_level - 1)
+
+        # Base indentation
+        current_base = nesting_level * (indent_width + 1)
+
+        # Get the first word (handling the starting '(' for subqueries)
+        first_word = _FIRST_WORD_RE.match(stripped).group().upper().replace('(', '')
+
+        if is_subquery_start:
+            new_line = (" " * (current_base + indent_width)) + stripped
+            if ')' not in stripped:
+                nesting_level += 1
+        elif first_word in ALIGN_OFFSETS:
+            new_line = (" " * (current_base + ALIGN_OFFSETS[first_word])) + stripped
+        elif first_word == 'SELECT':
+            new_line = (" " * current_base) + stripped
+        else:
+            # Continuation line
+            new_line = (" " * (current_base + 7)) + stripped
+
+        if stripped[0] != ')' and ')' in stripped:
+            nesting_level = max(0, nesting_level - stripped.count(')'))
+
+        yield new_line
+
+def _compact_select_lines(lines):
+    """Join the lines between SELECT and the next clause keyword"""
+    buf = []
+    in_select = False
+    for line in lines:
+        stripped = line.strip()
+        if stripped[:6].upper() == 'SELECT':
+            in_select = True
+            buf.append(stripped)
+        elif in_select and _ALIGN_PREFIX_RE.match(stripped):
+            yield " ".join(buf)
+            buf = [line]
+            in_select = False
+        elif in_select:
+            buf.append(stripped)
+        else:
+            yield line
+    if buf:
+        yield " ".join(buf) if in_select else buf[0]
+
+def align_sql_keywords(sql, settings):
+    """Advanced post-processing for soft right-alignment using nesting levels"""
+    return '\n'.join(align_lines(sql.split('\n'), settings))
+
+# --- Single-pass formatter ---
+# Tokenizes like sqlparse's lexer and breaks lines where sqlparse's reindent
+# filter would, without building a parse tree. The indentation sqlparse adds
+# is dropped by align_lines anyway, so only the line breaks have to match.
+_SQL_TOKEN_RE = re.compile(r"""
+    (?P<comment>(?:--|\#\ )[^\r\n]*(?:\r\n|\r|\n)?|/\*.*?\*/)
+  | (?P<ws>\s+)
+  | (?P<string>'(?:''|\\'|[^'])*'|"(?:""|\\"|[^"])*"|`(?:``|[^`])*`)
+  | (?P<cmp>(?:NOT\s+)?(?:LIKE|ILIKE|RLIKE)\b|(?:NOT\s+)?REGEXP(?:\s+BINARY)?\b)
+  | (?P<kw>(?:(?:LEFT\s+|RIGHT\s+|FULL\s+)?(?:INNER\s+|OUTER\s+|STRAIGHT\s+)?|(?:CROSS\s+|NATURAL\s+)?)?JOIN\b
+      |END(?:\s+IF|\s+LOOP|\s+WHILE|\s+FOR|\s+CASE)?\b|IF\s+(?:NOT\s+)?EXISTS\b|NOT\s+NULL\b
+      |UNION\s+ALL\b
+      |GROUP\s+BY\b|ORDER\s+BY\b|PRIMARY\s+KEY\b)
+  | (?P<order>(?:ASC|DESC)(?:\s+NULLS\s+(?:FIRST|LAST))?\b|NULLS\s+(?:FIRST|LAST)\b)
+  | (?P<ddl>CREATE(?:\s+OR\s+REPLACE)?\b)
+  | (?P<word>\w[$#\w]*)
+  | (?P<punct>[(),;])
+  | (?P<other>::|:=|.)
+""", re.IGNORECASE | re.VERBOSE | re.DOTALL)
+_DOT_AHEAD_RE = re.compile(r"\s*\.(?!\d)")
+_SPLIT_KEYWORD_RE = re.compile(r"FROM|STRAIGHT_JOIN$|JOIN$|AND|OR|GROUP BY|ORDER BY|UNION|VALUES|SET|BETWEEN|EXCEPT|HAVING|LIMIT|WHERE")
+_ALWAYS_KEYWORDS = {"CASE", "IN", "VALUES", "USING", "FROM", "AS"}
+_keyword_types = {}
+
+def _keyword_type(word):
+    """'kw', 'dml' or None, per sqlparse's keyword tables (cached)"""
+    up = word.upper()
+    kind = _keyword_types.get(up, False)
+    if kind is False:
+        from sqlparse import tokens as T
+        from sqlparse.lexer import Lexer
+        ttype = Lexer.get_default_instance().is_keyword(up)[0]
+        if ttype is T.Keyword.DML or ttype is T.Keyword.DDL:
+            kind = "dml"
+        elif ttype is T.Keyword:
+            kind = "kw"
+        elif ttype in T.Keyword:
+            kind = "kwother" # case-changed, never breaks a line
+        else:
+            kind = None
+        _keyword_types[up] = kind
+    return kind
+
+def tokenize_sql(sql):
+    """Flat (kind, text) tokens; words come out as 'name', 'num', 'kw', 'kwother' or 'dml'"""
+    tokens = []
+    prev_char = ""
+    for m in _SQL_TOKEN_RE.finditer(sql):
+        kind = m.lastgroup
+        text = m.group()
+        if kind == "word":
+            end = m.end()
+            if text[0].isdigit():
+                kind = "num"
+            elif text.upper() in _ALWAYS_KEYWORDS:
+                kind = "kw"
+            elif prev_char == "." or sql.startswith("(", end) or _DOT_AHEAD_RE.match(sql, end):
+                kind = "name"
+            else:
+                kind = _keyword_type(text) or "name"
+        elif kind == "ddl":
+            kind = "dml"
+        elif kind == "order":
+            kind = "kwother"
+        tokens.append((kind, text))
+        prev_char = text[-1]
+    return tokens
+
+def _match_parens(tokens):
+    """Partner index of every matched '(' and ')', and the '(' with a DML/DDL keyword directly
+    inside; sqlparse reindents those as subqueries, (WITH ... SELECT ...) as well as (SELECT ...)"""
+    partner = {}
+    dml_parens = set()
+    stack = []
+    for i, (kind, text) in enumerate(tokens):
+        if kind == "dml":
+            if stack:
+                dml_parens.add(stack[-1])
+        elif kind == "punct":
+            if text == "(":
+                stack.append(i)
+            elif text == ")":
+                if stack:
+                    j = stack.pop()
+                    partner[i] = j
+                    partner[j] = i
+            elif text == ";":
+                stack = []
+    return partner, dml_parens
+
+_WHERE_CLOSE = {"ORDER", "GROUP", "LIMIT", "UNION", "EXCEPT", "INTERSECT", "HAVING", "RETURNING", "INTO"}
+
+def format_sql_lines(sql, keyword_case="upper", comma_first=False, indent_width=2):
+    """Yield the reindented lines of sql (before alignment) in one pass over its tokens"""
+    convert = {"upper": str.upper, "lower": str.lower, "capitalize": str.capitalize}.get(keyword_case)
+    tokens = tokenize_sql(sql)
+    n = len(tokens)
+    partner, dml_parens = _match_parens(tokens)
+
+    cur = []             # pieces of the line being built
+    space = False        # whitespace seen since the last emitted token
+    broke_line = True    # the current line starts after a kept line break ('--' comment, ';', list comma)
+    stmt_start = True    # nothing of the current statement emitted yet
+    parens = []          # kinds of the open parentheses: 'sub', 'func', 'values', 'plain'
+    first_in_group = True
+    after_between = False
+    case_depth = 0
+    values_depth = None  # paren depth of an open VALUES list
+    create_table = False # sqlparse groups no function calls in CREATE TABLE
+    prev_kind = None     # last significant token ('comment' right after one, which prev_text/prev_i skip)
+    prev_text = ""
+    prev_i = -1
+    # sqlparse only breaks an identifier list once its items pass its indent column, which the
+    # lines it indents itself always do.  A line a comment breaks starts at a known, short column
+    # (line_col, None if sqlparse indents it), so a list starting on one may stay on one line.
+    line_col = 0
+    line_back = None     # width of the line a '--' comment ends, which sqlparse measures for a token right after it
+    wheres = []          # paren depths of the open WHERE clauses, which sqlparse indents
+    item_marks = {}      # depth -> (line, offset in it, column of the line) where the current item starts
+    lists = {}           # depth -> [start column, break column, position] of an open identifier list
+
+    def token_at(j):
+        return tokens[j] if 0 <= j < n else (None, "")
+
+    def skip(j, step, kinds=("ws", "comment")):
+        while 0 <= j < n and tokens[j][0] in kinds:
+            j += step
+        return j
+
+    def ends_item(kind, text):
+        return kind is None or text in (",", "(", ")", ";") or (kind in ("kw", "dml") and text.upper() != "AS")
+
+    def bare_close(j):
+        """Whether the ')' at j closes a parenthesis that sqlparse does not group into a larger item"""
+        if tokens[j][1] != ")" or j not in partner:
+            return False
+        before = token_at(skip(partner[j] - 1, -1, ("ws",)))
+        return before[0] == "comment" or ends_item(*before)
+
+    def in_item(j):
+        """Whether the token at j ends an item, which a comment after it joins"""
+        kind, text = token_at(j)
+        if kind == "name" or text == ")" or kind == "kw" and text.upper() == "END":
+            return True
+        return (kind in ("num", "string") or text == "*") and not ends_item(*token_at(skip(j - 1, -1)))
+
+    def group_start(j):
+        """Whether the comment at j starts a comment group"""
+        j -= 1
+        if 0 <= j and tokens[j][0] == "ws" and not tokens[j][1].strip("\r\n"):
+            j -= 1
+        return token_at(j)[0] != "comment"
+
+    def last_group(j):
+        """Whether the comment at j is in the last comment group (comments separated only by
+        line breaks) before the next token"""
+        split = False
+        for j in range(j + 1, n):
+            kind, text = tokens[j]
+            if kind == "ws":
+                split = split or bool(text.strip("\r\n"))
+            elif kind != "comment":
+                return True
+            elif split:
+                return False
+        return False
+
+    def comments_end(j):
+        while j < n and (tokens[j][0] == "comment" or tokens[j][0] == "ws" and not tokens[j][1].strip("\r\n")):
+            j += 1
+        return j == n
+
+    def item_len(j):
+        """Source length of the list item starting at j, as sqlparse measures it"""
+        start = j = skip(j, 1, ("ws",))
+        end = j
+        cases = 0
+        while j < n:
+            kind, text = tokens[j]
+            up = text.upper()
+            if kind == "comment":
+                if in_item(end):
+                    # The comment group joins the item, up to its last line break
+                    while j < n and tokens[j][0] == "comment":
+                        end = j
+                        j += 1
+                        if j < n and tokens[j][0] == "ws":
+                            breaks = len(tokens[j][1]) - len(tokens[j][1].lstrip("\r\n"))
+                            if breaks == len(tokens[j][1]):
+                                j += 1
+                                continue
+                            return sum(len(tokens[k][1]) for k in range(start, j)) + breaks
+                break
+            if text in (",", ")", ";"):
+                break
+            if text == "(" and j in partner:
+                j = partner[j]
+            elif kind == "kw" and up == "CASE":
+                cases += 1
+            elif kind == "kw" and up == "END" and cases:
+                cases -= 1
+            elif not cases and ends_item(kind, text):
+                break
+            if kind != "ws":
+                end = j
+            j += 1
+        return sum(len(tokens[k][1]) for k in range(start, end + 1)) if end < n else 0
+
+    def list_comma(c):
+        """Whether sqlparse groups the comma at c into an identifier list: it does not join
+        a comment, a bare parenthesis, a lone literal followed by a comment or a lone sort order"""
+        j = skip(c + 1, 1, ("ws",))
+        if token_at(j)[0] == "comment":
+            return False
+        if token_at(j)[1] == "(" and j in partner and ends_item(*token_at(skip(partner[j] + 1, 1))):
+            return False
+        j = skip(c - 1, -1, ("ws",))
+        kind, text = token_at(j)
+        if kind == "kwother" and text.split()[0].upper() in ("ASC", "DESC", "NULLS") \
+                and token_at(skip(j - 1, -1, ("ws",)))[0] == "comment":
+            return False # a comment parts the sort order from its column
+        if kind == "comment":
+            # The comment joins the item before it, unless that is a single ungrouped token
+            j = skip(j, -1)
+            kind, text = token_at(j)
+            if (kind in ("num", "string") or text == "*" or kind == "kw" and text.upper() != "END") \
+                    and ends_item(*token_at(skip(j - 1, -1))):
+                return False
+        return not (j >= 0 and bare_close(j))
+
+    i = 0
+    while i < n:
+        kind, text = tokens[i]
+        i += 1
+        if kind == "ws":
+            space = True
+            first_in_group = False
+            continue
+        if kind == "comment":
+            # sqlparse strips the whitespace after '(', and before the last comment group it merges
+            # into a bare parenthesis (comments are grouped unless only comments and line breaks follow)
+            bare = prev_i >= 0 and bare_close(prev_i) and not comments_end(i) \
+                and token_at(skip(i, 1))[1].upper() != "AS"
+            if cur and space and cur[-1] != "(" and not (bare and group_start(i - 1) and last_group(i - 1)):
+                cur.append(" ")
+            if text.startswith("/*"):
+                parts = text.split("\n")
+                for part in parts[:-1]:
+                    cur.append(part)
+                    yield "".join(cur).rstrip()
+                    cur = []
+                    line_col = 0
+                cur.append(parts[-1])
+                # A grouped comment keeps the first line break after it as a space, on top of
+                # the space the rest of the whitespace collapses to -- unless a comment follows
+                # and joins its group, which happens when it stands alone rather than in an item,
+                # or the comments after a bare parenthesis end with the next group
+                if i < n and tokens[i][0] == "ws" and tokens[i][1][0] in "\r\n" \
+                        and tokens[i][1].lstrip("\r\n") and not comments_end(i):
+                    j = skip(i, 1, ("ws",))
+                    if token_at(j)[0] != "comment" or in_item(prev_i) and not (bare and last_group(j)):
+                        cur.append(" ")
+                broke_line = False
+            else:
+                # A '--' comment keeps its line break; a break sqlparse adds after it
+                # leaves a blank line (see newline_before below)
+                cur.append(text.rstrip("\r\n"))
+                if text[-1] in "\r\n":
+                    line = "".join(cur)
+                    yield line.rstrip()
+                    cur = []
+                    broke_line = True
+                    line_back = None if line_col is None else line_col + len(line)
+                    line_col = 1 if token_at(i)[0] == "ws" else 0
+            space = False
+            first_in_group = False
+            stmt_start = False
+            prev_kind = "comment"
+            continue
+
+        newline_before = False
+        always_break = True  # False for the split keywords, which sqlparse skips right after a line break
+        break_col = None     # line_col of the line a break starts
+        ensure_space = False
+        newline_after = False
+        up = text.upper() if kind in ("kw", "kwother", "dml") else ""
+        depth = len(parens)
+        top = parens[-1] if parens else None
+
+        if kind == "punct" and text == ";":
+            cur.append(" ;" if space and cur else ";")
+            # The spaces and '--' comments after ';' stay with the statement
+            while i < n:
+                kind, text = tokens[i]
+                if kind == "ws" and "\n" not in text and "\r" not in text:
+                    space = True
+                elif kind == "comment" and not text.startswith("/*"):
+                    if cur and space:
+                        cur.append(" ")
+                    cur.append(text.rstrip("\r\n"))
+                    space = False
+                    if text[-1] in "\r\n":
+                        yield "".join(cur).rstrip()
+                        cur = []
+                else:
+                    break
+                i += 1
+            if cur:
+                yield "".join(cur).rstrip()
+                cur = []
+            if i < n:
+                yield "" # statements are separated by a blank line
+            space = False
+            line_col = 0
+            wheres = []
+            item_marks = {}
+            lists = {}
+            broke_line = True
+            stmt_start = True
+            parens = []
+            first_in_group = True
+            after_between = False
+            case_depth = 0
+            values_depth = None
+            create_table = False
+            prev_kind, prev_text, prev_i = None, "", -1
+            continue
+
+        if kind == "kw":
+            if up == "CASE":
+                case_depth += 1
+            elif case_depth and up in ("WHEN", "ELSE"):
+                newline_before = True
+            elif case_depth and up == "END":
+                newline_before = True
+                case_depth -= 1
+            elif _SPLIT_KEYWORD_RE.search(up):
+                if up == "BETWEEN":
+                    after_between = True
+                elif after_between:
+                    after_between = False
+                    newline_before = up != "AND"
+                else:
+                    newline_before = True
+                always_break = up in ("WHERE", "VALUES")
+            if values_depth == depth and up != "VALUES":
+                values_depth = None
+            if up == "VALUES":
+                values_depth = depth
+            elif up == "TABLE" and prev_text.upper().startswith("CREATE"):
+                create_table = True
+            if up == "WHERE":
+                wheres.append(depth)
+            elif wheres and wheres[-1] == depth and up.split()[0] in _WHERE_CLOSE:
+                wheres.pop()
+        if kind in ("kw", "dml") and not case_depth and up not in ("AS", "END"):
+            lists.pop(depth, None)
+
+        if kind == "dml":
+            # A new statement part, except as the first word of a subquery
+            newline_before = not first_in_group and top != "sub"
+        elif kind == "punct" and text == "(":
+            if i - 1 in dml_parens:
+                paren = "sub"
+                newline_before = True
+            elif values_depth == depth and (prev_text.upper() == "VALUES" or prev_text == ","):
+                paren = "values"
+            elif prev_kind == "name" and not create_table:
+                paren = "func"
+            else:
+                paren = "plain"
+            parens.append(paren)
+        elif kind == "punct" and text == ")":
+            if parens:
+                parens.pop()
+            lists.pop(depth, None)
+            item_marks.pop(depth, None)
+            if wheres and wheres[-1] == depth:
+                wheres.pop()
+        elif kind == "punct" and text == ",":
+            if top == "values":
+                pass # tuple contents keep their own spacing
+            elif values_depth == depth:
+                newline_before = comma_first
+                newline_after = not comma_first
+            elif top == "func":
+                ensure_space = True
+            elif not list_comma(i - 1):
+                lists.pop(depth, None)
+            else:
+                # Identifier list: one item per line, unless it starts left of its indent column
+                state = lists.get(depth)
+                if state is None:
+                    state = lists[depth] = [None, 0, 0]
+                    mark = item_marks.get(depth)
+                    if mark and mark[2] is not None:
+                        state[0] = mark[2] + sum(map(len, mark[0][:mark[1]]))
+                        state[1] = (parens.count("sub") + len(wheres)) * indent_width - state[0]
+                if state[1] > 0:
+                    state[2] += item_len(i) + 1
+                if state[2] > state[1] or state[1] <= 0:
+                    state[2] = 0
+                    newline_before = comma_first
+                    newline_after = not comma_first
+                    # sqlparse pads the comma it moves, and keeps a line break after it as a second space
+                    if comma_first:
+                        ensure_space = 2 if token_at(i)[0] == "ws" and token_at(i)[1][0] in "\r\n" else 1
+                    if state[0] is not None:
+                        break_col = max(0, state[0] - 2) if comma_first else state[0]
+
+        if convert and kind in ("kw", "kwother", "dml"):
+            text = convert(text)
+
+        if newline_before:
+            if cur:
+                yield "".join(cur).rstrip()
+                cur = []
+                line_col = break_col
+            elif broke_line and (always_break or space or stmt_start):
+                yield ""
+                line_col = break_col
+            elif line_col is not None:
+                line_col = 0 # sqlparse drops the whitespace before the keyword instead
+        elif cur and space and text not in (",", ")") and cur[-1] != "(":
+            cur.append(" ")
+
+        if prev_i < 0 or prev_text in ("(", ",") or (prev_kind == "comment" and not case_depth and up != "AS") \
+                or (token_at(prev_i)[0] in ("kw", "dml") and (up == "CASE" or not case_depth)
+                    and prev_text.upper() not in ("AS", "END")):
+            item_marks[depth] = (cur, len(cur), line_back if line_col == 0 and not cur else line_col)
+        if "\n" in text:
+            parts = text.split("\n")
+            for part in parts[:-1]:
+                cur.append(part)
+                yield "".join(cur).rstrip()
+                cur = []
+            text = parts[-1]
+            line_col = 0
+        cur.append(text)
+
+        space = False
+        broke_line = False
+        stmt_start = False
+        if newline_after:
+            yield "".join(cur).rstrip()
+            cur = []
+            broke_line = True
+            line_col = break_col
+        elif ensure_space:
+            space = True
+            if ensure_space == 2:
+                cur.append(" ")
+        first_in_group = kind == "punct" and text == "("
+        prev_kind, prev_text, prev_i = kind, tokens[i - 1][1], i - 1
+
+    last_kind, last_text = token_at(skip(n - 1, -1, ("ws",)))
+    if cur:
+        yield "".join(cur).rstrip()
+    elif last_kind == "comment" and last_text[-1] in "\r\n":
+        yield "" # the break ending a trailing '--' comment is kept
+
+def format_sql_fast(sql, settings, keyword_case="upper", comma_first=False, is_cancelled=None, indent_width=2):
+    """Reindent, case and align sql in one streaming pass (same layout as sqlparse + align_sql_keywords).
+    Returns None if is_cancelled() becomes true on the way."""
+    lines = align_lines(format_sql_lines(sql, keyword_case, comma_first, indent_width), settings)
+    if is_cancelled is None:
+        return '\n'.join(lines)
+
+    out = []
+    for n, line in enumerate(lines):
+        if n % 256 == 0 and is_cancelled():
+            return None
+        out.append(line)
+    return '\n'.join(out)
+
+# --- Line lexer for syntax highlighting ---
+_HIGHLIGHT_RE = re.compile(r"""
+    (?P<comment>--.*)
+  | (?P<block>/\*)
+  | (?P<quote>['"])
+  | (?P<number>\b\d+(?:\.\d+)?\b)
+  | (?P<word>[^\W\d]\w*)
+""", re.VERBOSE)
+_STRING_END_RE = {"'": re.compile(r"(?:''|\\.|[^'])*'"), '"': re.compile(r'(?:""|\\.|[^"])*"')}
+
+def lex_sql_line(line, state=None):
+    """Highlight spans of one line as [(tag, start, end)], plus the state the next line starts in.
+
+    state is None, "comment" (inside /* */) or the quote character of an open string.
+    """
+    spans = []
+    pos = 0
+    n = len(line)
+    if state == "comment":
+        end = line.find("*/")
+        if end < 0:
+            return [("comment", 0, n)], "comment"
+        spans.append(("comment", 0, end + 2))
+        pos = end + 2
+    elif state is not None:
+        m = _STRING_END_RE[state].match(line)
+        if m is None:
+            return [("string", 0, n)], state
+        spans.append(("string", 0, m.end()))
+        pos = m.end()
+
+    while True:
+        m = _HIGHLIGHT_RE.search(line, pos)
+        if m is None:
+            return spans, None
+        kind = m.lastgroup
+        start = m.start()
+        pos = m.end()
+        if kind == "comment":
+            spans.append(("comment", start, n))
+            return spans, None
+        if kind == "block":
+            end = line.find("*/", pos)
+            if end < 0:
+                spans.append(("comment", start, n))
+                return spans, "comment"
+            spans.append(("comment", start, end + 2))
+            pos = end + 2
+        elif kind == "quote":
+            quote = m.group()
+            m = _STRING_END_RE[quote].match(line, pos)
+            if m is None:
+                spans.append(("string", start, n))
+                return spans, quote
+            spans.append(("string", start, m.end()))
+            pos = m.end()
+        elif kind == "number":
+            spans.append(("number", start, pos))
+        elif _keyword_type(m.group()):
+            spans.append(("keyword", start, pos))
+
+class FormatCache:
+    """Thread-safe LRU of formatted SQL, keyed on the text and every option that changes the layout"""
+    def __init__(self, max_entries=AppConfig.FORMAT_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(sql, settings, keyword_case, indent_width, comma_first):
+        return (sql, keyword_case, indent_width, comma_first,
+                settings.get("sql_indent_width", 2), settings.get("sql_compact_select", False))
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+format_cache = FormatCache()
+
+def format_sql(sql, settings, keyword_case="upper", indent_width=2, comma_first=False, is_cancelled=None):
+    """Format and align a query; large ones skip sqlparse's parse tree.
+    Results are memoized; returns None if cancelled through is_cancelled()."""
+    key = FormatCache.make_key(sql, settings, keyword_case, indent_width, comma_first)
+    formatted = format_cache.get(key)
+    if formatted is not None:
+        return formatted
+
+    import sqlparse
+
+    if len(sql) < AppConfig.SQL_FAST_FORMAT_CHARS:
+        try:
+            formatted = sqlparse.format(sql, reindent=True, keyword_case=keyword_case,
+                                        indent_width=indent_width, comma_first=comma_first)
+            formatted = align_sql_keywords(formatted, settings)
+        except sqlparse.exceptions.SQLParseError:
+            pass # too many tokens for sqlparse's grouping
+    if formatted is None:
+        formatted = format_sql_fast(sql, settings, keyword_case, comma_first, is_cancelled, indent_width)
+        if formatted is None:
+            return None
+
+    format_cache.put(key, formatted)
+    return formatted
+
+def _placeholder_group_end(tokens, i):
+    """Index just past a "( ? , ? ... )" group starting at tokens[i], or None"""
+    if i >= len(tokens) or tokens[i] != "(":
+        return None
+    j = i + 1
+    while j + 1 < len(tokens) and tokens[j] == "?":
+        if tokens[j + 1] == ")":
+            return j + 2
+        if tokens[j + 1] != ",":
+            break
+        j += 2
+    return None
+
+def normalize_query(sql):
+    """The query as pg_stat_statements / pt-fingerprint would group it.
+
+    Literals and bind parameters become ?, IN lists and multi-row VALUES
+    collapse to (?+), comments are dropped (optimizer hints are kept),
+    keywords are upper-cased, unquoted names lower-cased and tokens are
+    separated by single spaces. Words are classified with sqlparse's keyword
+    tables through tokenize_sql, which is several times faster than the
+    sqlparse lexer.
+    """
+    raw = tokenize_sql(sql)
+    tokens = []
+    operand = False # the previous token ends an expression, so a "-" that follows is a subtraction
+    i, n = 0, len(raw)
+    while i < n:
+        kind, text = raw[i]
+        i += 1
+        next_kind, next_text = raw[i] if i < n else ("", "")
+        if kind == "ws" or (kind == "comment" and not text.startswith("/*+")):
+            continue
+        literal = kind == "num" or text == "?" or (kind == "string" and text[0] == "'")
+        if text == "." and next_kind == "num" and not operand: # .5
+            literal, i = True, i + 1
+        elif text in (":", "$", "%") and next_kind in ("name", "num", "kw", "kwother", "dml") \
+                and (text != "%" or next_text == "s"): # :name, $1, %s
+            literal, i = True, i + 1
+        elif text == "-" and next_kind == "num" and not operand: # the sign of the number that follows
+            continue
+        if literal:
+            if kind == "num" and next_text == "." and i + 1 < n and raw[i + 1][0] == "num": # 1.5
+                i += 2
+            tokens.append("?")
+            operand = True
+            continue
+        if kind in ("kw", "kwother", "dml", "cmp"):
+            text = " ".join(text.split()).upper() # "group\n  by" -> "GROUP BY"
+        elif kind == "name":
+            text = text.lower()
+        elif kind == "comment": # optimizer hint
+            text = " ".join(text.split())
+        tokens.append(text) # "quoted" identifiers keep their case
+        operand = kind in ("name", "string") or text == ")"
+    while tokens and tokens[-1] == ";":
+        tokens.pop()
+
+    collapsed = []
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        collapsed.append(token)
+        i += 1
+        if token in ("IN", "VALUES"):
+            end = _placeholder_group_end(tokens, i)
+            while token == "VALUES" and end is not None and end < len(tokens) and tokens[end] == ",":
+                following = _placeholder_group_end(tokens, end + 1)
+                if following is None:
+                    break
+                end = following
+            if end is not None:
+                collapsed.append("(?+)")
+                i = end
+
+    parts = []
+    for token in collapsed:
+        if parts and token not in (",", ")", ".", "::") and parts[-1] not in ("(", ".", "::") \
+                and not (token == "(" and not parts[-1].isupper()): # function calls stay "count(*)"
+            parts.append(" ")
+        parts.append(token)
+    return "".join(parts)
+
+def query_fingerprint(sql):
+    """Stable 16-hex-digit hash of normalize_query(sql); None for an empty query"""
+    normalized = normalize_query(sql) if sql and sql.strip() else ""
+    if not normalized:
+        return None
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()[:16]
+
+def parse_json_content(raw_content):
+    try:
+        return json.loads(raw_content)
+    except json.JSONDecodeError:
+        import re
+        json_match = re.search(r'(\{.*\})', raw_content, re.DOTALL)
+        if json_match:
+            return json.loads(json_match.group(1))
+        raise ValueError("Could not parse AI response as JSON")
+
+# Where each API puts the text of a stream chunk, keyed by the field that identifies the API
+STREAM_TOKEN_READERS = {
+    "choices": lambda chunk: ((chunk.get("choices") or [{}])[0].get("delta") or {}).get("content") or "", # OpenAI-compatible
+    "message": lambda chunk: (chunk.get("message") or {}).get("content") or "", # Native Ollama /api/chat
+    "response": lambda chunk: chunk.get("response") or "", # Ollama /api/generate
+}
+
+def stream_token_reader(json_chunk):
+    """The STREAM_TOKEN_READERS entry for this stream, or None if the chunk does not tell (e.g. an error)"""
+    for key, reader in STREAM_TOKEN_READERS.items():
+        if key in json_chunk:
+            return reader
+    return None
+
+def json_decoder():
+    """orjson.loads when the optional orjson package is installed, else json.loads (both accept bytes)"""
+    try:
+        import orjson
+        return orjson.loads
+    except ImportError:
+        return json.loads
+
+def extract_usage(json_chunk):
+    """(prompt tokens, completion tokens, generation seconds or None) from an answer
+    or its last stream chunk; None when the server did not report them"""
+    usage = json_chunk.get("usage")
+    if isinstance(usage, dict) and usage.get("completion_tokens") is not None:
+        return usage.get("prompt_tokens"), usage["completion_tokens"], None
+    if json_chunk.get("eval_count") is not None: # Native Ollama
+        duration = json_chunk.get("eval_duration")
+        return json_chunk.get("prompt_eval_count"), json_chunk["eval_count"], duration / 1e9 if duration else None
+    return None
+
+class StreamEventParser:
+    """Incrementally splits a streamed answer into its JSON objects.
+
+    feed() takes raw byte chunks, split anywhere (even inside a line ending or
+    a UTF-8 sequence), and returns the objects they complete; close() returns
+    what was left when the stream ended. The format is detected from the first
+    line: Server-Sent Events ("data:" lines joined up to the blank line ending
+    the event, "event:" names, ":" keep-alive comments, "[DONE]") or one JSON
+    object per line (native Ollama). Frames that are not JSON objects are
+    counted in `malformed` instead of being raised.
+    """
+    def __init__(self, loads=None):
+        self.loads = loads or json_decoder()
+        self.format = None # "sse" or "ndjson"
+        self.done = False # [DONE] seen; anything after it is ignored
+        self.malformed = 0
+        self.comments = 0
+        self._buffer = b""
+        self._data = []
+        self._event = None
+
+    def feed(self, chunk):
+        objects = []
+        if self.done or not chunk:
+            return objects
+        lines = (self._buffer + chunk).split(b"\n")
+        self._buffer = lines.pop() # incomplete line
+        for line in lines:
+            self._line(line, objects)
+            if self.done:
+                break
+        return objects
+
+    def close(self):
+        objects = []
+        if not self.done:
+            if self._buffer:
+                self._line(self._buffer, objects)
+            self._dispatch(objects) # the last event may lack its blank line
+        self._buffer = b""
+        return objects
+
+    def _line(self, line, objects):
+        if line.endswith(b"\r"):
+            line = line[:-1]
+        if self.format is None:
+            if not line.strip():
+                return
+            self.format = "ndjson" if line.lstrip().startswith(b"{") else "sse"
+        if self.format == "ndjson":
+            if line.strip():
+                self._decode(line, objects)
+        elif not line:
+            self._dispatch(objects)
+        elif line.startswith(b":"):
+            self.comments += 1
+        elif line.startswith(b"{"): # a bare JSON line in an SSE stream
+            self._decode(line, objects)
+        else:
+            name, _, value = line.partition(b":")
+            if value.startswith(b" "):
+                value = value[1:]
+            if name == b"data":
+                self._data.append(value)
+            elif name == b"event":
+                self._event = value.decode("utf-8", "replace")
+            # "id" and "retry" only matter for reconnecting; unknown fields are ignored (as the spec says)
+
+    def _dispatch(self, objects):
+        data, self._data = self._data, []
+        event, self._event = self._event, None
+        if not data:
+            return
+        if len(data) == 1 and data[0].strip() == b"[DONE]":
+            self.done = True
+            return
+        found = len(objects)
+        if not self._decode(b"\n".join(data), objects, count=len(data) == 1) and len(data) > 1:
+            # Not one multi-line object: servers that omit the blank lines send one object per data line
+            for line in data:
+                if line.strip() != b"[DONE]":
+                    self._decode(line, objects)
+        if event == "error":
+            objects[found:] = [obj if "error" in obj else {"error": obj} for obj in objects[found:]]
+
+    def _decode(self, data, objects, count=True):
+        try:
+            obj = self.loads(data)
+        except ValueError: # json.JSONDecodeError and orjson.JSONDecodeError both subclass it
+            obj = None
+        if not isinstance(obj, dict):
+            self.malformed += count
+            return False
+        objects.append(obj)
+        return True
+
+class JSONFieldStreamParser:
+    """Incrementally decodes the top-level string fields of a JSON object as it streams in.
+
+    feed() takes raw text chunks (any split, even inside escapes) and returns the
+    newly decoded text per field, so partial values can be shown before the
+    document is complete. Non-string values (e.g. index lists) are skipped;
+    they are only available from the final parse.
+    """
+    _ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+    def __init__(self, fields=("optimized_query", "indices", "explanation")):
+        self.fields = set(fields)
+        self._parts = {} # field -> decoded pieces, joined by `values`
+        self.state = "start"
+        self._key = []
+        self._field = None
+        self._escape = ""
+        self._high_surrogate = None
+        self._nest = 0
+        self._nest_in_str = False
+        self._nest_escape = False
+
+    @property
+    def values(self):
+        """The text decoded so far per field"""
+        return {field: "".join(parts) for field, parts in self._parts.items()}
+
+    def feed(self, chunk):
+        updates = {}
+        i, n = 0, len(chunk)
+        while i < n:
+            state = self.state
+            if state == "str_value":
+                i = self._read_string(chunk, i, updates)
+                continue
+
+            c = chunk[i]
+            i += 1
+            if state == "start":
+                if c == "{":
+                    self.state = "expect_key"
+            elif state == "expect_key":
+                if c == '"':
+                    self._key = []
+                    self.state = "key"
+                elif c == "}":
+                    self.state = "done"
+            elif state == "key":
+                if self._escape:
+                    self._key.append(c)
+                    self._escape = ""
+                elif c == "\\":
+                    self._escape = c
+                elif c == '"':
+                    self.state = "colon"
+                else:
+                    self._key.append(c)
+            elif state == "colon":
+                if c == ":":
+                    self.state = "value"
+            elif state == "value":
+                if c in " \t\r\n":
+                    continue
+                key = "".join(self._key)
+                if c == '"':
+                    self._field = key if key in self.fields else None
+                    if self._field is not None:
+                        self._parts[self._field] = []
+                    self.state = "str_value"
+                elif c in "{[":
+                    self._nest = 1
+                    self._nest_in_str = False
+                    self._nest_escape = False
+                    self.state = "nested"
+                else:
+                    self.state = "scalar"
+            elif state == "nested":
+                if self._nest_in_str:
+                    if self._nest_escape:
+                        self._nest_escape = False
+                    elif c == "\\":
+                        self._nest_escape = True
+                    elif c == '"':
+                        self._nest_in_str = False
+                elif c == '"':
+                    self._nest_in_str = True
+                elif c in "{[":
+                    self._nest += 1
+                elif c in "}]":
+                    self._nest -= 1
+                    if self._nest == 0:
+                        self.state = "after_value"
+            elif state in ("scalar", "after_value"):
+                if c == ",":
+                    self.state = "expect_key"
+                elif c == "}":
+                    self.state = "done"
+            elif state == "done":
+                break
+        return updates
+
+    def _read_string(self, chunk, i, updates):
+        out = []
+        n = len(chunk)
+        while i < n:
+            if self._escape:
+                self._escape += chunk[i]
+                i += 1
+                esc = self._escape
+                if esc[1] == "u":
+                    if len(esc) < 6:
+                        continue
+                    code = int(esc[2:], 16)
+                    self._escape = ""
+                    if 0xD800 <= code < 0xDC00:
+                        self._high_surrogate = code
+                        continue
+                    if 0xDC00 <= code < 0xE000 and self._high_surrogate is not None:
+                        code = 0x10000 + ((self._high_surrogate - 0xD800) << 10) + (code - 0xDC00)
+                    self._high_surrogate = None
+                    out.append(chr(code))
+                else:
+                    self._escape = ""
+                    out.append(self._ESCAPES.get(esc[1], esc[1]))
+                continue
+
+            # Copy plain runs in one slice up to the next quote or backslash
+            quote = chunk.find('"', i)
+            backslash = chunk.find("\\", i)
+            stop = min(p for p in (quote, backslash, n) if p >= 0)
+            if stop > i:
+                out.append(chunk[i:stop])
+                i = stop
+            if i >= n:
+                break
+            if chunk[i] == "\\":
+                self._escape = "\\"
+                i += 1
+            else:
+                i += 1
+                self.state = "after_value"
+                break
+
+        if out and self._field is not None:
+            text = "".join(out)
+            self._parts[self._field].append(text)
+            updates[self._field] = updates.get(self._field, "") + text
+        return i
+
+def indices_to_sql(raw_indices):
+    """Index suggestions as SQL (handle both string and structured JSON)"""
+    def dict_to_sql(d):
+        table = d.get('table', 'table_name')
+        idx_name = d.get('index_name', f"idx_{table}_{''.join(filter(str.isalnum, str(d.get('columns',[''])[0])))[:10]}")
+        cols = d.get('columns', [])
+        if isinstance(cols, list):
+            cols_str = ", ".join(cols)
+        else:
+            cols_str = str(cols)
+        return f"CREATE INDEX {idx_name} ON {table} ({cols_str});"
+
+    if isinstance(raw_indices, list):
+        statements = []
+        for item in raw_indices:
+            if isinstance(item, dict):
+                statements.append(dict_to_sql(item))
+            else:
+                statements.append(str(item))
+        sql_indices = "\n".join(statements)
+    elif isinstance(raw_indices, dict):
+        sql_indices = dict_to_sql(raw_indices)
+    else:
+        sql_indices = str(raw_indices)
+
+    # Final Cleanup: remove empty lines and isolated ";"
+    clean_lines = [line.strip() for line in sql_indices.split('\n') if line.strip() and line.strip() != ';']
+    return "\n".join(clean_lines)
+
+def format_optimize_result(content, settings, is_cancelled=None):
+    """Turn the parsed AI JSON into the three displayable/savable texts"""
+    import sqlparse
+    # 1. Optimized Query
+    raw_sql = content.get("optimized_query", "")
+    try:
+        formatted_sql = format_sql(raw_sql, settings, is_cancelled=is_cancelled)
+    except Exception:
+        formatted_sql = None
+    if formatted_sql is None:
+        formatted_sql = raw_sql
+
+    # 2. Index Suggestions
+    sql_indices = indices_to_sql(content.get("indices", ""))
+    try:
+        formatted_indices = sqlparse.format(sql_indices, reindent=True, keyword_case='upper')
+    except Exception:
+        formatted_indices = sql_indices
+
+    # 3. Explanation
+    expl = content.get("explanation", "No explanation provided")
+    return formatted_sql, formatted_indices, expl
+
+# --- Schema catalog ---
+_CREATE_TABLE_RE = re.compile(
+    r"CREATE\s+(?:OR\s+REPLACE\s+)?(?:(?:GLOBAL|LOCAL)\s+)?(?:TEMP(?:ORARY)?\s+|UNLOGGED\s+)?TABLE\s+"
+    r"(?:IF\s+NOT\s+EXISTS\s+)?(?P<name>[^\s(]+)\s*\((?P<body>.*)\)", re.IGNORECASE | re.DOTALL)
+_CREATE_INDEX_RE = re.compile(
+    r"CREATE\s+(?:UNIQUE\s+)?(?:CLUSTERED\s+|NONCLUSTERED\s+)?INDEX\s+(?:CONCURRENTLY\s+)?(?:IF\s+NOT\s+EXISTS\s+)?"
+    r"(?:[^\s(]+\s+)?ON\s+(?:ONLY\s+)?(?P<table>[^\s(]+)", re.IGNORECASE | re.DOTALL)
+_ALTER_TABLE_RE = re.compile(
+    r"ALTER\s+TABLE\s+(?:ONLY\s+)?(?:IF\s+EXISTS\s+)?(?P<table>[^\s(]+)\s+ADD\s+"
+    r"(?P<item>(?:CONSTRAINT|PRIMARY|FOREIGN|UNIQUE|CHECK)\b.*)", re.IGNORECASE | re.DOTALL)
+_CONSTRAINT_ITEM_RE = re.compile(r"(?:CONSTRAINT|PRIMARY\s+KEY|FOREIGN\s+KEY|UNIQUE|CHECK|EXCLUDE)\b", re.IGNORECASE)
+_INDEX_ITEM_RE = re.compile(r"(?:UNIQUE\s+)?(?:KEY|INDEX|FULLTEXT|SPATIAL)\b", re.IGNORECASE)
+# Column details that cost tokens without helping the model optimize a query
+_COLUMN_NOISE_RE = re.compile(
+    r"\s+(?:COMMENT\s+'(?:''|[^'])*'|COLLATE\s+\S+|CHARACTER\s+SET\s+\S+|CHARSET\s+\S+|DEFAULT\s+NULL\b)", re.IGNORECASE)
+
+def _split_top_level(body):
+    """Split a CREATE TABLE body on the commas outside parentheses and quotes"""
+    items = []
+    depth = 0
+    quote = None
+    start = 0
+    for i, ch in enumerate(body):
+        if quote:
+            if ch == quote:
+                quote = None
+        elif ch in "'\"`":
+            quote = ch
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == "," and depth == 0:
+            items.append(body[start:i].strip())
+            start = i + 1
+    items.append(body[start:].strip())
+    return [item for item in items if item]
+
+def _unquote_name(name):
+    return ".".join(part.strip('"`[]') for part in name.split(".")).lower()
+
+class SchemaCatalog:
+    """Index of table definitions from DDL files, used to inject only the relevant schema into prompts.
+
+    Files are parsed once; the index is saved to SCHEMA_INDEX_FILE and a file
+    is parsed again only when its mtime or size changes.
+    """
+    def __init__(self, paths=(), index_path=None):
+        self.index_path = index_path or AppConfig.SCHEMA_INDEX_FILE
+        self.paths = []
+        self.tables = {}     # qualified lowercase name -> table entry
+        self.by_name = {}    # unqualified lowercase name -> qualified names
+        self.schemas = set() # schema prefixes seen in table names
+        self._files = {}     # path -> {"mtime", "size", "tables"}
+        self._lock = threading.Lock()
+        self._checked_at = 0
+        if paths:
+            self.load(paths)
+
+    def load(self, paths):
+        """(Re)index the given .sql files and directories"""
+        with self._lock:
+            self.paths = list(paths)
+            if not self._files:
+                self._files = self._read_index()
+            self._refresh()
+
+    def refresh(self):
+        """Pick up added, changed or removed files (at most every SCHEMA_REFRESH_SECONDS)"""
+        if time.time() - self._checked_at < AppConfig.SCHEMA_REFRESH_SECONDS:
+            return
+        with self._lock:
+            self._refresh()
+
+    def _sql_files(self):
+        for path in self.paths:
+            path = os.path.abspath(os.path.expanduser(path))
+            if os.path.isdir(path):
+                for root, _dirs, files in os.walk(path):
+                    for name in sorted(files):
+                        if name.lower().endswith(".sql"):
+                            yield os.path.join(root, name)
+            elif os.path.isfile(path):
+                yield path
+
+    def _refresh(self):
+        self._checked_at = time.time()
+        files = {}
+        changed = False
+        for path in self._sql_files():
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entry = self._files.get(path)
+            if entry is None or entry["mtime"] != st.st_mtime or entry["size"] != st.st_size:
+                try:
+                    with open(path, 'r', encoding='utf-8', errors='replace') as f:
+                        tables = self.parse_ddl(f.read())
+                except OSError as e:
+                    print(f"Could not read schema file {path}: {e}")
+                    continue
+                entry = {"mtime": st.st_mtime, "size": st.st_size, "tables": tables}
+                changed = True
+            files[path] = entry
+        changed = changed or set(files) != set(self._files)
+
+        tables = {}
+        by_name = {}
+        for entry in files.values():
+            for key, table in entry["tables"].items():
+                tables[key] = table
+                by_name.setdefault(key.rsplit(".", 1)[-1], []).append(key)
+        self._files = files
+        self.tables, self.by_name = tables, by_name
+        self.schemas = {key.rsplit(".", 1)[0] for key in tables if "." in key}
+        # Keep the entries of other path sets in the saved index as well
+        if changed:
+            saved = self._read_index()
+            saved.update(files)
+            self._write_index(saved)
+
+    def _read_index(self):
+        try:
+            with open(self.index_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            return data.get("files", {}) if data.get("version") == 1 else {}
+        except (OSError, ValueError):
+            return {}
+
+    def _write_index(self, files):
+        try:
+            with open(self.index_path, 'w', encoding='utf-8') as f:
+                json.dump({"version": 1, "files": files}, f)
+        except OSError as e:
+            print(f"Could not save schema index: {e}")
+
+    @staticmethod
+    def parse_ddl(text):
+        """Map each table to its columns, constraints and indexes"""
+        tables = {}
+
+        def table_for(name):
+            key = _unquote_name(name)
+            return tables.setdefault(key, {"name": name, "columns": [], "constraints": [], "indexes": []})
+
+        # One statement per ';' (comments are dropped by the tokenizer pass)
+        statements = []
+        current = []
+        for kind, text_ in tokenize_sql(text):
+            if kind == "comment":
+                continue
+            if kind == "punct" and text_ == ";":
+                statements.append(" ".join("".join(current).split()))
+                current = []
+            else:
+                current.append(" " if kind == "ws" else text_)
+        statements.append(" ".join("".join(current).split()))
+
+        for stmt in statements:
+            m = _CREATE_TABLE_RE.match(stmt)
+            if m:
+                table = table_for(m.group("name"))
+                for item in _split_top_level(m.group("body")):
+                    if _CONSTRAINT_ITEM_RE.match(item):
+                        table["constraints"].append(item)
+                    elif _INDEX_ITEM_RE.match(item):
+                        table["indexes"].append(item)
+                    else:
+                        table["columns"].append(_COLUMN_NOISE_RE.sub("", item))
+                continue
+            m = _CREATE_INDEX_RE.match(stmt)
+            if m:
+                table_for(m.group("table"))["indexes"].append(stmt)
+                continue
+            m = _ALTER_TABLE_RE.match(stmt)
+            if m:
+                table_for(m.group("table"))["constraints"].append(m.group("item"))
+        return tables
+
+    def referenced_tables(self, query):
+        """Catalog tables named in query, in order of first appearance"""
+        found = []
+        chain = []
+
+        def resolve():
+            if not chain:
+                return
+            names = [_unquote_name(part) for part in chain]
+            if len(names) == 1:
+                candidates = self.by_name.get(names[0], [])
+            else:
+                # schema.table, schema.table.column, table.column
+                candidates = [".".join(names[-2:]), ".".join(names[-3:-1])] + self.by_name.get(names[-2], [])
+                if names[-2] in self.schemas:
+                    candidates += self.by_name.get(names[-1], []) # schema given, table indexed without it
+            for key in candidates:
+                if key in self.tables and key not in found:
+                    found.append(key)
+                    break
+            chain.clear()
+
+        prev = None
+        for kind, text in tokenize_sql(query):
+            if kind in ("ws", "comment"):
+                continue
+            if kind in ("name", "kw", "kwother") or (kind == "string" and text[0] in '"`'):
+                if prev != ".":
+                    resolve()
+                chain.append(text)
+            elif text != ".":
+                resolve()
+            prev = text
+        resolve()
+        return found
+
+    def table_ddl(self, key):
+        """Condensed CREATE TABLE (plus its indexes) for one table"""
+        table = self.tables[key]
+        # Inline KEY/INDEX items stay in the table body, CREATE INDEX statements follow it
+        inline = [index for index in table["indexes"] if not index[:6].upper() == "CREATE"]
+        body = ", ".join(table["columns"] + table["constraints"] + inline)
+        lines = [f"CREATE TABLE {table['name']} ({body});"]
+        lines.extend(f"{index};" for index in table["indexes"] if index[:6].upper() == "CREATE")
+        return "\n".join(lines)
+
+    @staticmethod
+    def estimate_tokens(text):
+        # Roughly four characters per token for SQL and English
+        return (len(text) + 3) // 4
+
+    def schema_context(self, query, budget=AppConfig.SCHEMA_TOKEN_BUDGET):
+        """DDL of the tables the query references, within a token budget"""
+        self.refresh()
+        parts = []
+        omitted = []
+        used = 0
+        for key in self.referenced_tables(query):
+            ddl = self.table_ddl(key)
+            cost = self.estimate_tokens(ddl)
+            if used + cost > budget:
+                omitted.append(self.tables[key]["name"])
+                continue
+            parts.append(ddl)
+            used += cost
+        if omitted:
+            parts.append(f"-- Not included (schema token budget): {', '.join(omitted)}")
+        return "\n".join(parts)
+
+class OpenAIBackend:
+    """The /v1/chat/completions API, spoken by OpenAI, Ollama, LM Studio, vLLM and most gateways.
+
+    A backend turns the configured URL into the endpoint it posts to and builds
+    the request body; answers of every backend are read by QueryOptimizer.
+    """
+    name = "openai"
+
+    def __init__(self, settings):
+        self.settings = settings
+
+    def endpoint(self, url):
+        return url
+
+    def payload(self, model, messages, stream, json_mode=False):
+        payload = {
+            "model": model,
+            "messages": messages,
+            "stream": stream,
+            "temperature": float(self.settings.get("temperature", AppConfig.AI_TEMPERATURE))
+        }
+        max_tokens = int(self.settings.get("max_tokens", AppConfig.AI_MAX_TOKENS))
+        if max_tokens > 0:
+            payload["max_tokens"] = max_tokens
+        if stream and self.settings.get("stream_usage", AppConfig.STREAM_USAGE):
+            payload["stream_options"] = {"include_usage": True} # token counts in the last chunk
+        if json_mode:
+            payload["response_format"] = {"type": "json_object"}
+        return payload
+
+class OllamaBackend(OpenAIBackend):
+    """Ollama's native /api/chat, which takes the runtime options the compatibility API ignores:
+    the context window (num_ctx) sizes the KV cache, so it drives RAM use and speed."""
+    name = "ollama"
+
+    def endpoint(self, url):
+        return ModelWarmer.ollama_base(url) + "/api/chat"
+
+    def payload(self, model, messages, stream, json_mode=False):
+        s = self.settings
+        options = {"temperature": float(s.get("temperature", AppConfig.AI_TEMPERATURE))}
+        # 0 / -1 leave the choice to Ollama (the model's defaults)
+        for key, default, minimum in (("ctx_size", AppConfig.AI_CTX_SIZE, 1),
+                                      ("max_tokens", AppConfig.AI_MAX_TOKENS, 1),
+                                      ("num_thread", AppConfig.AI_NUM_THREAD, 1),
+                                      ("num_gpu", AppConfig.AI_NUM_GPU, 0)):
+            value = int(s.get(key, default))
+            if value >= minimum:
+                options[{"ctx_size": "num_ctx", "max_tokens": "num_predict"}.get(key, key)] = value
+        payload = {
+            "model": model,
+            "messages": messages,
+            "stream": stream,
+            "options": options,
+            "keep_alive": ModelWarmer.keep_alive_value(s.get("keep_alive", AppConfig.OLLAMA_KEEP_ALIVE))
+        }
+        if json_mode:
+            payload["format"] = "json"
+        return payload
+
+CHAT_BACKENDS = {"openai": OpenAIBackend, "ollama": OllamaBackend}
+
+def chat_backend(settings, url=None):
+    """The backend for the configured endpoint. In "auto" mode Ollama's own port and
+    /api/ URLs use the native API, everything else the OpenAI-compatible one."""
+    name = settings.get("api_backend", AppConfig.API_BACKEND)
+    if name not in CHAT_BACKENDS:
+        from urllib.parse import urlsplit
+        parts = urlsplit(url or settings.get("ollama_url", AppConfig.OLLAMA_URL))
+        try:
+            port = parts.port
+        except ValueError:
+            port = None
+        name = "ollama" if parts.path.startswith("/api/") or port == AppConfig.OLLAMA_PORT else "openai"
+    return CHAT_BACKENDS[name](settings)
+
+class QueryOptimizer:
+    """Builds the AI request for a query, sends it and parses the answer"""
+    def __init__(self, settings, response_cache=None, http_pool=None, schema_catalog=None, endpoint_pool=None):
+        self.settings = settings
+        self.response_cache = response_cache
+        self.http_pool = http_pool or HttpSessionPool.from_settings(settings)
+        self.schema_catalog = schema_catalog
+        self.endpoint_pool = endpoint_pool
+
+    def with_schema(self, query, context):
+        """Prepend the DDL of the referenced tables to the user's context"""
+        if self.schema_catalog is None or not self.settings.get("schema_auto_inject", AppConfig.SCHEMA_AUTO_INJECT):
+            return context
+        try:
+            schema = self.schema_catalog.schema_context(
+                query, int(self.settings.get("schema_token_budget", AppConfig.SCHEMA_TOKEN_BUDGET)))
+        except Exception as e:
+            print(f"Schema lookup failed: {e}")
+            return context
+        if not schema:
+            return context
+        return f"{schema}\n\n{context}" if context else schema
+
+    def build_request(self, mode, query, context, db_type, model):
+        url = self.settings.get("ollama_url", AppConfig.OLLAMA_URL)
+        api_key = self.settings.get("api_key", "")
+        backend = chat_backend(self.settings, url)
+        context = self.with_schema(query, context)
+
+        # Build Headers
+        headers = {"Content-Type": "application/json"}
+        if api_key:
+            headers["Authorization"] = f"Bearer {api_key}"
+
+        # Build Prompt based on mode
+        if mode == "optimize":
+            system_prompt = f"You are an expert {db_type} DBA. Optimize the query and return a valid JSON."
+            user_content = f"""Input Query: {query}\nContext: {context}\n\nReturn a JSON object with exactly these keys:
+- "optimized_query": the optimized SQL string.
+- "indices": a string containing one or more SQL CREATE INDEX statements (or an empty string if none needed).
+- "explanation": a string with your reasoning."""
+            stream = bool(self.settings.get("stream_optimize", AppConfig.STREAM_OPTIMIZE))
+        else:
+            system_prompt_template = self.settings.get("system_prompt_chat", AppConfig.DEFAULT_SYSTEM_PROMPT_CHAT)
+            system_prompt = system_prompt_template.replace("{db_type}", db_type)
+            user_content = f"Input Query: {query}\nContext: {context}"
+            stream = True
 
-class HistoryManager:
-    def __init__(self):
-        self.db_path = os.path.expanduser("~/.querytune_history.db")
-        self.init_db()
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_content}
+        ]
+        payload = backend.payload(model, messages, stream, json_mode=(mode == "optimize"))
+        return backend.endpoint(url), headers, payload
 
-    def init_db(self):
+    def run(self, mode, query, context, db_type, model, use_cache=False, on_token=None, on_field=None,
+            is_cancelled=None, cancel_token=None, store_cache=None):
+        """Execute one request. Returns a dict with the raw answer text, the parsed
+        JSON content (optimize mode), and whether it came from the cache or was cancelled.
+
+        use_cache answers from the response cache when it can; store_cache (default:
+        use_cache) saves a fresh answer there, so bypassing the lookup refreshes the entry.
+
+        Chat tokens are passed to on_token(text); streamed Optimize answers are
+        decoded field by field and passed to on_field(field, text). Cancelling
+        cancel_token aborts the HTTP exchange immediately."""
+        cancel_token = cancel_token or CancelToken()
+        check = is_cancelled or (lambda: False)
+        is_cancelled = lambda: cancel_token.cancelled or check()
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute("""
-                    CREATE TABLE IF NOT EXISTS history (
-                        id INTEGER PRIMARY KEY AUTOINCREMENT,
-                        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                        request_mode TEXT,
-                        db_type TEXT,
-                        model TEXT,
-                        query_input TEXT,
-                        context_input TEXT,
-                        result_sql TEXT,
-                        result_indices TEXT,
-                        result_explanation TEXT
-                    )
-                """)
-        except Exception as e:
-            print(f"Database error: {e}")
+            return self._run(mode, query, context, db_type, model, use_cache,
+                             use_cache if store_cache is None else store_cache, on_token, on_field,
+                             is_cancelled, cancel_token)
+        except Exception:
+            if is_cancelled():
+                return {"mode": mode, "text": "", "content": None, "from_cache": False, "cancelled": True}
+            raise
+        finally:
+            cancel_token.release()
+
+    def _run(self, mode, query, context, db_type, model, use_cache, store_cache, on_token, on_field, is_cancelled,
+             cancel_token):
+        timeout = int(self.settings.get("timeout", AppConfig.TIMEOUT))
+        url, headers, payload = self.build_request(mode, query, context, db_type, model)
+        result = {"mode": mode, "url": url, "text": "", "content": None, "from_cache": False, "cancelled": False}
+
+        cache_key = None
+        if (use_cache or store_cache) and self.response_cache is not None:
+            cache_key = ResponseCache.make_key(url, payload)
+            cached = self.response_cache.get(cache_key) if use_cache else None
+            if cached is not None:
+                result["text"] = cached
+                result["from_cache"] = True
+                if mode == "explain":
+                    if on_token:
+                        on_token(cached)
+                else:
+                    result["content"] = parse_json_content(cached)
+                return result
 
-    def save(self, mode, db_type, model, query, context, res_sql="", res_idx="", res_expl=""):
+        # Always read the body as a stream so a cancel can close it mid-transfer
+        start = time.time()
+        served_url = None
+        attempts = {}
+        if self.endpoint_pool is not None and len(self.endpoint_pool) > 1:
+            served_url, response = self.endpoint_pool.post(
+                timeout,
+                cancel_token,
+                hedge=bool(self.settings.get("hedge_requests", AppConfig.HEDGE_REQUESTS)),
+                endpoint=chat_backend(self.settings).endpoint,
+                info=attempts,
+                json=payload,
+                headers=headers,
+                stream=True
+            )
+            result["url"] = served_url
+        else:
+            response = self.http_pool.post(
+                url,
+                timeout,
+                cancel_token=cancel_token,
+                json=payload,
+                headers=headers,
+                stream=True
+            )
+        result["telemetry"] = {
+            "endpoint": result["url"], "http_status": response.status_code,
+            "retries": attempts.get("attempts", 1) - 1, "ttfb_s": round(time.time() - start, 3),
+            "first_token_s": None, "total_s": None, "prompt_tokens": None, "completion_tokens": None,
+            "tokens_per_s": None
+        }
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute("""
-                    INSERT INTO history (request_mode, db_type, model, query_input, context_input, 
-                                       result_sql, result_indices, result_explanation)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """, (mode, db_type, model, query, context, res_sql, res_idx, res_expl))
-        except Exception as e:
-            print(f"Failed to save history: {e}")
+            self._read_response(mode, model, response, payload, result, cache_key, on_token, on_field, is_cancelled, start)
+        finally:
+            if served_url is not None:
+                self.endpoint_pool.end(served_url)
+        self._finish_telemetry(result["telemetry"], start, payload, result["text"])
+        return result
+
+    @staticmethod
+    def _record_usage(result, json_chunk):
+        usage = extract_usage(json_chunk)
+        if usage is not None:
+            prompt_tokens, completion_tokens, eval_s = usage
+            result["telemetry"].update(prompt_tokens=prompt_tokens, completion_tokens=completion_tokens, eval_s=eval_s)
+
+    @staticmethod
+    def _finish_telemetry(telemetry, start, payload=None, text=""):
+        telemetry["total_s"] = round(time.time() - start, 3)
+        # Servers that report no usage: estimate the counts from the texts
+        if telemetry["completion_tokens"] is None and text:
+            telemetry["completion_tokens"] = SchemaCatalog.estimate_tokens(text)
+        if telemetry["prompt_tokens"] is None and payload:
+            telemetry["prompt_tokens"] = sum(SchemaCatalog.estimate_tokens(m.get("content") or "")
+                                             for m in payload.get("messages", []))
+        if telemetry["first_token_s"] is None: # not streamed: the answer arrives at once
+            telemetry["first_token_s"] = telemetry["total_s"]
+        # Generation speed: Ollama's own timing, else the time spent streaming tokens
+        generation_s = telemetry.pop("eval_s", None) or (telemetry["total_s"] - telemetry["first_token_s"])
+        if generation_s <= 0:
+            generation_s = telemetry["total_s"]
+        if telemetry["completion_tokens"] and generation_s > 0:
+            telemetry["tokens_per_s"] = round(telemetry["completion_tokens"] / generation_s, 1)
+
+    def _read_response(self, mode, model, response, payload, result, cache_key, on_token, on_field, is_cancelled, start):
+        response.raise_for_status()
+
+        field_parser = None
+        if payload["stream"]:
+            if mode == "optimize":
+                field_parser = JSONFieldStreamParser()
+            chunks = []
+            for token in self._iter_stream_tokens(response, is_cancelled, result):
+                if not chunks:
+                    result["telemetry"]["first_token_s"] = round(time.time() - start, 3)
+                chunks.append(token)
+                if field_parser is None:
+                    if on_token:
+                        on_token(token)
+                else:
+                    for field, text in field_parser.feed(token).items():
+                        if on_field:
+                            on_field(field, text)
+            result["text"] = "".join(chunks)
+            if result["cancelled"]:
+                return result
+        else:
+            if is_cancelled():
+                result["cancelled"] = True
+                return result
+
+            result_json = response.json()
+            self._record_usage(result, result_json)
+            
+            # OpenAI-compatible, native Ollama /api/chat, or /api/generate
+            if "choices" in result_json:
+                result["text"] = result_json["choices"][0]["message"]["content"]
+            elif "message" in result_json:
+                result["text"] = result_json["message"].get("content", "")
+            else:
+                result["text"] = result_json.get("response", "{}")
+
+        if mode == "optimize":
+            try:
+                result["content"] = parse_json_content(result["text"])
+            except ValueError:
+                # Malformed document: keep the string fields that streamed in completely
+                if field_parser is None or not field_parser.values:
+                    raise
+                result["content"] = dict(field_parser.values)
+                return result
+
+        # Only complete answers are worth replaying
+        if cache_key:
+            self.response_cache.put(cache_key, mode, model, result["text"])
+        return result
+
+    def _iter_stream_tokens(self, response, is_cancelled, result):
+        parser = StreamEventParser()
+
+        def objects():
+            # Reading on after [DONE] costs nothing and lets the connection go back to the pool
+            for chunk in response.iter_content(chunk_size=None):
+                if is_cancelled():
+                    result["cancelled"] = True
+                    return
+                yield from parser.feed(chunk)
+            yield from parser.close()
+
+        read_token = None
+        for json_chunk in objects():
+            error = json_chunk.get("error")
+            if error:
+                message = error.get("message", error) if isinstance(error, dict) else error
+                raise RuntimeError(f"The server reported an error: {message}")
+            self._record_usage(result, json_chunk)
+            if read_token is None: # the API is detected once per stream
+                read_token = stream_token_reader(json_chunk)
+                if read_token is None:
+                    continue
+            token = read_token(json_chunk)
+            if token:
+                yield token
+        result["telemetry"]["malformed_frames"] = parser.malformed
+        if parser.malformed:
+            print(f"Skipped {parser.malformed} malformed stream frame(s) from {result['url']}")
+
+class ModelFanout:
+    """Sends one query to several models/endpoints at once.
 
-    def get_all(self):
+    Every target runs on its own thread with its own CancelToken, and its
+    latency (first token and total) is recorded. In race mode the first target
+    returning a valid answer wins and the others are cancelled.
+    """
+    def __init__(self, settings, targets, response_cache=None, http_pool=None, schema_catalog=None, race=False,
+                 endpoint_pool=None, cancel_token=None):
+        self.settings = settings
+        self.targets = targets
+        self.response_cache = response_cache
+        self.http_pool = http_pool or HttpSessionPool.from_settings(settings)
+        self.schema_catalog = schema_catalog
+        self.endpoint_pool = endpoint_pool
+        self.race = race
+        self.winner = None
+        self._lock = threading.Lock()
+        # Cancelling cancel_token cancels every target
+        self._tokens = [cancel_token.child() if cancel_token else CancelToken() for _ in targets]
+
+    @staticmethod
+    def parse_targets(lines):
+        """Targets from "model [endpoint URL] [API key]" lines; the URL and key default to the main settings"""
+        targets = []
+        for line in lines:
+            parts = line.split()
+            if not parts or parts[0].startswith("#"):
+                continue
+            targets.append({
+                "model": parts[0],
+                "url": parts[1] if len(parts) > 1 else "",
+                "api_key": parts[2] if len(parts) > 2 else ""
+            })
+        return targets
+
+    @staticmethod
+    def is_valid(result):
+        """A usable answer: parsable JSON with a query (optimize) or any text (chat)"""
+        if result["mode"] != "optimize":
+            return bool(result["text"].strip())
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.row_factory = sqlite3.Row
-                return conn.execute("SELECT * FROM history ORDER BY timestamp DESC LIMIT 100").fetchall()
-        except Exception:
-            return []
+            content = parse_json_content(result["text"])
+        except ValueError:
+            return False
+        return isinstance(content, dict) and bool(content.get("optimized_query"))
+
+    def _target_settings(self, target):
+        settings = dict(self.settings)
+        if target.get("url"):
+            settings["ollama_url"] = target["url"]
+            settings["api_backend"] = "auto" # the API type is picked per endpoint
+        if target.get("api_key"):
+            settings["api_key"] = target["api_key"]
+        return settings
+
+    def cancel(self, keep=None):
+        for i, token in enumerate(self._tokens):
+            if i != keep:
+                token.cancel()
+
+    def _claim(self, index):
+        with self._lock:
+            if self.winner is not None:
+                return False
+            self.winner = index
+        self.cancel(keep=index)
+        return True
+
+    def run_target(self, index, mode, query, context, db_type, use_cache=False,
+                   on_token=None, on_field=None, on_done=None, store_cache=None):
+        target = self.targets[index]
+        settings = self._target_settings(target)
+        record = {"index": index, "model": target["model"], "url": settings.get("ollama_url", AppConfig.OLLAMA_URL),
+                  "status": "", "elapsed_s": None, "first_token_s": None, "from_cache": False,
+                  "text": "", "content": None, "error": "", "winner": False, "telemetry": None}
+        start = time.time()
+
+        def first_token():
+            if record["first_token_s"] is None:
+                record["first_token_s"] = round(time.time() - start, 3)
+
+        def token_cb(text):
+            first_token()
+            if on_token:
+                on_token(index, text)
+
+        def field_cb(field, text):
+            first_token()
+            if on_field:
+                on_field(index, field, text)
 
-    def delete_item(self, item_id):
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute("DELETE FROM history WHERE id = ?", (item_id,))
+            # Targets with their own URL bypass the endpoint pool
+            endpoint_pool = None if target.get("url") else self.endpoint_pool
+            optimizer = QueryOptimizer(settings, self.response_cache, self.http_pool, self.schema_catalog, endpoint_pool)
+            result = optimizer.run(mode, query, context, db_type, target["model"], use_cache=use_cache, store_cache=store_cache,
+                                   on_token=token_cb, on_field=field_cb, cancel_token=self._tokens[index])
+            record.update(text=result["text"], content=result["content"], from_cache=result["from_cache"],
+                          url=result.get("url", record["url"]), telemetry=result.get("telemetry"))
+            if result["cancelled"]:
+                record["status"] = "cancelled"
+            elif self.is_valid(result):
+                record["status"] = "ok"
+            else:
+                record.update(status="invalid", error="The answer is not valid JSON")
         except Exception as e:
-            print(f"Failed to delete item: {e}")
+            record.update(status="cancelled" if self._tokens[index].cancelled else "error", error=str(e))
 
-    def clear_all(self):
+        record["elapsed_s"] = round(time.time() - start, 3)
+        if record["status"] == "ok" and self.race:
+            record["winner"] = self._claim(index)
+        if on_done:
+            on_done(record)
+        return record
+
+    def run(self, mode, query, context, db_type, use_cache=False, on_token=None, on_field=None, on_done=None,
+            store_cache=None):
+        """Run all targets concurrently and return their records in target order.
+
+        Callbacks receive the target index first and are called from the target's
+        thread: on_token(i, text), on_field(i, field, text), on_done(record)."""
+        from concurrent.futures import ThreadPoolExecutor
+
+        with ThreadPoolExecutor(max_workers=max(1, len(self.targets))) as pool:
+            futures = [pool.submit(self.run_target, i, mode, query, context, db_type, use_cache,
+                                   on_token, on_field, on_done, store_cache) for i in range(len(self.targets))]
+            return [future.result() for future in futures]
+
+class JobScheduler:
+    """Runs queued jobs on worker threads, highest priority first (FIFO within a
+    priority), with at most limit_for(url) jobs running per endpoint.
+
+    Jobs are dicts with at least "id", "priority", "url" and "cancel_token";
+    the scheduler maintains their "status" (queued, running, done, error or
+    cancelled), "started", "finished" and "error". run(job) does the work on
+    the job's thread and on_change(job) is called from any thread after every
+    status change. A job waiting for a busy endpoint does not hold back jobs
+    for other endpoints.
+    """
+    def __init__(self, run, limit_for, on_change=None):
+        self.run = run
+        self.limit_for = limit_for
+        self.on_change = on_change
+        self._lock = threading.Lock()
+        self._queue = []
+        self._running = {}
+        self._seq = itertools.count()
+
+    def submit(self, job):
+        job.update(status="queued", started=None, finished=None, error="")
+        with self._lock:
+            heapq.heappush(self._queue, (-job["priority"], next(self._seq), job))
+        self._notify(job)
+        self.dispatch()
+
+    def cancel(self, job):
+        job["cancel_token"].cancel()
+        with self._lock:
+            queued = job["status"] == "queued"
+            if queued:
+                job["status"] = "cancelled" # dropped from the heap by the next dispatch
+                job["finished"] = time.time()
+        if queued:
+            self._notify(job)
+            self.dispatch()
+
+    def position(self, job):
+        """1-based place of a queued job in the run order, or None"""
+        with self._lock:
+            ordered = sorted(item for item in self._queue if item[2]["status"] == "queued")
+        for n, item in enumerate(ordered, 1):
+            if item[2] is job:
+                return n
+        return None
+
+    def active(self):
+        with self._lock:
+            return sum(self._running.values()) + sum(1 for item in self._queue if item[2]["status"] == "queued")
+
+    def _notify(self, job):
+        if self.on_change:
+            self.on_change(job)
+
+    def dispatch(self):
+        """Start every queued job whose endpoint has a free slot"""
+        started, waiting = [], []
+        with self._lock:
+            while self._queue:
+                item = heapq.heappop(self._queue)
+                job = item[2]
+                if job["status"] != "queued":
+                    continue
+                url = job["url"]
+                if self._running.get(url, 0) < max(1, int(self.limit_for(url))):
+                    self._running[url] = self._running.get(url, 0) + 1
+                    job.update(status="running", started=time.time())
+                    started.append(job)
+                else:
+                    waiting.append(item)
+            for item in waiting:
+                heapq.heappush(self._queue, item)
+        for job in started:
+            self._notify(job)
+            threading.Thread(target=self._work, args=(job,), daemon=True).start()
+
+    def _work(self, job):
         try:
-            with sqlite3.connect(self.db_path) as conn:
-                conn.execute("DELETE FROM history")
+            self.run(job)
+            status = "cancelled" if job["cancel_token"].cancelled else "done"
         except Exception as e:
-            print(f"Failed to clear history: {e}")
+            status = "cancelled" if job["cancel_token"].cancelled else "error"
+            job["error"] = str(e)
+        with self._lock:
+            job.update(status=status, finished=time.time())
+            self._running[job["url"]] -= 1
+        self._notify(job)
+        self.dispatch()
+
+class BatchRunner:
+    """Headless optimization of many queries through a bounded thread pool.
+
+    Results are appended to a JSONL report as they complete, which doubles as
+    the resume journal: on restart, ids already reported as "ok" are skipped.
+    """
+    REPORT_FIELDS = ["id", "status", "mode", "db_type", "model", "url", "elapsed_s", "from_cache",
+                     "ttfb_s", "first_token_s", "tokens_per_s", "prompt_tokens", "completion_tokens", "retries",
+                     "malformed_frames", "fingerprint", "query", "optimized_query", "indices", "explanation", "error", "finished_at"]
+
+    def __init__(self, settings, report_path, concurrency=None, endpoint_limits=None,
+                 history_manager=None, response_cache=None, use_cache=True, resume=False, schema_catalog=None):
+        self.settings = settings
+        self.report_path = report_path
+        self.concurrency = int(concurrency or settings.get("batch_concurrency", AppConfig.BATCH_CONCURRENCY))
+        self.endpoint_limits = endpoint_limits or {}
+        self.history_manager = history_manager
+        self.response_cache = response_cache
+        self.use_cache = use_cache
+        self.resume = resume
+        self.schema_catalog = schema_catalog
+        self._semaphores = {}
+        self._lock = threading.Lock()
+        self.http_pool = HttpSessionPool.from_settings(settings)
+        self.primary_url = settings.get("ollama_url", AppConfig.OLLAMA_URL)
+        self.endpoint_pool = EndpointPool(
+            self.http_pool, EndpointPool.parse_entries(self.primary_url, settings.get("endpoint_pool", [])),
+            settings.get("api_key", ""))
+
+    @staticmethod
+    def load_jobs(source, context=""):
+        """Read jobs from a directory of .sql files or from a JSONL file.
+
+        JSONL lines need at least a "query"; "id", "context", "db_type", "model",
+        "url" and "mode" are optional per-line overrides.
+        """
+        jobs = []
+        if os.path.isdir(source):
+            for root, _dirs, files in os.walk(source):
+                for name in sorted(files):
+                    if not name.lower().endswith(".sql"):
+                        continue
+                    path = os.path.join(root, name)
+                    with open(path, 'r', encoding='utf-8') as f:
+                        query = f.read().strip()
+                    if query:
+                        jobs.append({"id": os.path.relpath(path, source), "query": query, "context": context})
+            jobs.sort(key=lambda j: j["id"])
+        else:
+            with open(source, 'r', encoding='utf-8') as f:
+                for line_no, line in enumerate(f, 1):
+                    line = line.strip()
+                    if not line:
+                        continue
+                    item = json.loads(line)
+                    if not item.get("query"):
+                        continue
+                    item.setdefault("id", f"line-{line_no}")
+                    item["id"] = str(item["id"])
+                    item.setdefault("context", context)
+                    jobs.append(item)
+        return jobs
+
+    def completed_ids(self):
+        done = set()
+        if not os.path.exists(self.report_path):
+            return done
+        with open(self.report_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue # Partially written line from a crash
+                if record.get("status") == "ok":
+                    done.add(record.get("id"))
+        return done
+
+    def _endpoint_limit(self, url):
+        urls = [url]
+        if url == self.primary_url:
+            # Jobs on the main URL are spread over the whole endpoint pool
+            urls = [e["url"] for e in self.endpoint_pool.stats()]
+        return sum(max(1, int(self.endpoint_limits.get(u, self.concurrency))) for u in urls)
+
+    def _endpoint_semaphore(self, url):
+        with self._lock:
+            if url not in self._semaphores:
+                self._semaphores[url] = threading.BoundedSemaphore(self._endpoint_limit(url))
+            return self._semaphores[url]
+
+    def _job_settings(self, job):
+        if not job.get("url"):
+            return self.settings
+        job_settings = dict(self.settings)
+        job_settings["ollama_url"] = job["url"]
+        return job_settings
+
+    def run_job(self, job):
+        settings = self._job_settings(job)
+        mode = job.get("mode", "optimize")
+        db_type = job.get("db_type") or settings.get("db_type", AppConfig.DB_OPTIONS[0])
+        model = job.get("model") or settings.get("model", AppConfig.DEFAULT_MODEL)
+        url = settings.get("ollama_url", AppConfig.OLLAMA_URL)
+        record = {"id": job["id"], "mode": mode, "db_type": db_type, "model": model, "url": url,
+                  "fingerprint": query_fingerprint(job["query"]),
+                  "query": job["query"], "optimized_query": "", "indices": "", "explanation": "", "error": ""}
+
+        start = time.time()
+        try:
+            with self._endpoint_semaphore(url):
+                start = time.time()
+                endpoint_pool = self.endpoint_pool if url == self.primary_url else None
+                optimizer = QueryOptimizer(settings, self.response_cache, self.http_pool, self.schema_catalog, endpoint_pool)
+                result = optimizer.run(mode, job["query"], job.get("context", ""), db_type, model,
+                                       use_cache=self.use_cache)
+            record["url"] = result.get("url", url)
+            if mode == "optimize":
+                sql, idx, expl = format_optimize_result(result["content"], settings)
+            else:
+                sql, idx, expl = "", "", result["text"]
+            record.update(status="ok", optimized_query=sql, indices=idx, explanation=expl,
+                          from_cache=result["from_cache"])
+            telemetry = result.get("telemetry") or {}
+            record.update((k, telemetry.get(k)) for k in ("ttfb_s", "first_token_s", "tokens_per_s", "prompt_tokens",
+                                                          "completion_tokens", "retries", "malformed_frames"))
+            if self.history_manager is not None:
+                self.history_manager.save(mode=mode, db_type=db_type, model=model, query=job["query"],
+                                          context=job.get("context", ""), res_sql=sql, res_idx=idx, res_expl=expl,
+                                          telemetry=result.get("telemetry"))
+        except Exception as e:
+            record.update(status="error", error=str(e), from_cache=False)
+
+        record["elapsed_s"] = round(time.time() - start, 3)
+        record["finished_at"] = datetime.now().isoformat(timespec="seconds")
+        return record
+
+    def _append_record(self, record):
+        with self._lock:
+            with open(self.report_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+
+    def run(self, jobs, progress=None):
+        from concurrent.futures import ThreadPoolExecutor, as_completed
+
+        if self.resume:
+            done = self.completed_ids()
+            jobs = [j for j in jobs if j["id"] not in done]
+        elif os.path.exists(self.report_path):
+            os.remove(self.report_path)
+
+        # The pool only needs to be as wide as all endpoint limits together
+        urls = {self._job_settings(j).get("ollama_url", AppConfig.OLLAMA_URL) for j in jobs}
+        workers = sum(self._endpoint_limit(u) for u in urls) or 1
+        self.endpoint_pool.start_health_checks()
+
+        stats = {"total": len(jobs), "ok": 0, "error": 0}
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            futures = [pool.submit(self.run_job, job) for job in jobs]
+            for n, future in enumerate(as_completed(futures), 1):
+                record = future.result()
+                self._append_record(record)
+                stats[record["status"]] += 1
+                if progress:
+                    progress(n, len(jobs), record)
+        self.http_pool.reset()
+        return stats
+
+    def export_csv(self, csv_path):
+        """Write the whole JSONL report (including resumed runs) as CSV, one row per query id.
+
+        A resumed run appends a new record for every id that failed before, so only the
+        last record of each id is kept.
+        """
+        import csv
+        records = {}
+        with open(self.report_path, 'r', encoding='utf-8') as src:
+            for line in src:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue # Partially written line from a crash
+                records.pop(record.get("id"), None)
+                records[record.get("id")] = record
+        with open(csv_path, 'w', newline='', encoding='utf-8') as dst:
+            writer = csv.DictWriter(dst, fieldnames=self.REPORT_FIELDS, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(records.values())
+
+def run_batch_cli(args):
+    settings = load_settings_file(default_settings())
+    if args.url:
+        settings["ollama_url"] = args.url
+    if args.model:
+        settings["model"] = args.model
+    if args.db_type:
+        settings["db_type"] = args.db_type
+
+    context = ""
+    if args.context:
+        with open(args.context, 'r', encoding='utf-8') as f:
+            context = f.read().strip()
+
+    if args.schema:
+        settings["schema_paths"] = args.schema
+        settings["schema_auto_inject"] = True
+    schema_catalog = None
+    if settings.get("schema_auto_inject", AppConfig.SCHEMA_AUTO_INJECT) and settings.get("schema_paths"):
+        schema_catalog = SchemaCatalog(settings["schema_paths"])
+
+    endpoint_limits = {}
+    for spec in args.endpoint_limit or []:
+        url, _, limit = spec.rpartition("=")
+        endpoint_limits[url] = int(limit)
+
+    jobs = BatchRunner.load_jobs(args.batch, context)
+    if args.mode:
+        for job in jobs:
+            job.setdefault("mode", args.mode)
+
+    cache = None
+    if settings.get("cache_enabled", AppConfig.CACHE_ENABLED) and not args.no_cache:
+        cache = ResponseCache(
+            max_entries=settings.get("cache_max_entries", AppConfig.CACHE_MAX_ENTRIES),
+            max_size_mb=settings.get("cache_max_size_mb", AppConfig.CACHE_MAX_SIZE_MB),
+            max_age_days=settings.get("cache_max_age_days", AppConfig.CACHE_MAX_AGE_DAYS)
+        )
+
+    runner = BatchRunner(
+        settings, args.output,
+        concurrency=args.concurrency,
+        endpoint_limits=endpoint_limits,
+        history_manager=None if args.no_history else HistoryManager(),
+        response_cache=cache,
+        use_cache=cache is not None,
+        resume=args.resume,
+        schema_catalog=schema_catalog
+    )
+
+    def progress(n, total, record):
+        status = "ok" if record["status"] == "ok" else f"error: {record['error']}"
+        print(f"[{n}/{total}] {record['id']} ({record['elapsed_s']}s) {status}", flush=True)
+
+    stats = runner.run(jobs, progress=progress)
+    if args.csv:
+        runner.export_csv(args.csv)
+    print(f"Done: {stats['ok']} ok, {stats['error']} failed, {stats['total']} processed. Report: {args.output}")
+    return 0 if stats["error"] == 0 else 1
 
 # System settings
 ctk.set_appearance_mode("System")
 ctk.set_default_color_theme("blue")
 
+class StreamRenderer:
+    """Buffers tokens pushed from worker threads and draws them in one insert per frame"""
+    def __init__(self, textbox, interval_ms=AppConfig.STREAM_FLUSH_MS):
+        self.textbox = textbox
+        self.interval_ms = interval_ms
+        self._pending = []
+        self._lock = threading.Lock()
+        self._req_id = None
+        self._after_id = None
+        self._replace = False
+
+    def start(self, req_id, replace=False):
+        # Tk thread only; with replace=True the first flush clears the placeholder text
+        self.cancel()
+        self._req_id = req_id
+        self._replace = replace
+        self._after_id = self.textbox.after(self.interval_ms, self._tick)
+
+    def push(self, token, req_id):
+        # Any thread: no Tk calls here, the frame timer picks the tokens up
+        with self._lock:
+            if req_id == self._req_id:
+                self._pending.append(token)
+
+    def _tick(self):
+        self.flush()
+        self._after_id = self.textbox.after(self.interval_ms, self._tick)
+
+    def flush(self):
+        with self._lock:
+            if not self._pending:
+                return
+            text = "".join(self._pending)
+            self._pending.clear()
+        if self._replace:
+            self._replace = False
+            self.textbox.delete("1.0", tk.END)
+        # Only follow the stream if the user has not scrolled up to read
+        at_bottom = self.textbox.yview()[1] >= 0.999
+        self.textbox.insert(tk.END, text)
+        if at_bottom:
+            self.textbox.see(tk.END)
+
+    def _halt(self):
+        if self._after_id is not None:
+            self.textbox.after_cancel(self._after_id)
+            self._after_id = None
+
+    def stop(self):
+        """Draw what is left and stop the frame timer"""
+        self._halt()
+        self.flush()
+        self._req_id = None
+
+    def cancel(self):
+        """Drop what is left and stop the frame timer"""
+        self._halt()
+        with self._lock:
+            self._pending.clear()
+            self._req_id = None
+
+class SqlHighlighter:
+    """Incremental SQL highlighting for a CTkTextbox.
+
+    The Tk text command is proxied (rename trick) so every edit reports the
+    lines it touched. Only those lines are re-lexed, in idle callbacks of
+    HIGHLIGHT_LINES_PER_PASS lines; a line's end state (open comment or
+    string) is kept so re-lexing stops as soon as it stops changing.
+    """
+    TAGS = ("keyword", "string", "comment", "number")
+    UNLEXED = object() # end state of a line that has not been lexed yet
+    EDIT_COMMANDS = ("insert", "delete", "replace")
+
+    def __init__(self, textbox, colors=AppConfig.HIGHLIGHT_COLORS):
+        self.textbox = textbox
+        self.widget = textbox._textbox
+        for tag in self.TAGS:
+            self.widget.tag_configure(tag, foreground=colors[tag])
+
+        self.states = [None]    # lexer state at the end of each line (0-based)
+        self.dirty = set()      # 0-based lines waiting to be re-lexed
+        self._after_id = None
+
+        # Put a Python proxy in place of the widget command
+        self._orig = self.widget._w + "_orig"
+        self.widget.tk.call("rename", self.widget._w, self._orig)
+        self.widget.tk.createcommand(self.widget._w, self._proxy)
+
+    def _call(self, *args):
+        return self.widget.tk.call((self._orig,) + args)
+
+    def _line_count(self):
+        return int(self._call("index", "end-1c").split(".")[0])
+
+    def _proxy(self, *args):
+        cmd = args[0] if args else ""
+        if cmd in self.EDIT_COMMANDS:
+            before = self._line_count()
+            start = min(int(self._call("index", args[1]).split(".")[0]), before) - 1
+            result = self._call(*args)
+            self._edited(start, self._line_count() - before)
+            return result
+        if cmd == "edit" and len(args) > 1 and args[1] in ("undo", "redo"):
+            result = self._call(*args)
+            self.rehighlight() # undo does not go through insert/delete
+            return result
+        return self._call(*args)
+
+    def _edited(self, start, delta):
+        # The last line of the edited block inherits the old end state, which is
+        # what the line after it was lexed with
+        if delta > 0:
+            self.states[start:start] = [self.UNLEXED] * delta
+        elif delta < 0:
+            del self.states[start:start - delta]
+        if delta:
+            # Keep pending lines pointing at the same text
+            shifted = set()
+            for line in self.dirty:
+                if line <= start:
+                    shifted.add(line)
+                elif line > start - delta:
+                    shifted.add(line + delta)
+            self.dirty = shifted
+        self.dirty.update(range(start, start + max(delta, 0) + 1))
+        self._schedule()
+
+    def rehighlight(self):
+        """Re-lex the whole buffer (in the background, pass by pass)"""
+        self.states = [self.UNLEXED] * self._line_count()
+        self.dirty = set(range(len(self.states)))
+        self._schedule()
+
+    def _schedule(self):
+        if self._after_id is None:
+            self._after_id = self.widget.after_idle(self._process)
+
+    def _process(self):
+        self._after_id = None
+        if not self.dirty:
+            return
+        ranges = {tag: [] for tag in self.TAGS}
+        runs = [] # contiguous [first, last] blocks of re-lexed lines
+        budget = AppConfig.HIGHLIGHT_LINES_PER_PASS
+        line = min(self.dirty)
+        total = len(self.states)
+
+        while budget > 0 and line is not None:
+            self.dirty.discard(line)
+            if line < total:
+                state = self.states[line - 1] if line > 0 else None
+                text = self._call("get", f"{line + 1}.0", f"{line + 1}.end")
+                spans, end_state = lex_sql_line(text, state)
+                for tag, start, end in spans:
+                    ranges[tag].extend((f"{line + 1}.{start}", f"{line + 1}.{end}"))
+                if runs and runs[-1][1] == line - 1:
+                    runs[-1][1] = line
+                else:
+                    runs.append([line, line])
+                # An opened or closed comment/string changes how the next line reads
+                if end_state != self.states[line]:
+                    self.states[line] = end_state
+                    self.dirty.add(line + 1)
+            budget -= 1
+            if line + 1 in self.dirty:
+                line += 1
+            else:
+                line = min(self.dirty) if self.dirty else None
+
+        # Tags change in batches: one remove per block and one add per tag for the whole pass
+        for tag in self.TAGS:
+            for first, last in runs:
+                self._call("tag", "remove", tag, f"{first + 1}.0", f"{last + 1}.end")
+            if ranges[tag]:
+                self._call("tag", "add", tag, *ranges[tag])
+        if self.dirty:
+            self._schedule()
+
+class VirtualHistoryList(ctk.CTkFrame):
+    """Scrollable history list that only creates widgets for the visible rows.
+
+    Rows have a fixed height and a small pool of cards is re-bound to whatever
+    items the scroll position exposes, so a long list costs the same as a
+    screenful. Single rows can be inserted or removed without a redraw.
+    """
+    ROW_HEIGHT = 56
+    SCROLL_STEP = 28
+    MONTHS = ["Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep", "Oct", "Nov", "Dec"]
+
+    def __init__(self, master, on_open, on_delete, **kwargs):
+        super().__init__(master, **kwargs)
+        self.on_open = on_open
+        self.on_delete = on_delete
+        self.items = []
+        self._top = 0 # Scroll offset, in unscaled pixels
+        self._rows = []
+
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(0, weight=1)
+        self.viewport = ctk.CTkFrame(self, fg_color="transparent")
+        self.viewport.grid(row=0, column=0, sticky="nsew")
+        self.scrollbar = ctk.CTkScrollbar(self, command=self.yview)
+        self.scrollbar.grid(row=0, column=1, sticky="ns")
+
+        self.viewport.bind("<Configure>", lambda e: self._render())
+        self.bind_all("<MouseWheel>", self._on_mousewheel, add="+")
+        self.bind_all("<Button-4>", self._on_mousewheel, add="+")
+        self.bind_all("<Button-5>", self._on_mousewheel, add="+")
+
+    @classmethod
+    def short_timestamp(cls, ts):
+        # "2024-05-17 14:03:59" -> "17 May 14:03" without strptime
+        try:
+            return f"{ts[8:10]} {cls.MONTHS[int(ts[5:7]) - 1]} {ts[11:16]}"
+        except (TypeError, ValueError, IndexError):
+            return str(ts)
+
+    def _create_row(self):
+        card = ctk.CTkFrame(self.viewport, height=self.ROW_HEIGHT - 6, fg_color=("gray90", "gray20"), corner_radius=6)
+        card.pack_propagate(False)
+        card.item_id = None
+
+        # Clickable area
+        card.title_btn = ctk.CTkButton(card, text="", anchor="w", fg_color="transparent", text_color=("black", "white"),
+                                       hover_color=("gray80", "gray30"), height=24,
+                                       command=lambda c=card: c.item_id is not None and self.on_open(c.item_id))
+        card.title_btn.pack(side="top", fill="x", padx=2, pady=(2, 0))
+
+        # Preview text
+        card.preview_label = ctk.CTkLabel(card, text="", font=ctk.CTkFont(size=10), text_color="gray", anchor="w")
+        card.preview_label.pack(side="top", fill="x", padx=10, pady=(0, 2))
+
+        # Delete button
+        card.del_btn = ctk.CTkButton(card, text="×", width=20, height=20, fg_color="transparent",
+                                     hover_color="#C0392B", text_color="gray",
+                                     command=lambda c=card: c.item_id is not None and self.on_delete(c.item_id))
+        card.del_btn.place(relx=0.9, rely=0.1, anchor="center")
+        return card
+
+    def _bind_row(self, card, item):
+        if card.item_id == item['id']:
+            return
+        card.item_id = item['id']
+        mode_icon = "🪄" if item['request_mode'] == 'optimize' else "💬"
+        runs = item['runs'] if 'runs' in item.keys() else 1 # grouped by fingerprint
+        title = f"{mode_icon} {self.short_timestamp(item['timestamp'])}"
+        card.title_btn.configure(text=f"{title}  ×{runs}" if runs > 1 else title)
+        preview = item['preview'] or ""
+        preview = (preview[:40] + "...") if len(preview) > 40 else preview
+        card.preview_label.configure(text=preview)
+
+    def _view_height(self):
+        return self.viewport.winfo_height() / self._get_widget_scaling()
+
+    def _render(self):
+        view_h = self._view_height()
+        if view_h <= 1:
+            return
+        total_h = len(self.items) * self.ROW_HEIGHT
+        self._top = max(0, min(self._top, total_h - view_h))
+        first = int(self._top // self.ROW_HEIGHT)
+        needed = int(view_h // self.ROW_HEIGHT) + 2
+
+        while len(self._rows) < needed:
+            self._rows.append(self._create_row())
+
+        # A card keeps its item while it stays on screen: scrolling one row re-binds one card
+        visible = range(first, min(first + needed, len(self.items)))
+        shown = set()
+        for index in visible:
+            card = self._rows[index % needed]
+            shown.add(index % needed)
+            self._bind_row(card, self.items[index])
+            card.place(x=0, y=index * self.ROW_HEIGHT - self._top, relwidth=1)
+        for k, card in enumerate(self._rows):
+            if k not in shown:
+                card.item_id = None
+                card.place_forget()
+
+        if total_h <= view_h:
+            self.scrollbar.set(0.0, 1.0)
+        else:
+            self.scrollbar.set(self._top / total_h, (self._top + view_h) / total_h)
+
+    def yview(self, *args):
+        total_h = len(self.items) * self.ROW_HEIGHT
+        if args and args[0] == "moveto":
+            self._top = float(args[1]) * total_h
+        elif args and args[0] == "scroll":
+            step = self._view_height() if args[2] == "pages" else self.SCROLL_STEP
+            self._top += int(args[1]) * step
+        self._render()
+
+    def _on_mousewheel(self, event):
+        # bind_all sees every wheel event in the app; only react inside this list
+        if not str(event.widget).startswith(str(self)):
+            return
+        if event.num == 4:
+            direction = -1
+        elif event.num == 5:
+            direction = 1
+        else:
+            direction = -1 if event.delta > 0 else 1
+        self.yview("scroll", direction, "units")
+
+    def set_items(self, items):
+        self.items = list(items)
+        self._top = 0
+        for card in self._rows:
+            card.item_id = None
+        self._render()
+
+    def insert_item(self, index, item):
+        self.items.insert(index, item)
+        # Keep the rows the user is looking at in place
+        if index * self.ROW_HEIGHT < self._top:
+            self._top += self.ROW_HEIGHT
+        for card in self._rows:
+            card.item_id = None
+        self._render()
+
+    def remove_item(self, item_id):
+        for index, item in enumerate(self.items):
+            if item['id'] == item_id:
+                del self.items[index]
+                if index * self.ROW_HEIGHT < self._top:
+                    self._top -= self.ROW_HEIGHT
+                for card in self._rows:
+                    card.item_id = None
+                self._render()
+                return True
+        return False
+
+    def __len__(self):
+        return len(self.items)
+
 class SettingsDialog(ctk.CTkToplevel):
+    API_BACKENDS = {"auto": "Auto-detect", "openai": "OpenAI-compatible (/v1)", "ollama": "Ollama native (/api/chat)"}
+
     def __init__(self, parent):
         super().__init__(parent)
         self.parent = parent
         self.title("Preferences")
-        self.geometry("600x600")
+        self.geometry("680x600")
         self.resizable(False, False)
         
         # Make modal
@@ -158,25 +4007,32 @@ class SettingsDialog(ctk.CTkToplevel):
         self.tab_ai = self.tabview.add("AI Configuration")
         self.tab_prompts = self.tabview.add("System Prompt")
         self.tab_ui = self.tabview.add("Interface & Appearance")
+        self.tab_perf = self.tabview.add("Performance")
+        self.tab_schema = self.tabview.add("Schema")
+        self.tab_compare = self.tabview.add("Compare")
         
         # --- AI Tab ---
         self.tab_ai.grid_columnconfigure(1, weight=1)
         
-        ctk.CTkLabel(self.tab_ai, text="Provider Presets:").grid(row=0, column=0, sticky="w", padx=10, pady=10)
+        ctk.CTkLabel(self.tab_ai, text="Provider Presets:").grid(row=0, column=0, sticky="w", padx=10, pady=6)
         self.option_provider = ctk.CTkOptionMenu(self.tab_ai, values=["Ollama (Local)", "OpenAI (Cloud)", "Custom"], command=self.on_provider_change)
-        self.option_provider.grid(row=0, column=1, sticky="ew", padx=10, pady=10)
+        self.option_provider.grid(row=0, column=1, sticky="ew", padx=10, pady=6)
 
-        ctk.CTkLabel(self.tab_ai, text="API Endpoint URL:").grid(row=1, column=0, sticky="w", padx=10, pady=10)
+        ctk.CTkLabel(self.tab_ai, text="API Endpoint URL:").grid(row=1, column=0, sticky="w", padx=10, pady=6)
         self.entry_url = ctk.CTkEntry(self.tab_ai)
-        self.entry_url.grid(row=1, column=1, sticky="ew", padx=10, pady=10)
+        self.entry_url.grid(row=1, column=1, sticky="ew", padx=10, pady=6)
+
+        ctk.CTkLabel(self.tab_ai, text="API Type:").grid(row=2, column=0, sticky="w", padx=10, pady=6)
+        self.option_backend = ctk.CTkOptionMenu(self.tab_ai, values=list(self.API_BACKENDS.values()))
+        self.option_backend.grid(row=2, column=1, sticky="ew", padx=10, pady=6)
         
-        ctk.CTkLabel(self.tab_ai, text="API Key (Optional):").grid(row=2, column=0, sticky="w", padx=10, pady=10)
+        ctk.CTkLabel(self.tab_ai, text="API Key (Optional):").grid(row=3, column=0, sticky="w", padx=10, pady=6)
         self.entry_apikey = ctk.CTkEntry(self.tab_ai, show="*")
-        self.entry_apikey.grid(row=2, column=1, sticky="ew", padx=10, pady=10)
+        self.entry_apikey.grid(row=3, column=1, sticky="ew", padx=10, pady=6)
         
-        ctk.CTkLabel(self.tab_ai, text="Model Name:").grid(row=3, column=0, sticky="w", padx=10, pady=10)
+        ctk.CTkLabel(self.tab_ai, text="Model Name:").grid(row=4, column=0, sticky="w", padx=10, pady=6)
         self.model_frame = ctk.CTkFrame(self.tab_ai, fg_color="transparent")
-        self.model_frame.grid(row=3, column=1, sticky="ew", padx=10, pady=10)
+        self.model_frame.grid(row=4, column=1, sticky="ew", padx=10, pady=6)
         self.model_frame.grid_columnconfigure(0, weight=1)
         
         self.entry_model = ctk.CTkComboBox(self.model_frame, values=[AppConfig.DEFAULT_MODEL])
@@ -185,21 +4041,28 @@ class SettingsDialog(ctk.CTkToplevel):
         self.btn_fetch = ctk.CTkButton(self.model_frame, text="↻", width=30, command=self.fetch_ollama_models)
         self.btn_fetch.grid(row=0, column=1, padx=(5, 0))
         
-        ctk.CTkLabel(self.tab_ai, text="Temperature (0.0 - 1.0):").grid(row=4, column=0, sticky="w", padx=10, pady=10)
+        ctk.CTkLabel(self.tab_ai, text="Temperature (0.0 - 1.0):").grid(row=5, column=0, sticky="w", padx=10, pady=6)
         self.entry_temp = ctk.CTkEntry(self.tab_ai)
-        self.entry_temp.grid(row=4, column=1, sticky="ew", padx=10, pady=10)
+        self.entry_temp.grid(row=5, column=1, sticky="ew", padx=10, pady=6)
         
-        ctk.CTkLabel(self.tab_ai, text="Context Size (tokens):").grid(row=5, column=0, sticky="w", padx=10, pady=10)
+        ctk.CTkLabel(self.tab_ai, text="Context Window (num_ctx, Ollama):").grid(row=6, column=0, sticky="w", padx=10, pady=6)
         self.entry_ctx = ctk.CTkEntry(self.tab_ai)
-        self.entry_ctx.grid(row=5, column=1, sticky="ew", padx=10, pady=10)
+        self.entry_ctx.grid(row=6, column=1, sticky="ew", padx=10, pady=6)
+
+        ctk.CTkLabel(self.tab_ai, text="Max Answer Tokens (0 = no limit):").grid(row=7, column=0, sticky="w", padx=10, pady=6)
+        self.entry_max_tokens = ctk.CTkEntry(self.tab_ai)
+        self.entry_max_tokens.grid(row=7, column=1, sticky="ew", padx=10, pady=6)
         
-        ctk.CTkLabel(self.tab_ai, text="Timeout (seconds):").grid(row=6, column=0, sticky="w", padx=10, pady=10)
+        ctk.CTkLabel(self.tab_ai, text="Read Timeout (seconds):").grid(row=8, column=0, sticky="w", padx=10, pady=6)
         self.entry_timeout = ctk.CTkEntry(self.tab_ai)
-        self.entry_timeout.grid(row=6, column=1, sticky="ew", padx=10, pady=10)
+        self.entry_timeout.grid(row=8, column=1, sticky="ew", padx=10, pady=6)
+
+        self.switch_stream_usage = ctk.CTkSwitch(self.tab_ai, text="Ask for token counts when streaming (stream_options, OpenAI API)")
+        self.switch_stream_usage.grid(row=9, column=0, columnspan=2, sticky="w", padx=10, pady=6)
 
         self.btn_test_conn = ctk.CTkButton(self.tab_ai, text="Test Connection", command=self.test_connection, 
                                           fg_color="#2E86C1", hover_color="#2874A6")
-        self.btn_test_conn.grid(row=7, column=1, sticky="e", padx=10, pady=10)
+        self.btn_test_conn.grid(row=10, column=1, sticky="e", padx=10, pady=6)
 
         # --- Prompts Tab ---
         self.tab_prompts.grid_columnconfigure(0, weight=1)
@@ -260,6 +4123,144 @@ class SettingsDialog(ctk.CTkToplevel):
         self.switch_compact_select = ctk.CTkSwitch(self.format_frame, text="Compact SELECT (One line)")
         self.switch_compact_select.grid(row=4, column=0, columnspan=2, sticky="w", padx=10, pady=5)
 
+        # --- Schema Tab ---
+        self.tab_schema.grid_columnconfigure(1, weight=1)
+        self.tab_schema.grid_rowconfigure(1, weight=1)
+
+        ctk.CTkLabel(self.tab_schema, text="DDL files or folders (one per line):", font=ctk.CTkFont(weight="bold")).grid(row=0, column=0, columnspan=2, sticky="w", padx=10, pady=(10, 0))
+        self.text_schema_paths = ctk.CTkTextbox(self.tab_schema, height=120)
+        self.text_schema_paths.grid(row=1, column=0, columnspan=2, sticky="nsew", padx=10, pady=5)
+
+        self.schema_btn_frame = ctk.CTkFrame(self.tab_schema, fg_color="transparent")
+        self.schema_btn_frame.grid(row=2, column=0, columnspan=2, sticky="ew", padx=10, pady=5)
+        ctk.CTkButton(self.schema_btn_frame, text="Add Files...", width=110, command=self.add_schema_files).pack(side="left")
+        ctk.CTkButton(self.schema_btn_frame, text="Add Folder...", width=110, command=self.add_schema_folder).pack(side="left", padx=10)
+
+        self.switch_schema_inject = ctk.CTkSwitch(self.tab_schema, text="Add the DDL of the tables a query uses to its context")
+        self.switch_schema_inject.grid(row=3, column=0, columnspan=2, sticky="w", padx=10, pady=5)
+
+        ctk.CTkLabel(self.tab_schema, text="Token Budget:").grid(row=4, column=0, sticky="w", padx=10, pady=5)
+        self.entry_schema_budget = ctk.CTkEntry(self.tab_schema)
+        self.entry_schema_budget.grid(row=4, column=1, sticky="ew", padx=10, pady=5)
+
+        catalog = self.parent.schema_catalog
+        status = f"{len(catalog.tables)} tables indexed" if catalog.paths else "No schema loaded"
+        ctk.CTkLabel(self.tab_schema, text=status, font=ctk.CTkFont(size=11, slant="italic")).grid(row=5, column=0, columnspan=2, sticky="w", padx=10, pady=(0, 10))
+
+        # --- Compare Tab ---
+        self.tab_compare.grid_columnconfigure(0, weight=1)
+        self.tab_compare.grid_rowconfigure(2, weight=1)
+
+        ctk.CTkLabel(self.tab_compare, text="Models to compare (one per line):", font=ctk.CTkFont(weight="bold")).grid(row=0, column=0, sticky="w", padx=10, pady=(10, 0))
+        ctk.CTkLabel(self.tab_compare, text="model [endpoint URL] [API key] - URL and key default to the AI Configuration tab.", font=ctk.CTkFont(size=11, slant="italic")).grid(row=1, column=0, sticky="w", padx=10, pady=(0, 5))
+        self.text_compare_targets = ctk.CTkTextbox(self.tab_compare, height=160, font=(AppConfig.FONT_MONO, 12))
+        self.text_compare_targets.grid(row=2, column=0, sticky="nsew", padx=10, pady=(5, 10))
+
+        # --- Performance Tab ---
+        self.tab_perf.grid_columnconfigure(0, weight=1)
+        self.tab_perf.grid_rowconfigure(0, weight=1)
+        self.perf_frame = ctk.CTkScrollableFrame(self.tab_perf, fg_color="transparent")
+        self.perf_frame.grid(row=0, column=0, sticky="nsew")
+        self.perf_frame.grid_columnconfigure(1, weight=1)
+
+        ctk.CTkLabel(self.perf_frame, text="Response Cache", font=ctk.CTkFont(weight="bold")).grid(row=0, column=0, columnspan=2, sticky="w", padx=10, pady=(10, 0))
+
+        self.switch_cache = ctk.CTkSwitch(self.perf_frame, text="Reuse cached answers for identical requests")
+        self.switch_cache.grid(row=1, column=0, columnspan=2, sticky="w", padx=10, pady=5)
+
+        ctk.CTkLabel(self.perf_frame, text="Max Entries:").grid(row=2, column=0, sticky="w", padx=10, pady=5)
+        self.entry_cache_entries = ctk.CTkEntry(self.perf_frame)
+        self.entry_cache_entries.grid(row=2, column=1, sticky="ew", padx=10, pady=5)
+
+        ctk.CTkLabel(self.perf_frame, text="Max Size (MB):").grid(row=3, column=0, sticky="w", padx=10, pady=5)
+        self.entry_cache_size = ctk.CTkEntry(self.perf_frame)
+        self.entry_cache_size.grid(row=3, column=1, sticky="ew", padx=10, pady=5)
+
+        ctk.CTkLabel(self.perf_frame, text="Max Age (days):").grid(row=4, column=0, sticky="w", padx=10, pady=5)
+        self.entry_cache_age = ctk.CTkEntry(self.perf_frame)
+        self.entry_cache_age.grid(row=4, column=1, sticky="ew", padx=10, pady=5)
+
+        self.btn_clear_cache = ctk.CTkButton(self.perf_frame, text="Clear Cache", command=self.clear_response_cache,
+                                             fg_color="#A04000", hover_color="#CA6F1E", width=120)
+        self.btn_clear_cache.grid(row=5, column=1, sticky="e", padx=10, pady=(5, 10))
+
+        ctk.CTkLabel(self.perf_frame, text="Network", font=ctk.CTkFont(weight="bold")).grid(row=6, column=0, columnspan=2, sticky="w", padx=10, pady=(10, 0))
+
+        ctk.CTkLabel(self.perf_frame, text="Connections per Endpoint:").grid(row=7, column=0, sticky="w", padx=10, pady=5)
+        self.entry_pool_size = ctk.CTkEntry(self.perf_frame)
+        self.entry_pool_size.grid(row=7, column=1, sticky="ew", padx=10, pady=5)
+
+        ctk.CTkLabel(self.perf_frame, text="Connect Timeout (seconds):").grid(row=8, column=0, sticky="w", padx=10, pady=5)
+        self.entry_connect_timeout = ctk.CTkEntry(self.perf_frame)
+        self.entry_connect_timeout.grid(row=8, column=1, sticky="ew", padx=10, pady=5)
+
+        self.switch_compression = ctk.CTkSwitch(self.perf_frame, text="Accept compressed responses (gzip)")
+        self.switch_compression.grid(row=9, column=0, columnspan=2, sticky="w", padx=10, pady=5)
+
+        ctk.CTkLabel(self.perf_frame, text="Streaming", font=ctk.CTkFont(weight="bold")).grid(row=10, column=0, columnspan=2, sticky="w", padx=10, pady=(10, 0))
+
+        ctk.CTkLabel(self.perf_frame, text="Redraw Interval (ms):").grid(row=11, column=0, sticky="w", padx=10, pady=5)
+        self.entry_flush_ms = ctk.CTkEntry(self.perf_frame)
+        self.entry_flush_ms.grid(row=11, column=1, sticky="ew", padx=10, pady=5)
+
+        self.switch_stream_optimize = ctk.CTkSwitch(self.perf_frame, text="Stream Optimize results while they are generated")
+        self.switch_stream_optimize.grid(row=12, column=0, columnspan=2, sticky="w", padx=10, pady=5)
+
+        ctk.CTkLabel(self.perf_frame, text="History Retention (0 = unlimited)", font=ctk.CTkFont(weight="bold")).grid(row=13, column=0, columnspan=2, sticky="w", padx=10, pady=(10, 0))
+
+        ctk.CTkLabel(self.perf_frame, text="Max Entries:").grid(row=14, column=0, sticky="w", padx=10, pady=5)
+        self.entry_history_rows = ctk.CTkEntry(self.perf_frame)
+        self.entry_history_rows.grid(row=14, column=1, sticky="ew", padx=10, pady=5)
+
+        ctk.CTkLabel(self.perf_frame, text="Max Age (days):").grid(row=15, column=0, sticky="w", padx=10, pady=5)
+        self.entry_history_age = ctk.CTkEntry(self.perf_frame)
+        self.entry_history_age.grid(row=15, column=1, sticky="ew", padx=10, pady=5)
+
+        ctk.CTkLabel(self.perf_frame, text="Max Database Size (MB):").grid(row=16, column=0, sticky="w", padx=10, pady=5)
+        self.entry_history_size = ctk.CTkEntry(self.perf_frame)
+        self.entry_history_size.grid(row=16, column=1, sticky="ew", padx=10, pady=5)
+
+        ctk.CTkLabel(self.perf_frame, text="Endpoint Pool", font=ctk.CTkFont(weight="bold")).grid(row=17, column=0, columnspan=2, sticky="w", padx=10, pady=(10, 0))
+        ctk.CTkLabel(self.perf_frame, text="Extra endpoints serving the same models, one \"URL [weight]\" per line:", font=ctk.CTkFont(size=11, slant="italic")).grid(row=18, column=0, columnspan=2, sticky="w", padx=10)
+        self.text_endpoint_pool = ctk.CTkTextbox(self.perf_frame, height=80, font=(AppConfig.FONT_MONO, 12))
+        self.text_endpoint_pool.grid(row=19, column=0, columnspan=2, sticky="ew", padx=10, pady=5)
+
+        self.switch_hedge = ctk.CTkSwitch(self.perf_frame, text="Retry slow requests on a second endpoint (hedging)")
+        self.switch_hedge.grid(row=20, column=0, columnspan=2, sticky="w", padx=10, pady=5)
+
+        pool_lines = []
+        for e in self.parent.endpoint_pool.stats():
+            latency = f"p50 {e['p50']:.2f}s / p95 {e['p95']:.2f}s" if e["p50"] is not None else "no samples"
+            state = "up" if e["healthy"] else "DOWN"
+            pool_lines.append(f"{HttpSessionPool.endpoint_key(e['url'])}: {state}, {e['outstanding']} running, "
+                              f"{e['requests']} ok / {e['errors']} failed, first byte {latency}")
+        ctk.CTkLabel(self.perf_frame, text="\n".join(pool_lines), justify="left", font=ctk.CTkFont(size=11)).grid(row=21, column=0, columnspan=2, sticky="w", padx=10, pady=(0, 10))
+
+        ctk.CTkLabel(self.perf_frame, text="Job Queue", font=ctk.CTkFont(weight="bold")).grid(row=22, column=0, columnspan=2, sticky="w", padx=10, pady=(10, 0))
+
+        ctk.CTkLabel(self.perf_frame, text="Running Jobs per Endpoint:").grid(row=23, column=0, sticky="w", padx=10, pady=(5, 10))
+        self.entry_job_concurrency = ctk.CTkEntry(self.perf_frame)
+        self.entry_job_concurrency.grid(row=23, column=1, sticky="ew", padx=10, pady=(5, 10))
+
+        ctk.CTkLabel(self.perf_frame, text="Ollama Runtime", font=ctk.CTkFont(weight="bold")).grid(row=24, column=0, columnspan=2, sticky="w", padx=10, pady=(10, 0))
+
+        self.switch_warmup = ctk.CTkSwitch(self.perf_frame, text="Load the selected model in the background")
+        self.switch_warmup.grid(row=25, column=0, columnspan=2, sticky="w", padx=10, pady=5)
+
+        ctk.CTkLabel(self.perf_frame, text="Keep Loaded For (keep_alive):").grid(row=26, column=0, sticky="w", padx=10, pady=5)
+        self.entry_keep_alive = ctk.CTkEntry(self.perf_frame, placeholder_text="30m, 2h, -1 = forever")
+        self.entry_keep_alive.grid(row=26, column=1, sticky="ew", padx=10, pady=5)
+
+        ctk.CTkLabel(self.perf_frame, text="CPU Threads (0 = auto):").grid(row=27, column=0, sticky="w", padx=10, pady=5)
+        self.entry_num_thread = ctk.CTkEntry(self.perf_frame)
+        self.entry_num_thread.grid(row=27, column=1, sticky="ew", padx=10, pady=5)
+
+        ctk.CTkLabel(self.perf_frame, text="GPU Layers (-1 = auto, 0 = CPU only):").grid(row=28, column=0, sticky="w", padx=10, pady=5)
+        self.entry_num_gpu = ctk.CTkEntry(self.perf_frame)
+        self.entry_num_gpu.grid(row=28, column=1, sticky="ew", padx=10, pady=5)
+
+        ctk.CTkLabel(self.perf_frame, text="Threads and GPU layers apply to the native Ollama API only.", font=ctk.CTkFont(size=11, slant="italic")).grid(row=29, column=0, columnspan=2, sticky="w", padx=10, pady=(0, 10))
+
         # --- Buttons ---
         self.btn_frame = ctk.CTkFrame(self, fg_color="transparent")
         self.btn_frame.grid(row=1, column=0, sticky="ew", padx=20, pady=10)
@@ -274,6 +4275,7 @@ class SettingsDialog(ctk.CTkToplevel):
         if choice == "Ollama (Local)":
             self.entry_url.delete(0, tk.END)
             self.entry_url.insert(0, "http://localhost:11434/v1/chat/completions")
+            self.option_backend.set(self.API_BACKENDS["ollama"])
             # Restore available models from settings if they look like Ollama models
             models = self.parent.settings.get("available_models", [AppConfig.DEFAULT_MODEL])
             self.entry_model.configure(values=models)
@@ -281,14 +4283,20 @@ class SettingsDialog(ctk.CTkToplevel):
         elif choice == "OpenAI (Cloud)":
             self.entry_url.delete(0, tk.END)
             self.entry_url.insert(0, "https://api.openai.com/v1/chat/completions")
+            self.option_backend.set(self.API_BACKENDS["openai"])
+            self.switch_stream_usage.select() # OpenAI supports stream_options
             openai_models = ["gpt-4o", "gpt-4o-mini", "gpt-4-turbo"]
             self.entry_model.configure(values=openai_models)
             self.entry_model.set("gpt-4o")
 
+    def selected_backend(self):
+        return next((k for k, v in self.API_BACKENDS.items() if v == self.option_backend.get()), AppConfig.API_BACKEND)
+
     def test_connection(self):
         url = self.entry_url.get().strip()
         api_key = self.entry_apikey.get().strip()
         model = self.entry_model.get().strip()
+        backend = chat_backend({"api_backend": self.selected_backend(), "max_tokens": 5, "ctx_size": 0}, url)
         
         def run_test():
             self.btn_test_conn.configure(state="disabled", text="Testing...")
@@ -297,13 +4305,8 @@ class SettingsDialog(ctk.CTkToplevel):
                 if api_key:
                     headers["Authorization"] = f"Bearer {api_key}"
                 
-                payload = {
-                    "model": model,
-                    "messages": [{"role": "user", "content": "say ok"}],
-                    "max_tokens": 5
-                }
-                
-                response = requests.post(url, json=payload, headers=headers, timeout=10)
+                payload = backend.payload(model, [{"role": "user", "content": "say ok"}], stream=False)
+                response = self.parent.http_pool.post(backend.endpoint(url), 10, json=payload, headers=headers)
                 if response.status_code == 200:
                     tk.messagebox.showinfo("Success", "Connection successful!")
                 else:
@@ -324,7 +4327,7 @@ class SettingsDialog(ctk.CTkToplevel):
                 if not base_url.endswith("/api/tags"):
                     base_url = base_url.rstrip("/") + "/api/tags"
                 
-                response = requests.get(base_url, timeout=5)
+                response = self.parent.http_pool.get(base_url, 5)
                 response.raise_for_status()
                 data = response.json()
                 models = [m["name"] for m in data.get("models", [])]
@@ -338,11 +4341,26 @@ class SettingsDialog(ctk.CTkToplevel):
         else:
             tk.messagebox.showinfo("Notice", "Model fetching is only available for local Ollama instances.")
 
+    def add_schema_files(self):
+        paths = filedialog.askopenfilenames(parent=self, filetypes=[("SQL files", "*.sql"), ("All files", "*")])
+        for path in paths:
+            self.text_schema_paths.insert(tk.END, path + "\n")
+
+    def add_schema_folder(self):
+        path = filedialog.askdirectory(parent=self)
+        if path:
+            self.text_schema_paths.insert(tk.END, path + "\n")
+
+    def clear_response_cache(self):
+        if messagebox.askyesno("Confirm", "Remove all cached AI responses?", parent=self):
+            threading.Thread(target=self.parent.response_cache.clear, daemon=True).start()
+
     def load_current_values(self):
         s = self.parent.settings
         
         self.option_provider.set("Custom") # Default to custom as we don't save provider state yet
         self.entry_url.insert(0, s.get("ollama_url", AppConfig.OLLAMA_URL))
+        self.option_backend.set(self.API_BACKENDS.get(s.get("api_backend"), self.API_BACKENDS[AppConfig.API_BACKEND]))
         self.entry_apikey.insert(0, s.get("api_key", ""))
         
         # Load available models into the combobox
@@ -352,6 +4370,7 @@ class SettingsDialog(ctk.CTkToplevel):
         
         self.entry_temp.insert(0, str(s.get("temperature", AppConfig.AI_TEMPERATURE)))
         self.entry_ctx.insert(0, str(s.get("ctx_size", AppConfig.AI_CTX_SIZE)))
+        self.entry_max_tokens.insert(0, str(s.get("max_tokens", AppConfig.AI_MAX_TOKENS)))
         self.entry_timeout.insert(0, str(s.get("timeout", AppConfig.TIMEOUT)))
         
         self.option_theme.set(s.get("appearance", "System"))
@@ -374,6 +4393,46 @@ class SettingsDialog(ctk.CTkToplevel):
 
         self.text_prompt_chat.insert("1.0", s.get("system_prompt_chat", AppConfig.DEFAULT_SYSTEM_PROMPT_CHAT))
 
+        if s.get("cache_enabled", AppConfig.CACHE_ENABLED):
+            self.switch_cache.select()
+        self.entry_cache_entries.insert(0, str(s.get("cache_max_entries", AppConfig.CACHE_MAX_ENTRIES)))
+        self.entry_cache_size.insert(0, str(s.get("cache_max_size_mb", AppConfig.CACHE_MAX_SIZE_MB)))
+        self.entry_cache_age.insert(0, str(s.get("cache_max_age_days", AppConfig.CACHE_MAX_AGE_DAYS)))
+
+        self.entry_pool_size.insert(0, str(s.get("http_pool_size", AppConfig.HTTP_POOL_SIZE)))
+        self.entry_connect_timeout.insert(0, str(s.get("connect_timeout", AppConfig.CONNECT_TIMEOUT)))
+        if s.get("http_compression", AppConfig.HTTP_COMPRESSION):
+            self.switch_compression.select()
+        self.entry_flush_ms.insert(0, str(s.get("stream_flush_ms", AppConfig.STREAM_FLUSH_MS)))
+        if s.get("stream_optimize", AppConfig.STREAM_OPTIMIZE):
+            self.switch_stream_optimize.select()
+        if s.get("stream_usage", AppConfig.STREAM_USAGE):
+            self.switch_stream_usage.select()
+
+        self.entry_history_rows.insert(0, str(s.get("history_max_rows", AppConfig.HISTORY_MAX_ROWS)))
+        self.entry_history_age.insert(0, str(s.get("history_max_age_days", AppConfig.HISTORY_MAX_AGE_DAYS)))
+        self.entry_history_size.insert(0, str(s.get("history_max_db_mb", AppConfig.HISTORY_MAX_DB_MB)))
+
+        for line in s.get("endpoint_pool", []):
+            self.text_endpoint_pool.insert(tk.END, line + "\n")
+        if s.get("hedge_requests", AppConfig.HEDGE_REQUESTS):
+            self.switch_hedge.select()
+        self.entry_job_concurrency.insert(0, str(s.get("job_concurrency", AppConfig.JOB_CONCURRENCY)))
+        if s.get("warmup_enabled", AppConfig.WARMUP_ENABLED):
+            self.switch_warmup.select()
+        self.entry_keep_alive.insert(0, str(s.get("keep_alive", AppConfig.OLLAMA_KEEP_ALIVE)))
+        self.entry_num_thread.insert(0, str(s.get("num_thread", AppConfig.AI_NUM_THREAD)))
+        self.entry_num_gpu.insert(0, str(s.get("num_gpu", AppConfig.AI_NUM_GPU)))
+
+        for path in s.get("schema_paths", []):
+            self.text_schema_paths.insert(tk.END, path + "\n")
+        if s.get("schema_auto_inject", AppConfig.SCHEMA_AUTO_INJECT):
+            self.switch_schema_inject.select()
+        self.entry_schema_budget.insert(0, str(s.get("schema_token_budget", AppConfig.SCHEMA_TOKEN_BUDGET)))
+
+        for line in s.get("compare_targets", []):
+            self.text_compare_targets.insert(tk.END, line + "\n")
+
     def reset_chat_prompt(self):
         self.text_prompt_chat.delete("1.0", tk.END)
         self.text_prompt_chat.insert("1.0", AppConfig.DEFAULT_SYSTEM_PROMPT_CHAT)
@@ -387,7 +4446,9 @@ class SettingsDialog(ctk.CTkToplevel):
             new_settings["api_key"] = self.entry_apikey.get().strip()
             new_settings["model"] = self.entry_model.get().strip()
             new_settings["temperature"] = float(self.entry_temp.get())
-            new_settings["ctx_size"] = int(self.entry_ctx.get())
+            new_settings["api_backend"] = self.selected_backend()
+            new_settings["ctx_size"] = max(0, int(self.entry_ctx.get()))
+            new_settings["max_tokens"] = max(0, int(self.entry_max_tokens.get()))
             new_settings["timeout"] = int(self.entry_timeout.get())
             
             new_settings["appearance"] = self.option_theme.get()
@@ -403,6 +4464,39 @@ class SettingsDialog(ctk.CTkToplevel):
             new_settings["sql_compact_select"] = self.switch_compact_select.get() == 1
 
             new_settings["system_prompt_chat"] = self.text_prompt_chat.get("1.0", tk.END).strip()
+
+            new_settings["cache_enabled"] = self.switch_cache.get() == 1
+            new_settings["cache_max_entries"] = int(self.entry_cache_entries.get())
+            new_settings["cache_max_size_mb"] = float(self.entry_cache_size.get())
+            new_settings["cache_max_age_days"] = float(self.entry_cache_age.get())
+
+            new_settings["http_pool_size"] = max(1, int(self.entry_pool_size.get()))
+            new_settings["connect_timeout"] = float(self.entry_connect_timeout.get())
+            new_settings["http_compression"] = self.switch_compression.get() == 1
+            new_settings["stream_flush_ms"] = min(500, max(5, int(self.entry_flush_ms.get())))
+            new_settings["stream_optimize"] = self.switch_stream_optimize.get() == 1
+            new_settings["stream_usage"] = self.switch_stream_usage.get() == 1
+
+            new_settings["history_max_rows"] = max(0, int(self.entry_history_rows.get()))
+            new_settings["history_max_age_days"] = max(0.0, float(self.entry_history_age.get()))
+            new_settings["history_max_db_mb"] = max(0.0, float(self.entry_history_size.get()))
+
+            new_settings["endpoint_pool"] = [l.strip() for l in self.text_endpoint_pool.get("1.0", tk.END).splitlines() if l.strip()]
+            EndpointPool.parse_entries(new_settings["ollama_url"], new_settings["endpoint_pool"]) # weights must be numbers
+            new_settings["hedge_requests"] = self.switch_hedge.get() == 1
+            new_settings["job_concurrency"] = max(1, int(self.entry_job_concurrency.get()))
+            new_settings["warmup_enabled"] = self.switch_warmup.get() == 1
+            keep_alive = self.entry_keep_alive.get().strip() or AppConfig.OLLAMA_KEEP_ALIVE
+            if not re.fullmatch(r"-?\d+|\d+(?:\.\d+)?(?:ms|s|m|h)", keep_alive):
+                raise ValueError(f"keep_alive must be a duration like 30m or a number of seconds, not {keep_alive!r}")
+            new_settings["keep_alive"] = keep_alive
+            new_settings["num_thread"] = max(0, int(self.entry_num_thread.get()))
+            new_settings["num_gpu"] = max(-1, int(self.entry_num_gpu.get()))
+
+            new_settings["schema_paths"] = [p.strip() for p in self.text_schema_paths.get("1.0", tk.END).splitlines() if p.strip()]
+            new_settings["schema_auto_inject"] = self.switch_schema_inject.get() == 1
+            new_settings["schema_token_budget"] = max(0, int(self.entry_schema_budget.get()))
+            new_settings["compare_targets"] = [l.strip() for l in self.text_compare_targets.get("1.0", tk.END).splitlines() if l.strip()]
             # Save the current list of values from the combobox
             new_settings["available_models"] = self.entry_model.cget("values")
             
@@ -413,6 +4507,88 @@ class SettingsDialog(ctk.CTkToplevel):
         except ValueError as e:
             tk.messagebox.showerror("Invalid Input", f"Please check your inputs (numbers vs text).\nError: {e}")
 
+class StatsDialog(ctk.CTkToplevel):
+    """Latency and throughput percentiles from the history, per model, endpoint or database"""
+    GROUPS = {"Model": "model", "Endpoint": "endpoint", "Database": "db_type"}
+    COLUMNS = [("ttfb_s", "First Byte"), ("first_token_s", "First Token"), ("total_s", "Total"), ("tokens_per_s", "Tokens/s")]
+
+    def __init__(self, parent):
+        super().__init__(parent)
+        self.parent = parent
+        self.title("Performance Stats")
+        self.geometry("900x420")
+        self.transient(parent)
+
+        self.grid_columnconfigure(0, weight=1)
+        self.grid_rowconfigure(1, weight=1)
+
+        self.toolbar = ctk.CTkFrame(self, fg_color="transparent")
+        self.toolbar.grid(row=0, column=0, sticky="ew", padx=20, pady=(20, 5))
+        ctk.CTkLabel(self.toolbar, text="Group by:").pack(side="left")
+        self.group_selector = ctk.CTkSegmentedButton(self.toolbar, values=list(self.GROUPS), command=lambda _: self.refresh())
+        self.group_selector.set("Model")
+        self.group_selector.pack(side="left", padx=10)
+        ctk.CTkButton(self.toolbar, text="Export CSV...", width=110, command=self.export_csv).pack(side="right")
+        ctk.CTkButton(self.toolbar, text="Refresh", width=80, command=self.refresh).pack(side="right", padx=10)
+
+        self.textbox = ctk.CTkTextbox(self, font=(AppConfig.FONT_MONO, 12), wrap="none")
+        self.textbox.grid(row=1, column=0, sticky="nsew", padx=20, pady=5)
+        ctk.CTkLabel(self, text="Seconds, p50 / p95. Answers served from the response cache are not counted.",
+                     font=ctk.CTkFont(size=11, slant="italic")).grid(row=2, column=0, sticky="w", padx=20, pady=(0, 15))
+        self.refresh()
+
+    @staticmethod
+    def cell(p50, p95, digits):
+        if p50 is None:
+            return "-"
+        return f"{p50:.{digits}f} / {p95:.{digits}f}"
+
+    def refresh(self):
+        group_by = self.GROUPS[self.group_selector.get()]
+        self.parent.history_call(lambda hm: hm.telemetry_stats(group_by), lambda stats: self.show_stats(group_by, stats))
+
+    def show_stats(self, group_by, stats):
+        if not self.winfo_exists():
+            return
+        header = f"{self.group_selector.get():<40} {'Requests':>8} {'Retries':>7}"
+        header += "".join(f" {title:>15}" for _, title in self.COLUMNS)
+        lines = [header, "-" * len(header)]
+        for entry in stats or []:
+            name = str(entry[group_by])
+            if len(name) > 40:
+                name = "..." + name[-37:]
+            line = f"{name:<40} {entry['requests']:>8} {entry['retries']:>7}"
+            for metric, _ in self.COLUMNS:
+                digits = 0 if metric == "tokens_per_s" else 2
+                line += f" {self.cell(entry[metric + '_p50'], entry[metric + '_p95'], digits):>15}"
+            lines.append(line)
+        if not stats:
+            lines.append("No timed requests yet.")
+        self.textbox.configure(state="normal")
+        self.textbox.delete("1.0", tk.END)
+        self.textbox.insert("1.0", "\n".join(lines))
+        self.textbox.configure(state="disabled")
+
+    def export_csv(self):
+        path = filedialog.asksaveasfilename(parent=self, defaultextension=".csv", initialfile="querytune_requests.csv",
+                                            filetypes=[("CSV files", "*.csv")])
+        if not path:
+            return
+
+        def export(hm):
+            try:
+                return hm.export_telemetry(path)
+            except Exception as e:
+                return e
+
+        def done(count):
+            if isinstance(count, Exception):
+                messagebox.showerror("Export Failed", str(count), parent=self)
+            else:
+                messagebox.showinfo("Export", f"{count} requests written to {path}", parent=self)
+
+        self.parent.history_call(export, done)
+
 class HelpDialog(ctk.CTkToplevel):
     def __init__(self, parent):
         super().__init__(parent)
@@ -480,36 +4656,97 @@ class HelpDialog(ctk.CTkToplevel):
                                       font=ctk.CTkFont(size=13, underline=True),
                                       anchor="w")
         self.link_label.pack(fill="x", padx=15, pady=(0, 15))
-        self.link_label.bind("<Button-1>", lambda e: webbrowser.open(AppConfig.URL_GITHUB))
+        self.link_label.bind("<Button-1>", lambda e: self.open_url(AppConfig.URL_GITHUB))
 
         self.btn_close = ctk.CTkButton(self, text="Close", command=self.destroy)
         self.btn_close.grid(row=1, column=0, pady=(0, 20))
 
+    @staticmethod
+    def open_url(url):
+        import webbrowser
+        webbrowser.open(url)
+
+class StartupTimer:
+    """Cold-start milestones, in seconds since main.py started importing"""
+    def __init__(self, started):
+        self.started = started
+        self.marks = OrderedDict()
+
+    def mark(self, name):
+        if name not in self.marks: # only the first time counts
+            self.marks[name] = time.perf_counter() - self.started
+
+    @staticmethod
+    def slowest_imports(count=8):
+        """Modules imported by main.py, slowest first, as (name, seconds) from python -X importtime"""
+        if getattr(sys, "frozen", False):
+            return [] # no interpreter to run in a packaged build
+        import subprocess
+        folder = os.path.dirname(os.path.realpath(__file__))
+        proc = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import sys; sys.path.insert(0, {folder!r}); import main"],
+                              capture_output=True, text=True, timeout=120)
+        # Lines are "import time: self | cumulative | name", children first and indented two more spaces
+        rows = []
+        for line in proc.stderr.splitlines():
+            parts = line.split("|")
+            if len(parts) != 3 or not parts[1].strip().isdigit():
+                continue
+            rows.append((len(parts[2]) - len(parts[2].lstrip()), parts[2].strip(), int(parts[1]) / 1e6))
+        main_index = next((i for i, row in enumerate(rows) if row[1] == "main"), None)
+        if main_index is None:
+            return []
+        depth = rows[main_index][0]
+        direct = []
+        for row in reversed(rows[:main_index]):
+            if row[0] <= depth:
+                break # the previous top-level import
+            if row[0] == depth + 2:
+                direct.append((row[1], row[2]))
+        return sorted(direct, key=lambda item: -item[1])[:count]
+
+    def report(self):
+        lines = ["QueryTune cold start (seconds since main.py started importing):"]
+        lines += [f"  {name:<18} {seconds:7.3f}" for name, seconds in self.marks.items()]
+        imports = self.slowest_imports()
+        if imports:
+            lines.append("Slowest imports of main.py (python -X importtime):")
+            lines += [f"  {name:<18} {seconds:7.3f}" for name, seconds in imports]
+        return "\n".join(lines)
+
+startup_timer = StartupTimer(_IMPORT_STARTED)
+
 class QueryTuneApp(ctk.CTk):
-    def __init__(self):
+    def __init__(self, startup_report=False):
         super().__init__()
+        self.startup_report = startup_report
         
         # Default Settings
-        self.settings = {
-            "db_type": AppConfig.DB_OPTIONS[0],
-            "model": AppConfig.DEFAULT_MODEL,
-            "appearance": "System",
-            "ollama_url": AppConfig.OLLAMA_URL,
-            "timeout": AppConfig.TIMEOUT,
-            "temperature": AppConfig.AI_TEMPERATURE,
-            "ctx_size": AppConfig.AI_CTX_SIZE,
-            "font_mono": AppConfig.FONT_MONO,
-            "font_sans": AppConfig.FONT_SANS,
-            "size_query": AppConfig.SIZE_QUERY,
-            "size_indices": AppConfig.SIZE_INDICES,
-            "size_explanation": AppConfig.SIZE_EXPLANATION,
-            "system_prompt_chat": AppConfig.DEFAULT_SYSTEM_PROMPT_CHAT,
-            "available_models": [AppConfig.DEFAULT_MODEL]
-        }
+        self.settings = default_settings()
 
-        self.current_optimization_id = 0
-        self.is_optimizing = False
-        self.history_manager = HistoryManager()
+        self.jobs = OrderedDict()
+        self.job_rows = {}
+        self._job_seq = 0
+        self.selected_job_id = None
+        self.compare_job_id = None
+        self.compare_panes = []
+        self._jobs_tick_id = None
+        self._jobs_busy = False
+        self.scheduler = JobScheduler(self.execute_job, self.job_limit,
+                                      on_change=lambda job: self.after(0, lambda: self.on_job_changed(job)))
+        self.history_manager = HistoryManager(open_db=False) # opened on the history thread
+        self.history_writer = HistoryWriter(self.history_manager)
+        self._history_load_seq = 0
+        self._format_seq = 0
+        self._formatting = False
+        self.response_cache = ResponseCache(open_db=False) # created off the Tk thread in finish_startup
+        self.http_pool = HttpSessionPool()
+        self._http_endpoint = None
+        self.schema_catalog = SchemaCatalog()
+        self.endpoint_pool = EndpointPool(self.http_pool)
+        self.model_warmer = ModelWarmer(self.http_pool,
+                                        on_status=lambda state: self.after(0, lambda: self.show_model_status(state)))
+        self.optimizer = QueryOptimizer(self.settings, self.response_cache, self.http_pool, self.schema_catalog,
+                                        self.endpoint_pool)
 
         self.title(f"{AppConfig.APP_NAME} - AI SQL Optimizer")
         self.geometry("900x850")
@@ -522,8 +4759,58 @@ class QueryTuneApp(ctk.CTk):
         self._init_main_area()
         
         self.load_settings()
-        self.load_history_to_sidebar()
         self.protocol("WM_DELETE_WINDOW", self.on_closing)
+        startup_timer.mark("window built")
+        # Idle callbacks draw the widgets first; the rest of the startup waits for that frame
+        self.after_idle(lambda: self.after(0, self.finish_startup))
+
+    def finish_startup(self):
+        """Startup work that does not need to delay the first frame"""
+        startup_timer.mark("first frame")
+        # Opening can take a while once, when an older database is upgraded
+        self.history_title.configure(text="Opening history...")
+        # Pruned entries disappear from the sidebar on its next refresh
+        self.history_call(lambda hm: hm.init_db(), lambda _: self.history_manager.start_pruning(
+            on_pruned=lambda n: self.after(0, self.load_history_to_sidebar)))
+        self.load_history_to_sidebar()
+        self.history_call(lambda hm: None, lambda _: self.on_history_ready())
+        threading.Thread(target=self.response_cache.init_db, daemon=True).start()
+        self.endpoint_pool.start_health_checks()
+        self.model_warmer.start()
+        self.refresh_model_list()
+
+    def on_history_ready(self):
+        startup_timer.mark("history loaded")
+        self.history_title.configure(text="Recent Activity:")
+        if self.startup_report:
+            print(startup_timer.report(), flush=True)
+            self.history_writer.close()
+            self.history_manager.close()
+            self.destroy()
+
+    def refresh_model_list(self):
+        """List the models installed on the Ollama server in the sidebar (the saved list stays as it is)"""
+        url = self.settings.get("ollama_url", AppConfig.OLLAMA_URL)
+        if chat_backend(self.settings, url).name != "ollama":
+            return
+
+        def fetch():
+            try:
+                response = self.http_pool.get(ModelWarmer.ollama_base(url) + "/api/tags", self.http_pool.connect_timeout)
+                response.raise_for_status()
+                models = [m["name"] for m in response.json().get("models", [])]
+            except Exception:
+                return # offline: keep the saved list
+            if models:
+                self.after(0, lambda: self.show_model_list(models))
+
+        threading.Thread(target=fetch, daemon=True).start()
+
+    def show_model_list(self, models):
+        current = self.model_entry.get()
+        if current and current not in models:
+            models = [current] + models # a model pulled later or served elsewhere stays selectable
+        self.model_entry.configure(values=models)
 
     def _create_menu(self):
         menubar = tk.Menu(self)
@@ -538,6 +4825,10 @@ class QueryTuneApp(ctk.CTk):
         help_menu = tk.Menu(menubar, tearoff=0)
         menubar.add_cascade(label="Help", menu=help_menu)
         help_menu.add_command(label="Usage Guide", command=self.show_help)
+
+        view_menu = tk.Menu(menubar, tearoff=0)
+        menubar.add_cascade(label="View", menu=view_menu)
+        view_menu.add_command(label="Performance Stats", command=self.show_stats)
         
         # If not on macOS, add About and Preferences to menus
         if platform.system() != "Darwin":
@@ -563,7 +4854,10 @@ class QueryTuneApp(ctk.CTk):
         )
 
     def show_help(self):
-        webbrowser.open(AppConfig.URL_DOCS)
+        HelpDialog.open_url(AppConfig.URL_DOCS)
+
+    def show_stats(self):
+        StatsDialog(self)
     
     def _init_sidebar(self):
         self.sidebar_frame = ctk.CTkFrame(self, width=220, corner_radius=0)
@@ -572,6 +4866,7 @@ class QueryTuneApp(ctk.CTk):
 
         try:
             image_path = resource_path(os.path.join("assets", "icon.png"))
+            from PIL import Image
             self.logo_image = ctk.CTkImage(Image.open(image_path), size=(60, 60))
             self.logo_image_label = ctk.CTkLabel(self.sidebar_frame, text="", image=self.logo_image)
             self.logo_image_label.grid(row=0, column=0, padx=20, pady=(20, 0))
@@ -586,25 +4881,70 @@ class QueryTuneApp(ctk.CTk):
         self.db_optionemenu = ctk.CTkOptionMenu(self.sidebar_frame, values=AppConfig.DB_OPTIONS)
         self.db_optionemenu.grid(row=3, column=0, padx=20, pady=5)
 
-        self.model_label = ctk.CTkLabel(self.sidebar_frame, text="Model:", anchor="w")
-        self.model_label.grid(row=4, column=0, padx=20, pady=(10, 0))
-        self.model_entry = ctk.CTkComboBox(self.sidebar_frame, values=[AppConfig.DEFAULT_MODEL])
+        self.model_header = ctk.CTkFrame(self.sidebar_frame, fg_color="transparent")
+        self.model_header.grid(row=4, column=0, padx=20, pady=(10, 0))
+        self.model_label = ctk.CTkLabel(self.model_header, text="Model:", anchor="w")
+        self.model_label.pack(side="left")
+        self.model_status_label = ctk.CTkLabel(self.model_header, text="", font=ctk.CTkFont(size=11))
+        self.model_status_label.pack(side="left", padx=(6, 0))
+        self.model_entry = ctk.CTkComboBox(self.sidebar_frame, values=[AppConfig.DEFAULT_MODEL], command=self.on_model_change)
         self.model_entry.set(AppConfig.DEFAULT_MODEL)
         self.model_entry.grid(row=5, column=0, padx=20, pady=5)
+        self.model_entry.bind("<Return>", self.on_model_change)
+        self.model_entry.bind("<FocusOut>", self.on_model_change)
 
         # History Section
-        self.history_title = ctk.CTkLabel(self.sidebar_frame, text="Recent Activity:", font=ctk.CTkFont(weight="bold"))
-        self.history_title.grid(row=6, column=0, padx=20, pady=(20, 5), sticky="w")
+        self.history_page = 0
+        self._search_after_id = None
+        self.history_tools_frame = ctk.CTkFrame(self.sidebar_frame, fg_color="transparent")
+        self.history_tools_frame.grid(row=6, column=0, padx=15, pady=(20, 5), sticky="ew")
+        self.history_tools_frame.grid_columnconfigure((0, 1), weight=1)
+
+        self.history_title = ctk.CTkLabel(self.history_tools_frame, text="Recent Activity:", font=ctk.CTkFont(weight="bold"))
+        self.history_title.grid(row=0, column=0, columnspan=2, padx=5, sticky="w")
+
+        self.history_search_entry = ctk.CTkEntry(self.history_tools_frame, placeholder_text="Search history...", height=26)
+        self.history_search_entry.grid(row=1, column=0, columnspan=2, padx=5, pady=(5, 2), sticky="ew")
+        self.history_search_entry.bind("<KeyRelease>", self.on_history_search)
+
+        filter_font = ctk.CTkFont(size=11)
+        self.history_mode_filter = ctk.CTkOptionMenu(self.history_tools_frame, values=["All modes", "Optimize", "Chat"],
+                                                     width=80, height=22, font=filter_font, command=self.apply_history_search)
+        self.history_mode_filter.grid(row=2, column=0, padx=(5, 2), pady=2, sticky="ew")
+        self.history_db_filter = ctk.CTkOptionMenu(self.history_tools_frame, values=["All databases"] + AppConfig.DB_OPTIONS,
+                                                   width=80, height=22, font=filter_font, command=self.apply_history_search)
+        self.history_db_filter.grid(row=2, column=1, padx=(2, 5), pady=2, sticky="ew")
+        self.history_model_filter = ctk.CTkOptionMenu(self.history_tools_frame, values=["All models"],
+                                                      height=22, font=filter_font, command=self.apply_history_search)
+        self.history_model_filter.grid(row=3, column=0, columnspan=2, padx=5, pady=2, sticky="ew")
+        self.history_group_check = ctk.CTkCheckBox(self.history_tools_frame, text="Group repeated queries", font=filter_font,
+                                                   checkbox_width=16, checkbox_height=16, command=self.toggle_history_grouping)
+        self.history_group_check.grid(row=4, column=0, columnspan=2, padx=5, pady=(4, 2), sticky="w")
         
-        self.history_frame = ctk.CTkScrollableFrame(self.sidebar_frame, fg_color="transparent")
-        self.history_frame.grid(row=7, column=0, padx=5, pady=0, sticky="nsew")
+        self.history_list = VirtualHistoryList(self.sidebar_frame, on_open=self.load_history_item,
+                                               on_delete=self.delete_history_item, fg_color="transparent")
+        self.history_list.grid(row=7, column=0, padx=5, pady=0, sticky="nsew")
+
+        self.history_footer = ctk.CTkFrame(self.sidebar_frame, fg_color="transparent")
+        self.history_footer.grid(row=8, column=0, padx=20, pady=(5, 10))
+
+        self.pager_frame = ctk.CTkFrame(self.history_footer, fg_color="transparent")
+        self.pager_frame.pack(pady=(0, 5))
+        self.prev_page_btn = ctk.CTkButton(self.pager_frame, text="◀", width=28, height=22,
+                                           command=lambda: self.change_history_page(-1))
+        self.prev_page_btn.pack(side="left")
+        self.page_label = ctk.CTkLabel(self.pager_frame, text="Page 1", width=70, font=ctk.CTkFont(size=11))
+        self.page_label.pack(side="left")
+        self.next_page_btn = ctk.CTkButton(self.pager_frame, text="▶", width=28, height=22,
+                                           command=lambda: self.change_history_page(1))
+        self.next_page_btn.pack(side="left")
 
-        self.clear_btn = ctk.CTkButton(self.sidebar_frame, text="Clear All History", command=self.clear_all_history,
+        self.clear_btn = ctk.CTkButton(self.history_footer, text="Clear All History", command=self.clear_all_history,
                                        height=24, font=ctk.CTkFont(size=11), 
                                        fg_color="transparent", border_width=1,
                                        text_color=("#C0392B", "#E74C3C"), border_color=("#C0392B", "#E74C3C"),
                                        hover_color=("#FADBD8", "#442222"))
-        self.clear_btn.grid(row=8, column=0, padx=20, pady=10)
+        self.clear_btn.pack()
 
         self.appearance_mode_label = ctk.CTkLabel(self.sidebar_frame, text="Appearance:", anchor="w")
         self.appearance_mode_label.grid(row=9, column=0, padx=20, pady=(10, 0))
@@ -614,42 +4954,131 @@ class QueryTuneApp(ctk.CTk):
         self.appearance_mode_optionemenu.grid(row=10, column=0, padx=20, pady=(5, 20))
 
 
+    # Model residency shown next to the "Model:" label
+    MODEL_STATUS = {
+        "loaded": ("● loaded", ("#16A34A", "#4ADE80")),
+        "loading": ("◌ loading...", ("#D97706", "#FBBF24")),
+        "unloaded": ("○ not loaded", ("gray40", "gray60")),
+        "offline": ("○ offline", ("#C0392B", "#E74C3C"))
+    }
+
+    def show_model_status(self, state):
+        text, color = self.MODEL_STATUS.get(state, ("", ("gray40", "gray60")))
+        self.model_status_label.configure(text=text, text_color=color)
+
+    def on_model_change(self, *args):
+        model = self.model_entry.get().strip()
+        if model and model != self.settings.get("model"):
+            self.settings["model"] = model
+            self.update_model_warmer()
+
+    def update_model_warmer(self):
+        s = self.settings
+        self.model_warmer.configure(
+            [e["url"] for e in self.endpoint_pool.stats()],
+            s.get("model", AppConfig.DEFAULT_MODEL),
+            s.get("keep_alive", AppConfig.OLLAMA_KEEP_ALIVE),
+            s.get("warmup_enabled", AppConfig.WARMUP_ENABLED),
+            int(s.get("timeout", AppConfig.TIMEOUT))
+        )
+
+    def on_history_search(self, event=None):
+        # Debounce: search once typing pauses
+        if self._search_after_id is not None:
+            self.after_cancel(self._search_after_id)
+        self._search_after_id = self.after(250, self.apply_history_search)
+
+    def apply_history_search(self, *args):
+        self._search_after_id = None
+        self.history_page = 0
+        self.load_history_to_sidebar()
+
+    def toggle_history_grouping(self):
+        self.settings["history_group_queries"] = bool(self.history_group_check.get())
+        self.apply_history_search()
+
+    def change_history_page(self, delta):
+        self.history_page = max(0, self.history_page + delta)
+        self.load_history_to_sidebar()
+
+    def history_filters(self):
+        mode = {"Optimize": "optimize", "Chat": "explain"}.get(self.history_mode_filter.get())
+        db_type = self.history_db_filter.get()
+        model = self.history_model_filter.get()
+        return (mode,
+                None if db_type == "All databases" else db_type,
+                None if model == "All models" else model)
+
+    def history_call(self, func, on_done=None):
+        """Run func(history_manager) on the history thread and on_done(result) back on the Tk thread"""
+        callback = None
+        if on_done is not None:
+            callback = lambda result: self.after(0, lambda: on_done(result))
+        self.history_writer.call(func, callback)
+
+    def save_history(self, **entry):
+        """Queue an entry for the history thread; it shows up in the sidebar once committed"""
+        self.history_writer.save(entry, lambda summary: self.after(0, lambda: self.add_history_entry(summary)))
+
     def load_history_to_sidebar(self):
-        # Clear current list
-        for widget in self.history_frame.winfo_children():
-            widget.destroy()
-        
-        items = self.history_manager.get_all()
-        for item in items:
-            self._add_history_card(item)
+        mode, db_type, model = self.history_filters()
+        text = self.history_search_entry.get()
+        page = self.history_page
+        page_size = AppConfig.HISTORY_PAGE_SIZE
+        group = bool(self.settings.get("history_group_queries", AppConfig.HISTORY_GROUP_QUERIES))
+        self._history_load_seq += 1
+        seq = self._history_load_seq
 
-    def _add_history_card(self, item):
-        card = ctk.CTkFrame(self.history_frame, fg_color=("gray90", "gray20"), corner_radius=6)
-        card.pack(fill="x", padx=5, pady=3)
-        
-        # Clickable area
-        mode_icon = "🪄" if item['request_mode'] == 'optimize' else "💬"
-        timestamp = datetime.strptime(item['timestamp'], "%Y-%m-%d %H:%M:%S").strftime("%d %b %H:%M")
-        
-        title_btn = ctk.CTkButton(card, text=f"{mode_icon} {timestamp}", 
-                                  anchor="w", fg_color="transparent", text_color=("black", "white"),
-                                  hover_color=("gray80", "gray30"), height=24,
-                                  command=lambda i=item: self.load_history_item(i))
-        title_btn.pack(side="top", fill="x", padx=2, pady=(2, 0))
-        
-        # Preview text
-        preview = (item['query_input'][:40] + "...") if len(item['query_input']) > 40 else item['query_input']
-        preview_label = ctk.CTkLabel(card, text=preview, font=ctk.CTkFont(size=10), 
-                                     text_color="gray", anchor="w")
-        preview_label.pack(side="top", fill="x", padx=10, pady=(0, 2))
-        
-        # Delete button
-        del_btn = ctk.CTkButton(card, text="×", width=20, height=20, fg_color="transparent", 
-                                hover_color="#C0392B", text_color="gray",
-                                command=lambda i=item['id']: self.delete_history_item(i))
-        del_btn.place(relx=0.9, rely=0.1, anchor="center")
+        def query(hm):
+            # One extra row tells whether there is a next page
+            items = hm.search(text, db_type=db_type, model=model, mode=mode,
+                              limit=page_size + 1, offset=page * page_size, group=group)
+            return items, hm.get_distinct("model")
+
+        def show(result):
+            if seq != self._history_load_seq or result is None:
+                return # a newer search or page is on its way
+            items, models = result
+            self.history_list.set_items(items[:page_size])
+            self.page_label.configure(text=f"Page {page + 1}")
+            self.prev_page_btn.configure(state="normal" if page > 0 else "disabled")
+            self.next_page_btn.configure(state="normal" if len(items) > page_size else "disabled")
+            self.history_model_filter.configure(values=["All models"] + models)
+
+        self.history_call(query, show)
+
+    def add_history_entry(self, summary):
+        """Show a newly saved entry at the top of the list without reloading it"""
+        if summary is None:
+            return
+        # Only the first page of the unfiltered-by-text view shows new entries
+        if self.history_page > 0 or self.history_search_entry.get().strip():
+            return
+        mode, db_type, model = self.history_filters()
+        if (mode and summary['request_mode'] != mode) or (db_type and summary['db_type'] != db_type) \
+                or (model and summary['model'] != model):
+            return
+        if self.settings.get("history_group_queries", AppConfig.HISTORY_GROUP_QUERIES):
+            self.load_history_to_sidebar() # the entry may join a group further down
+            return
+
+        self.history_list.insert_item(0, summary)
+        if len(self.history_list) > AppConfig.HISTORY_PAGE_SIZE:
+            self.history_list.remove_item(self.history_list.items[-1]['id'])
+            self.next_page_btn.configure(state="normal")
+
+        models = list(self.history_model_filter.cget("values"))
+        if summary['model'] and summary['model'] not in models:
+            self.history_model_filter.configure(values=models + [summary['model']])
+
+    def load_history_item(self, item_id):
+        self.history_call(lambda hm: hm.get_item(item_id), self.show_history_item)
+
+    def show_history_item(self, item):
+        if item is None:
+            return
+        self.select_job(None) # running jobs stop drawing into the result tabs
 
-    def load_history_item(self, item):
         # Populate inputs
         self.input_text.delete("1.0", tk.END)
         self.input_text.insert("1.0", item['query_input'])
@@ -668,6 +5097,7 @@ class QueryTuneApp(ctk.CTk):
         
         self.db_optionemenu.set(item['db_type'])
         self.model_entry.set(item['model'])
+        self.on_model_change()
 
         if item['request_mode'] == 'optimize':
             self.output_query.insert("1.0", item['result_sql'] or "")
@@ -680,12 +5110,14 @@ class QueryTuneApp(ctk.CTk):
         self.tabview.set("Analysis")
 
     def delete_history_item(self, item_id):
-        self.history_manager.delete_item(item_id)
-        self.load_history_to_sidebar()
+        self.history_call(lambda hm: hm.delete_item(item_id))
+        self.history_list.remove_item(item_id)
+        if len(self.history_list) == 0 and self.history_page > 0:
+            self.change_history_page(-1)
 
     def clear_all_history(self):
         if messagebox.askyesno("Confirm", "Clear all history?"):
-            self.history_manager.clear_all()
+            self.history_call(lambda hm: hm.clear_all())
             self.load_history_to_sidebar()
 
 
@@ -693,9 +5125,9 @@ class QueryTuneApp(ctk.CTk):
         self.main_frame = ctk.CTkFrame(self, corner_radius=0)
         self.main_frame.grid(row=0, column=1, sticky="nsew", padx=20, pady=20)
         self.main_frame.grid_columnconfigure(0, weight=1)
-        # Row layout: 0=Labels, 1=Input, 2=Context, 3=Buttons, 4=Tabs, 5=Progress
+        # Row layout: 0=Labels, 1=Input, 2=Context, 3=Buttons, 4=Jobs, 5=Tabs, 6=Progress
         self.main_frame.grid_rowconfigure(1, weight=1) 
-        self.main_frame.grid_rowconfigure(4, weight=3)
+        self.main_frame.grid_rowconfigure(5, weight=3)
 
         # Header Frame for Label + Context Switch
         self.header_frame = ctk.CTkFrame(self.main_frame, fg_color="transparent")
@@ -715,6 +5147,8 @@ class QueryTuneApp(ctk.CTk):
         # Input Query
         self.input_text = ctk.CTkTextbox(self.main_frame, undo=True, font=(AppConfig.FONT_MONO, AppConfig.SIZE_QUERY))
         self.input_text.grid(row=1, column=0, sticky="nsew", pady=5)
+        self.input_text.bind("<<Modified>>", self.on_input_modified)
+        self.input_highlighter = SqlHighlighter(self.input_text)
         
         # Context Frame (Initially hidden)
         self.context_frame = ctk.CTkFrame(self.main_frame, fg_color="transparent")
@@ -726,37 +5160,68 @@ class QueryTuneApp(ctk.CTk):
         self.context_text.pack(fill="x", pady=5)
 
         # Buttons
-        self.button_frame = ctk.CTkFrame(self.main_frame, fg_color="transparent", height=50)
-        self.button_frame.grid(row=3, column=0, pady=10, sticky="ew")
+        self.button_frame = ctk.CTkFrame(self.main_frame, fg_color="transparent", height=80)
+        self.button_frame.grid(row=3, column=0, pady=(10, 5), sticky="ew")
         
         # Center Buttons Container
         self.center_btn_frame = ctk.CTkFrame(self.button_frame, fg_color="transparent")
-        self.center_btn_frame.place(relx=0.5, rely=0.5, anchor="center")
+        self.center_btn_frame.place(relx=0.5, rely=0.0, anchor="n")
 
         self.optimize_button = ctk.CTkButton(self.center_btn_frame, text="Optimize", 
-                                             command=lambda: self.start_optimization_thread("optimize"), 
+                                             command=lambda: self.submit_job("optimize"), 
                                              width=140, height=40, font=ctk.CTkFont(size=14, weight="bold"))
         self.optimize_button.pack(side="left", padx=10)
 
         self.explain_button = ctk.CTkButton(self.center_btn_frame, text="Chat mode", 
-                                            command=lambda: self.start_optimization_thread("explain"),
+                                            command=lambda: self.submit_job("explain"),
                                             fg_color="#2980B9", hover_color="#3498DB",
                                             width=140, height=40, font=ctk.CTkFont(size=14, weight="bold"))
         self.explain_button.pack(side="left", padx=10)
 
+        self.compare_button = ctk.CTkButton(self.center_btn_frame, text="Compare",
+                                            command=lambda: self.submit_job("compare"),
+                                            fg_color="#7D3C98", hover_color="#9B59B6",
+                                            width=140, height=40, font=ctk.CTkFont(size=14, weight="bold"))
+        self.compare_button.pack(side="left", padx=10)
+
         self.stop_button = ctk.CTkButton(self.button_frame, text="Stop", command=self.stop_optimization, 
                                          fg_color="#C0392B", hover_color="#E74C3C", width=80, state="disabled")
-        self.stop_button.pack(side="right", padx=0)
+        self.stop_button.place(relx=1.0, rely=1.0, anchor="se")
+
+        # Options applied to the next submitted job
+        self.run_options_frame = ctk.CTkFrame(self.button_frame, fg_color="transparent")
+        self.run_options_frame.place(relx=0.5, rely=1.0, anchor="s")
+
+        self.bypass_cache_check = ctk.CTkCheckBox(self.run_options_frame, text="Bypass cache",
+                                                  font=ctk.CTkFont(size=11), checkbox_width=18, checkbox_height=18)
+        self.bypass_cache_check.pack(side="left", padx=0)
+
+        self.race_check = ctk.CTkCheckBox(self.run_options_frame, text="Race",
+                                          font=ctk.CTkFont(size=11), checkbox_width=18, checkbox_height=18)
+        self.race_check.pack(side="left", padx=10)
+
+        self.priority_menu = ctk.CTkOptionMenu(self.run_options_frame, values=list(AppConfig.JOB_PRIORITIES),
+                                               width=120, height=22, font=ctk.CTkFont(size=11))
+        self.priority_menu.set("Normal priority")
+        self.priority_menu.pack(side="left")
+
+        # Job queue (shown once something has been submitted)
+        self.jobs_frame = ctk.CTkScrollableFrame(self.main_frame, height=70, label_text="Jobs",
+                                                 label_font=ctk.CTkFont(size=11, weight="bold"))
+        self.jobs_frame.grid(row=4, column=0, sticky="ew", pady=(0, 5))
+        self.jobs_frame.grid_remove()
 
         # Output Tabs
         self.tabview = ctk.CTkTabview(self.main_frame)
-        self.tabview.grid(row=4, column=0, sticky="nsew")
+        self.tabview.grid(row=5, column=0, sticky="nsew")
         self.tabview.add("Optimized Query")
         self.tabview.add("Index Suggestions")
         self.tabview.add("Analysis")
+        self.tabview.add("Compare")
 
         self.output_query = ctk.CTkTextbox(self.tabview.tab("Optimized Query"), font=(AppConfig.FONT_MONO, AppConfig.SIZE_QUERY))
         self.output_query.pack(fill="both", expand=True, padx=5, pady=5)
+        self.output_highlighter = SqlHighlighter(self.output_query)
         self.copy_query_btn = ctk.CTkButton(self.tabview.tab("Optimized Query"), text="Copy Query", 
                                             command=lambda: self.copy_to_clipboard(self.output_query.get("1.0", tk.END)))
         self.copy_query_btn.pack(pady=5)
@@ -773,8 +5238,20 @@ class QueryTuneApp(ctk.CTk):
                                            command=lambda: self.copy_to_clipboard(self.output_explanation.get("1.0", tk.END)))
         self.copy_expl_btn.pack(pady=5)
 
+        self.compare_frame = ctk.CTkFrame(self.tabview.tab("Compare"), fg_color="transparent")
+        self.compare_frame.pack(fill="both", expand=True)
+        ctk.CTkLabel(self.compare_frame, text="Add models under Settings > Compare, then click Compare\nto run the query on all of them side by side.",
+                     font=ctk.CTkFont(size=12, slant="italic")).pack(expand=True)
+
+        self.stream_renderer = StreamRenderer(self.output_explanation)
+        self.field_renderers = {
+            "optimized_query": StreamRenderer(self.output_query),
+            "indices": StreamRenderer(self.output_indices),
+            "explanation": self.stream_renderer
+        }
+
         self.progressbar = ctk.CTkProgressBar(self.main_frame)
-        self.progressbar.grid(row=5, column=0, sticky="ew", pady=10)
+        self.progressbar.grid(row=6, column=0, sticky="ew", pady=10)
         self.progressbar.set(0)
         self.progressbar.grid_remove()
 
@@ -787,117 +5264,69 @@ class QueryTuneApp(ctk.CTk):
             self.main_frame.grid_rowconfigure(1, weight=2) # Input grows back
 
     def align_sql_keywords(self, sql):
-        """Advanced post-processing for soft right-alignment using nesting levels"""
-        import re
-        s = self.settings
-        indent_width = s.get("sql_indent_width", 2)
-        compact_select = s.get("sql_compact_select", False)
-
-        # Offsets to achieve end-alignment at column 6 (length of SELECT)
-        # adjusted based on indent_width if needed, but usually 
-        # relative to the SELECT anchor.
-        offsets = {
-            'FROM': 2, 'JOIN': 2, 'LEFT': 2, 'RIGHT': 2, 'INNER': 2,
-            'WHERE': 1, 'AND': 3, 'OR': 4, 'ON': 4,
-            'GROUP': 1, 'ORDER': 1, 'HAVING': 1, 'LIMIT': 1,
-            'SET': 3, 'VALUES': 0, 'INSERT': 0, 'UPDATE': 0, 'DELETE': 0
-        }
-        
-        lines = sql.split('\n')
-        
-        # Compact SELECT logic: if enabled, try to join lines between SELECT and next keyword
-        if compact_select:
-            new_lines = []
-            buf = []
-            in_select = False
-            for line in lines:
-                up = line.strip().upper()
-                if up.startswith('SELECT'):
-                    in_select = True
-                    buf.append(line.strip())
-                elif in_select and any(up.startswith(k) for k in offsets):
-                    new_lines.append(" ".join(buf))
-                    buf = [line]
-                    in_select = False
-                elif in_select:
-                    buf.append(line.strip())
-                else:
-                    new_lines.append(line)
-            if buf:
-                new_lines.append(" ".join(buf) if in_select else buf[0])
-            lines = new_lines
-
-        aligned_lines = []
-        nesting_level = 0
-        
-        for line in lines:
-            stripped = line.lstrip()
-            if not stripped:
-                aligned_lines.append("")
-                continue
-                
-            # Detect subquery start/end
-            is_subquery_start = stripped.startswith('(') and 'SELECT' in stripped.upper()
-            
-            # If the line starts with a closing paren, we are exiting a level
-            if stripped.startswith(')'):
-                nesting_level = max(0, nesting_level - 1)
-            
-            # Base indentation
-            current_base = nesting_level * (indent_width + 1)
-            
-            # Get the first word (handling the starting '(' for subqueries)
-            first_word = stripped.split()[0].upper().replace('(', '')
-            
-            if is_subquery_start:
-                new_indent = (nesting_level * (indent_width + 1)) + indent_width
-                new_line = (" " * new_indent) + stripped
-                if ')' not in stripped:
-                    nesting_level += 1
-            elif first_word in offsets:
-                new_indent = current_base + offsets[first_word]
-                new_line = (" " * new_indent) + stripped
-            elif first_word == 'SELECT':
-                new_line = (" " * current_base) + stripped
-            else:
-                # Continuation line
-                new_indent = current_base + 7
-                new_line = (" " * new_indent) + stripped
-            
-            if ')' in stripped and not stripped.startswith(')'):
-                nesting_level = max(0, nesting_level - stripped.count(')'))
-                
-            aligned_lines.append(new_line)
-            
-        return '\n'.join(aligned_lines)
+        return align_sql_keywords(sql, self.settings)
 
     def format_input_query(self):
         query = self.input_text.get("1.0", tk.END).strip()
-        if query:
+        if not query:
+            return
+
+        s = self.settings
+        options = dict(
+            keyword_case=s.get("sql_keyword_case", "upper"),
+            indent_width=s.get("sql_indent_width", 2),
+            comma_first=s.get("sql_comma_first", False)
+        )
+        self._format_seq += 1
+        seq = self._format_seq
+
+        formatted = format_cache.get(FormatCache.make_key(query, s, **options))
+        if formatted is not None:
+            self.apply_formatted_input(formatted, seq)
+            return
+
+        # Format on a worker; editing the text meanwhile cancels it
+        self._formatting = True
+        self.format_button.configure(text="Formatting...", state="disabled")
+
+        def work():
             try:
-                s = self.settings
-                formatted_sql = sqlparse.format(
-                    query, 
-                    reindent=True, 
-                    keyword_case=s.get("sql_keyword_case", "upper"),
-                    indent_width=s.get("sql_indent_width", 2),
-                    comma_first=s.get("sql_comma_first", False)
-                )
-                formatted_sql = self.align_sql_keywords(formatted_sql)
-                self.input_text.delete("1.0", tk.END)
-                self.input_text.insert("1.0", formatted_sql)
+                formatted = format_sql(query, s, is_cancelled=lambda: seq != self._format_seq, **options)
             except Exception as e:
                 print(f"Format error: {e}")
+                formatted = None
+            self.after(0, lambda: self.apply_formatted_input(formatted, seq))
+
+        threading.Thread(target=work, daemon=True).start()
+
+    def apply_formatted_input(self, formatted, seq):
+        if seq != self._format_seq:
+            return # the text changed or a newer Format is running
+        self.reset_format_button()
+        if formatted is None:
+            return
+        self.input_text.delete("1.0", tk.END)
+        self.input_text.insert("1.0", formatted)
+
+    def reset_format_button(self):
+        if self._formatting:
+            self._formatting = False
+            self.format_button.configure(text="Format SQL", state="normal")
+
+    def on_input_modified(self, event=None):
+        if not self.input_text.edit_modified():
+            return
+        self.input_text.edit_modified(False)
+        if self._formatting:
+            self._format_seq += 1
+            self.reset_format_button()
 
     def change_appearance_mode_event(self, new_appearance_mode: str):
         ctk.set_appearance_mode(new_appearance_mode)
 
     def load_settings(self):
         try:
-            if os.path.exists(AppConfig.SETTINGS_FILE):
-                with open(AppConfig.SETTINGS_FILE, 'r') as f:
-                    loaded = json.load(f)
-                    self.settings.update(loaded)
+            load_settings_file(self.settings)
             self.apply_settings()
         except Exception as e:
             print(f"Failed to load settings: {e}")
@@ -928,6 +5357,11 @@ class QueryTuneApp(ctk.CTk):
         self.model_entry.configure(values=models)
         self.model_entry.set(s.get("model", AppConfig.DEFAULT_MODEL))
         
+        if s.get("history_group_queries", AppConfig.HISTORY_GROUP_QUERIES):
+            self.history_group_check.select()
+        else:
+            self.history_group_check.deselect()
+
         mode = s.get("appearance", "System")
         self.appearance_mode_optionemenu.set(mode)
         ctk.set_appearance_mode(mode)
@@ -942,281 +5376,528 @@ class QueryTuneApp(ctk.CTk):
         self.output_indices.configure(font=font_indices)
         self.output_explanation.configure(font=font_expl)
 
+        self.response_cache.configure(
+            s.get("cache_max_entries", AppConfig.CACHE_MAX_ENTRIES),
+            s.get("cache_max_size_mb", AppConfig.CACHE_MAX_SIZE_MB),
+            s.get("cache_max_age_days", AppConfig.CACHE_MAX_AGE_DAYS)
+        )
+
+        # Keep warm connections unless the endpoint or its credentials changed
+        endpoint = (s.get("ollama_url", AppConfig.OLLAMA_URL), s.get("api_key", ""))
+        if endpoint != self._http_endpoint:
+            self._http_endpoint = endpoint
+            self.http_pool.reset()
+        self.http_pool.configure(
+            s.get("http_pool_size", AppConfig.HTTP_POOL_SIZE),
+            s.get("connect_timeout", AppConfig.CONNECT_TIMEOUT),
+            s.get("http_compression", AppConfig.HTTP_COMPRESSION)
+        )
+        try:
+            entries = EndpointPool.parse_entries(s.get("ollama_url", AppConfig.OLLAMA_URL), s.get("endpoint_pool", []))
+        except ValueError as e:
+            print(f"Invalid endpoint pool: {e}")
+            entries = EndpointPool.parse_entries(s.get("ollama_url", AppConfig.OLLAMA_URL), [])
+        self.endpoint_pool.configure(entries, s.get("api_key", ""))
+        self.scheduler.dispatch() # a higher job limit may free slots
+        self.update_model_warmer()
+
+        for renderer in self.field_renderers.values():
+            renderer.interval_ms = int(s.get("stream_flush_ms", AppConfig.STREAM_FLUSH_MS))
+
+        self.history_manager.set_retention(
+            s.get("history_max_rows", AppConfig.HISTORY_MAX_ROWS),
+            s.get("history_max_age_days", AppConfig.HISTORY_MAX_AGE_DAYS),
+            s.get("history_max_db_mb", AppConfig.HISTORY_MAX_DB_MB)
+        )
+
+        # Parsing a large schema takes a while the first time
+        schema_paths = list(s.get("schema_paths", []))
+        if schema_paths != self.schema_catalog.paths:
+            threading.Thread(target=self.schema_catalog.load, args=(schema_paths,), daemon=True).start()
+
     def on_closing(self):
+        # Let the servers stop generating for jobs nobody will see
+        for job in self.jobs.values():
+            if job["status"] in ("queued", "running"):
+                self.scheduler.cancel(job)
         self.save_settings()
+        self.history_writer.close() # commits what is still queued
+        self.history_manager.close()
         self.destroy()
 
-    def start_optimization_thread(self, mode="optimize"):
+    def job_limit(self, url):
+        """Jobs allowed to run at once on an endpoint; the main URL counts for its whole pool"""
+        limit = max(1, int(self.settings.get("job_concurrency", AppConfig.JOB_CONCURRENCY)))
+        if url == self.settings.get("ollama_url", AppConfig.OLLAMA_URL):
+            limit *= max(1, len(self.endpoint_pool))
+        return limit
+
+    def submit_job(self, mode="optimize"):
         query = self.input_text.get("1.0", tk.END).strip()
         context = self.context_text.get("1.0", tk.END).strip()
-        
         if not query:
             return
 
-        self.last_query = query
-        self.last_context = context
-        self.last_mode = mode
-        self.full_response_content = "" # For streaming chat
-
-        self.optimize_button.configure(state="disabled")
-        self.explain_button.configure(state="disabled")
-        self.stop_button.configure(state="normal")
-        self.progressbar.grid()
-        self.progressbar.configure(mode="indeterminate")
-        self.progressbar.start()
-        
-        # Clear previous outputs
-        self.output_query.delete("1.0", tk.END)
-        self.output_indices.delete("1.0", tk.END)
-        self.output_explanation.delete("1.0", tk.END)
+        job = {
+            "mode": mode,
+            "query": query,
+            "context": context,
+            "db_type": self.db_optionemenu.get(),
+            "model": self.model_entry.get() or self.settings.get("model", AppConfig.DEFAULT_MODEL),
+            "url": self.settings.get("ollama_url", AppConfig.OLLAMA_URL),
+            "use_cache": self.settings.get("cache_enabled", AppConfig.CACHE_ENABLED) and self.bypass_cache_check.get() == 0,
+            "store_cache": self.settings.get("cache_enabled", AppConfig.CACHE_ENABLED), # a bypass refreshes the entry
+            "priority": AppConfig.JOB_PRIORITIES.get(self.priority_menu.get(), 0),
+            "cancel_token": CancelToken(),
+            "lock": threading.Lock(), # guards the streamed text below against the Tk thread
+            "received": 0,
+            "chunks": [],
+            "fields": {},
+            "text": "",
+            "formatted": None
+        }
+        if mode == "compare":
+            targets = ModelFanout.parse_targets(self.settings.get("compare_targets", []))
+            if not targets:
+                messagebox.showinfo("Compare", "Add the models to compare under Preferences > Compare first.")
+                return
+            job.update(targets=targets, race=self.race_check.get() == 1, model=f"{len(targets)} models",
+                       records=[None] * len(targets), pane_chunks=[[] for _ in targets],
+                       pane_fields=[None] * len(targets), pane_formatted=[None] * len(targets), panes=None)
 
-        if mode == "optimize":
-            self.output_query.insert("1.0", "Optimizing query... please wait.")
-            self.output_indices.insert("1.0", "Analyzing schema...")
-            self.output_explanation.insert("1.0", "Thinking...")
-            self.tabview.set("Optimized Query")
-        else:
-            self.output_explanation.insert("1.0", "Chatting with DBA... \n\n")
-            self.tabview.set("Analysis")
+        self._job_seq += 1
+        job["id"] = self._job_seq
+        self.jobs[job["id"]] = job
+        self.scheduler.submit(job)
+        self.add_job_row(job)
+        self.select_job(job["id"])
+        self.tabview.set({"optimize": "Optimized Query", "explain": "Analysis", "compare": "Compare"}[mode])
 
-        self.current_optimization_id += 1
-        self.is_optimizing = True
-        
-        req_id = self.current_optimization_id
-        threading.Thread(target=self.run_optimization, args=(query, context, req_id, mode), daemon=True).start()
+    def execute_job(self, job):
+        """Scheduler worker: run one job, keeping its streamed and final results on the job"""
+        if job["mode"] == "compare":
+            return self.execute_comparison(job)
 
-    def stop_optimization(self):
-        if self.is_optimizing:
-            self.is_optimizing = False
-            self.current_optimization_id += 1
-            self.finalize_task()
-            self.output_query.delete("1.0", tk.END)
-            self.output_query.insert("1.0", "Optimization stopped by user.")
-            self.output_indices.delete("1.0", tk.END)
-            self.output_explanation.delete("1.0", tk.END)
+        result = self.optimizer.run(
+            job["mode"], job["query"], job["context"], job["db_type"], job["model"],
+            use_cache=job["use_cache"],
+            store_cache=job["store_cache"],
+            on_token=lambda t: self.stream_token(job, t),
+            on_field=lambda f, t: self.stream_field(job, f, t),
+            cancel_token=job["cancel_token"]
+        )
+        if result["cancelled"]:
+            return
 
-    def run_optimization(self, query, context, req_id, mode):
-        db_type = self.db_optionemenu.get()
-        model = self.model_entry.get() or self.settings.get("model", AppConfig.DEFAULT_MODEL)
-        url = self.settings.get("ollama_url", AppConfig.OLLAMA_URL)
-        api_key = self.settings.get("api_key", "")
-        temperature = float(self.settings.get("temperature", AppConfig.AI_TEMPERATURE))
-        ctx_size = int(self.settings.get("ctx_size", AppConfig.AI_CTX_SIZE))
-        timeout = int(self.settings.get("timeout", AppConfig.TIMEOUT))
+        if job["mode"] == "explain":
+            job["text"] = result["text"]
+            self.save_history(
+                mode="explain",
+                db_type=job["db_type"],
+                model=job["model"],
+                query=job["query"],
+                context=job["context"],
+                res_expl=job["text"],
+                telemetry=result.get("telemetry")
+            )
+            return
 
-        # Build Headers
-        headers = {"Content-Type": "application/json"}
-        if api_key:
-            headers["Authorization"] = f"Bearer {api_key}"
+        # Formatting a large query takes a while, so it happens here rather than on the Tk thread
+        formatted = format_optimize_result(result["content"], self.settings,
+                                           is_cancelled=lambda: job["cancel_token"].cancelled)
+        if job["cancel_token"].cancelled:
+            return
+        job["formatted"] = formatted
+        formatted_sql, formatted_indices, expl = formatted
+        self.save_history(
+            mode="optimize",
+            db_type=job["db_type"],
+            model=job["model"],
+            query=job["query"],
+            context=job["context"],
+            res_sql=formatted_sql,
+            res_idx=formatted_indices,
+            res_expl=expl,
+            telemetry=result.get("telemetry")
+        )
 
-        # Build Prompt based on mode
-        if mode == "optimize":
-            system_prompt = f"You are an expert {db_type} DBA. Optimize the query and return a valid JSON."
-            user_content = f"""Input Query: {query}\nContext: {context}\n\nReturn a JSON object with exactly these keys:
-- "optimized_query": the optimized SQL string.
-- "indices": a string containing one or more SQL CREATE INDEX statements (or an empty string if none needed).
-- "explanation": a string with your reasoning."""
-            format_type = {"type": "json_object"} if "openai" in url.lower() else "json"
-            stream = False
-        else:
-            system_prompt_template = self.settings.get("system_prompt_chat", AppConfig.DEFAULT_SYSTEM_PROMPT_CHAT)
-            system_prompt = system_prompt_template.replace("{db_type}", db_type)
-            user_content = f"Input Query: {query}\nContext: {context}"
-            format_type = ""
-            stream = True
+    def stream_token(self, job, token):
+        # Worker thread: the job keeps the text; the renderer draws it if the job is on screen
+        with job["lock"]:
+            job["chunks"].append(token)
+            job["received"] += len(token)
+            self.stream_renderer.push(token, job["id"])
 
-        payload = {
-            "model": model,
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_content}
-            ],
-            "stream": stream,
-            "temperature": temperature,
-            "max_tokens": ctx_size
-        }
-        
-        # Some providers use "format", some "response_format"
-        if mode == "optimize":
-            if "openai" in url.lower():
-                payload["response_format"] = {"type": "json_object"}
-            else:
-                payload["format"] = "json"
+    def stream_field(self, job, field, text):
+        # Partial Optimize output; the formatted result replaces it once the job is done
+        with job["lock"]:
+            job["fields"].setdefault(field, []).append(text)
+            job["received"] += len(text)
+            self.field_renderers[field].push(text, job["id"])
 
-        try:
-            response = requests.post(
-                url,
-                json=payload,
-                headers=headers,
-                timeout=timeout,
-                stream=stream 
-            )
-            response.raise_for_status()
+    def cancel_renderers(self):
+        for renderer in self.field_renderers.values():
+            renderer.cancel()
 
-            if mode == "explain" and stream:
-                for line in response.iter_lines():
-                    if req_id != self.current_optimization_id or not self.is_optimizing:
-                        break
-                    if line:
-                        try:
-                            # Standard OpenAI/Ollama v1 format
-                            raw_line = line.decode('utf-8').replace('data: ', '').strip()
-                            if raw_line == "[DONE]": break
-                            json_chunk = json.loads(raw_line)
-                            
-                            # Content is in choices[0].delta.content for stream
-                            token = ""
-                            if "choices" in json_chunk:
-                                token = json_chunk["choices"][0].get("delta", {}).get("content", "")
-                            elif "message" in json_chunk: # Some Ollama versions
-                                token = json_chunk["message"].get("content", "")
-                            elif "response" in json_chunk: # Old Ollama fallback
-                                token = json_chunk.get("response", "")
-                                
-                            if token:
-                                self.full_response_content += token
-                                self.after(0, lambda t=token: self.stream_token(t, req_id))
-                        except:
-                            pass
-                
-                # Save chat to history
-                self.history_manager.save(
-                    mode="explain",
-                    db_type=db_type,
-                    model=model,
-                    query=query,
-                    context=context,
-                    res_expl=self.full_response_content
-                )
-                self.after(0, self.load_history_to_sidebar)
-                self.after(0, self.finalize_task)
-            
-            else:
-                if req_id != self.current_optimization_id or not self.is_optimizing:
-                    return
+    # --- Job queue panel ---
+    JOB_MODE_LABELS = {"optimize": "Optimize", "explain": "Chat", "compare": "Compare"}
 
-                result_json = response.json()
-                
-                # Parse standard OpenAI/Ollama v1 response
-                if "choices" in result_json:
-                    raw_content = result_json["choices"][0]["message"]["content"]
-                else:
-                    raw_content = result_json.get("response", "{}")
-                
-                try:
-                    content = json.loads(raw_content)
-                except json.JSONDecodeError:
-                    import re
-                    json_match = re.search(r'(\{.*\})', raw_content, re.DOTALL)
-                    if json_match:
-                        content = json.loads(json_match.group(1))
-                    else:
-                        raise ValueError("Could not parse AI response as JSON")
-                
-                self.after(0, lambda: self.update_ui(content, req_id))
+    def add_job_row(self, job):
+        row = ctk.CTkFrame(self.jobs_frame, fg_color="transparent", corner_radius=4)
+        existing = self.jobs_frame.pack_slaves()
+        if existing:
+            row.pack(fill="x", before=existing[0]) # newest first
+        else:
+            row.pack(fill="x")
+        label = ctk.CTkLabel(row, text="", anchor="w", height=20, font=ctk.CTkFont(size=11))
+        label.pack(side="left", fill="x", expand=True, padx=5)
+        button = ctk.CTkButton(row, text="✕", width=22, height=18, font=ctk.CTkFont(size=11),
+                               fg_color="transparent", text_color=("gray30", "gray70"), hover_color=("gray75", "gray30"),
+                               command=lambda: self.cancel_or_remove_job(job["id"]))
+        button.pack(side="right", padx=2)
+        for widget in (row, label):
+            widget.bind("<Button-1>", lambda e: self.select_job(job["id"]))
+        self.job_rows[job["id"]] = (row, label, button)
+        self.jobs_frame.grid()
+        self.update_job_row(job)
 
-        except Exception as e:
-            if req_id == self.current_optimization_id and self.is_optimizing:
-                error_msg = str(e)
-                self.after(0, lambda: self.show_error(error_msg))
+        # Forget the oldest finished jobs beyond the list size
+        finished = [j for j in self.jobs.values() if j["status"] in ("done", "error", "cancelled")]
+        for old in finished[:max(0, len(self.jobs) - AppConfig.JOB_LIST_SIZE)]:
+            self.remove_job(old["id"])
+
+    def job_status_text(self, job):
+        status = job["status"]
+        if status == "queued":
+            position = self.scheduler.position(job)
+            text = f"queued #{position}" if position else "queued"
+        elif status == "running":
+            text = f"running {time.time() - job['started']:.0f}s"
+            if job["received"]:
+                text += f", {job['received']:,} chars"
+        elif status == "done":
+            text = f"done in {job['finished'] - job['started']:.1f}s"
+        elif status == "error":
+            text = "failed"
+        else:
+            text = "cancelled"
+        priority = {1: " ↑", -1: " ↓"}.get(job["priority"], "")
+        return f"#{job['id']} {self.JOB_MODE_LABELS[job['mode']]}{priority} · {job['model']} · {text}"
+
+    def update_job_row(self, job):
+        row = self.job_rows.get(job["id"])
+        if row is not None:
+            row[1].configure(text=self.job_status_text(job))
+
+    def select_job(self, job_id):
+        self.selected_job_id = job_id
+        for row_id, (row, _label, _button) in self.job_rows.items():
+            row.configure(fg_color=("gray78", "gray28") if row_id == job_id else "transparent")
+        if job_id is None:
+            self.cancel_renderers()
+        else:
+            self.show_job(self.jobs[job_id])
+        self.refresh_job_controls()
 
-    def stream_token(self, token, req_id):
-        if req_id != self.current_optimization_id:
+    def cancel_or_remove_job(self, job_id):
+        job = self.jobs.get(job_id)
+        if job is None:
             return
-        self.output_explanation.insert(tk.END, token)
-        self.output_explanation.see(tk.END)
+        if job["status"] in ("queued", "running"):
+            self.scheduler.cancel(job)
+        else:
+            self.remove_job(job_id)
+
+    def remove_job(self, job_id):
+        self.jobs.pop(job_id, None)
+        row = self.job_rows.pop(job_id, None)
+        if row is not None:
+            row[0].destroy()
+        if job_id == self.selected_job_id:
+            self.select_job(None)
+        if not self.jobs:
+            self.jobs_frame.grid_remove()
 
-    def update_ui(self, content, req_id):
-        if req_id != self.current_optimization_id:
+    def on_job_changed(self, job):
+        if job["id"] not in self.jobs:
             return
+        self.update_job_row(job)
+        if job["id"] == self.selected_job_id:
+            self.show_job(job)
+        self.refresh_job_controls()
+
+    def refresh_job_controls(self):
+        job = self.jobs.get(self.selected_job_id)
+        active = job is not None and job["status"] in ("queued", "running")
+        self.stop_button.configure(state="normal" if active else "disabled")
+
+        busy = self.scheduler.active() > 0
+        if busy and not self._jobs_busy:
+            self.progressbar.grid()
+            self.progressbar.configure(mode="indeterminate")
+            self.progressbar.start()
+        elif not busy and self._jobs_busy:
+            self.progressbar.stop()
+            self.progressbar.grid_remove()
+        self._jobs_busy = busy
+        if busy and self._jobs_tick_id is None:
+            self._jobs_tick_id = self.after(500, self._tick_jobs)
 
+    def _tick_jobs(self):
+        # Elapsed time, received text and queue positions, twice a second
+        self._jobs_tick_id = None
+        for job in self.jobs.values():
+            if job["status"] in ("queued", "running"):
+                self.update_job_row(job)
+        if self.scheduler.active():
+            self._jobs_tick_id = self.after(500, self._tick_jobs)
+
+    def show_job(self, job):
+        """Fill the result tabs from a job; a running job keeps streaming into them"""
+        self.cancel_renderers()
         self.output_query.delete("1.0", tk.END)
         self.output_indices.delete("1.0", tk.END)
         self.output_explanation.delete("1.0", tk.END)
+        if job["mode"] == "compare":
+            self.show_comparison(job)
 
-        # 1. Optimized Query
-        raw_sql = content.get("optimized_query", "")
-        try:
-            formatted_sql = sqlparse.format(raw_sql, reindent=True, keyword_case='upper')
-            formatted_sql = self.align_sql_keywords(formatted_sql)
-        except Exception:
-            formatted_sql = raw_sql
-        self.output_query.insert("1.0", formatted_sql if formatted_sql else "No query returned")
-
-        # 2. Index Suggestions (Handle both string and structured JSON)
-        raw_indices = content.get("indices", "")
-        sql_indices = ""
+        status = job["status"]
+        if status == "queued":
+            self.output_explanation.insert("1.0", "Waiting in the job queue...")
+        elif status == "running":
+            self.show_job_progress(job)
+        elif status == "error":
+            self.output_explanation.insert("1.0", f"Error: {job['error']}\n\nCheck Ollama connection or Model name.")
+        elif status == "cancelled":
+            self.output_query.insert("1.0", "Optimization stopped by user.")
+        elif job["mode"] == "explain":
+            self.output_explanation.insert("1.0", job["text"])
+        elif job["formatted"] is not None:
+            self.show_result(job["formatted"])
+        elif job["mode"] == "compare":
+            if job["race"]:
+                self.output_explanation.insert("1.0", "No model returned a valid answer.")
+            else:
+                self.output_explanation.insert("1.0", "Comparison finished. Click \"Use Result\" in the Compare tab to load an answer here.")
 
-        def dict_to_sql(d):
-            table = d.get('table', 'table_name')
-            idx_name = d.get('index_name', f"idx_{table}_{''.join(filter(str.isalnum, str(d.get('columns',[''])[0])))[:10]}")
-            cols = d.get('columns', [])
-            if isinstance(cols, list):
-                cols_str = ", ".join(cols)
+    def show_job_progress(self, job):
+        with job["lock"]:
+            if job["mode"] == "optimize":
+                placeholders = {"optimized_query": "Optimizing query... please wait.",
+                                "indices": "Analyzing schema...", "explanation": "Thinking..."}
+                for field, renderer in self.field_renderers.items():
+                    text = "".join(job["fields"].get(field, []))
+                    renderer.textbox.insert("1.0", text or placeholders[field])
+                    renderer.start(job["id"], replace=not text)
+            elif job["mode"] == "explain":
+                self.output_explanation.insert("1.0", "Chatting with DBA... \n\n" + "".join(job["chunks"]))
+                self.stream_renderer.start(job["id"])
+            elif job["formatted"] is not None:
+                self.show_result(job["formatted"]) # the race is already won
             else:
-                cols_str = str(cols)
-            return f"CREATE INDEX {idx_name} ON {table} ({cols_str});"
-
-        if isinstance(raw_indices, list):
-            statements = []
-            for item in raw_indices:
-                if isinstance(item, dict):
-                    statements.append(dict_to_sql(item))
-                else:
-                    statements.append(str(item))
-            sql_indices = "\n".join(statements)
-        elif isinstance(raw_indices, dict):
-            sql_indices = dict_to_sql(raw_indices)
-        else:
-            sql_indices = str(raw_indices)
+                self.output_explanation.insert("1.0", f"Comparing {len(job['targets'])} models... see the Compare tab.")
 
-        # Final Cleanup: remove empty lines and isolated ";"
-        clean_lines = [line.strip() for line in sql_indices.split('\n') if line.strip() and line.strip() != ';']
-        sql_indices = "\n".join(clean_lines)
+    def stop_optimization(self):
+        job = self.jobs.get(self.selected_job_id)
+        if job is not None and job["status"] in ("queued", "running"):
+            self.scheduler.cancel(job)
 
-        try:
-            formatted_indices = sqlparse.format(sql_indices, reindent=True, keyword_case='upper')
-        except Exception:
-            formatted_indices = sql_indices
+    def show_result(self, formatted):
+        self.output_query.delete("1.0", tk.END)
+        self.output_indices.delete("1.0", tk.END)
+        self.output_explanation.delete("1.0", tk.END)
 
+        formatted_sql, formatted_indices, expl = formatted
+        self.output_query.insert("1.0", formatted_sql if formatted_sql else "No query returned")
         self.output_indices.insert("1.0", formatted_indices if formatted_indices else "None")
-        
-        # 3. Explanation
-        expl = content.get("explanation", "No explanation provided")
         self.output_explanation.insert("1.0", expl)
 
-        # Save to history
-        self.history_manager.save(
-            mode="optimize",
-            db_type=self.db_optionemenu.get(),
-            model=self.model_entry.get(),
-            query=self.last_query,
-            context=self.last_context,
-            res_sql=formatted_sql,
-            res_idx=formatted_indices,
-            res_expl=expl
+    # --- Compare jobs ---
+    # Headers between the streamed fields in a Compare pane
+    COMPARE_HEADERS = {"indices": "\n\n-- Indexes\n", "explanation": "\n\n-- Explanation\n"}
+
+    def execute_comparison(self, job):
+        fanout = ModelFanout(self.settings, job["targets"], self.response_cache, self.http_pool, self.schema_catalog,
+                             race=job["race"], endpoint_pool=self.endpoint_pool, cancel_token=job["cancel_token"])
+        is_cancelled = lambda: job["cancel_token"].cancelled
+
+        def done(record):
+            formatted = None
+            if isinstance(record["content"], dict):
+                formatted = format_optimize_result(record["content"], self.settings, is_cancelled=is_cancelled)
+            with job["lock"]:
+                job["records"][record["index"]] = record
+                job["pane_formatted"][record["index"]] = formatted
+                if record["winner"]:
+                    job["formatted"] = formatted
+            if record["status"] == "ok":
+                formatted_sql, formatted_indices, expl = formatted
+                self.save_history(
+                    mode="optimize",
+                    db_type=job["db_type"],
+                    model=record["model"],
+                    query=job["query"],
+                    context=job["context"],
+                    res_sql=formatted_sql,
+                    res_idx=formatted_indices,
+                    res_expl=expl,
+                    telemetry=record["telemetry"]
+                )
+            self.after(0, lambda: self.show_compare_result(job, record["index"]))
+
+        fanout.run(
+            "optimize", job["query"], job["context"], job["db_type"],
+            use_cache=job["use_cache"],
+            store_cache=job["store_cache"],
+            on_field=lambda i, f, t: self.compare_field(job, i, f, t),
+            on_done=done
         )
-        self.after(0, self.load_history_to_sidebar)
-        self.finalize_task()
 
+    def compare_field(self, job, index, field, text):
+        with job["lock"]:
+            if field != job["pane_fields"][index]:
+                header = self.COMPARE_HEADERS.get(field)
+                if header:
+                    text = (header if job["pane_fields"][index] else header.lstrip("\n")) + text
+                job["pane_fields"][index] = field
+            job["pane_chunks"][index].append(text)
+            job["received"] += len(text)
+            if job["panes"] is not None:
+                job["panes"][index]["renderer"].push(text, job["id"])
 
-    def show_error(self, error_msg):
-        self.output_explanation.delete("1.0", tk.END)
-        self.output_explanation.insert("1.0", f"Error: {error_msg}\n\nCheck Ollama connection or Model name.")
-        self.finalize_task()
+    def show_comparison(self, job):
+        """Rebuild the Compare tab for a compare job, with what it has streamed so far"""
+        shown = self.jobs.get(self.compare_job_id)
+        if shown is not None:
+            with shown["lock"]:
+                shown["panes"] = None
+        for pane in self.compare_panes:
+            pane["renderer"].cancel()
+        self.compare_frame.destroy()
+        self.compare_frame = ctk.CTkFrame(self.tabview.tab("Compare"), fg_color="transparent")
+        self.compare_frame.pack(fill="both", expand=True)
+        self.compare_frame.grid_rowconfigure(0, weight=1)
+        self.compare_job_id = job["id"]
 
-    def finalize_task(self):
-        self.is_optimizing = False
-        self.progressbar.stop()
-        self.progressbar.grid_remove()
-        self.optimize_button.configure(state="normal")
-        self.explain_button.configure(state="normal")
-        self.stop_button.configure(state="disabled")
+        font_mono = (self.settings.get("font_mono", AppConfig.FONT_MONO), int(self.settings.get("size_query", AppConfig.SIZE_QUERY)))
+        interval_ms = int(self.settings.get("stream_flush_ms", AppConfig.STREAM_FLUSH_MS))
+        panes = []
+        for i, target in enumerate(job["targets"]):
+            self.compare_frame.grid_columnconfigure(i, weight=1, uniform="pane")
+            frame = ctk.CTkFrame(self.compare_frame)
+            frame.grid(row=0, column=i, sticky="nsew", padx=3, pady=3)
+            frame.grid_columnconfigure(0, weight=1)
+            frame.grid_rowconfigure(2, weight=1)
+
+            url = target["url"] or self.settings.get("ollama_url", AppConfig.OLLAMA_URL)
+            ctk.CTkLabel(frame, text=target["model"], font=ctk.CTkFont(weight="bold")).grid(row=0, column=0, padx=5, pady=(5, 0), sticky="w")
+            status = ctk.CTkLabel(frame, text=HttpSessionPool.endpoint_key(url), font=ctk.CTkFont(size=11), anchor="w")
+            status.grid(row=1, column=0, padx=5, sticky="ew")
+            textbox = ctk.CTkTextbox(frame, font=font_mono, wrap="none")
+            textbox.grid(row=2, column=0, padx=5, pady=5, sticky="nsew")
+            use_btn = ctk.CTkButton(frame, text="Use Result", state="disabled", height=24,
+                                    command=lambda i=i: self.use_compare_result(i))
+            use_btn.grid(row=3, column=0, padx=5, pady=(0, 5))
+            panes.append({"status": status, "textbox": textbox, "use_btn": use_btn,
+                          "renderer": StreamRenderer(textbox, interval_ms)})
+        self.compare_panes = panes
+
+        with job["lock"]:
+            for i, pane in enumerate(panes):
+                if job["records"][i] is not None:
+                    self.fill_compare_pane(job, i)
+                    continue
+                text = "".join(job["pane_chunks"][i])
+                waiting = "Waiting for the first token..." if job["status"] == "running" else "Queued..."
+                pane["textbox"].insert("1.0", text or waiting)
+                if job["status"] == "running":
+                    pane["renderer"].start(job["id"], replace=not text)
+            if job["status"] == "running":
+                job["panes"] = panes
+
+    @staticmethod
+    def compare_text(formatted):
+        formatted_sql, formatted_indices, expl = formatted
+        return f"{formatted_sql}\n\n-- Indexes\n{formatted_indices or 'None'}\n\n-- Explanation\n{expl}"
+
+    def fill_compare_pane(self, job, index):
+        pane = self.compare_panes[index]
+        record = job["records"][index]
+        formatted = job["pane_formatted"][index]
+
+        if record["status"] == "ok":
+            status = f"{record['elapsed_s']:.1f}s"
+            if record["first_token_s"] is not None:
+                status += f" (first token {record['first_token_s']:.1f}s)"
+            if record["telemetry"] and record["telemetry"]["tokens_per_s"]:
+                status += f", {record['telemetry']['tokens_per_s']:.0f} tok/s"
+            if record["from_cache"]:
+                status += " - cached"
+            if record["winner"]:
+                status += " - winner"
+        elif record["status"] == "cancelled":
+            lost = any(r is not None and r["winner"] for r in job["records"])
+            status = "Cancelled (lost the race)" if lost else "Cancelled"
+        else:
+            status = f"Failed after {record['elapsed_s']:.1f}s"
+        pane["status"].configure(text=status)
+
+        textbox = pane["textbox"]
+        if formatted is not None:
+            textbox.delete("1.0", tk.END)
+            textbox.insert("1.0", self.compare_text(formatted))
+            pane["use_btn"].configure(state="normal")
+        elif record["error"] and record["status"] != "cancelled":
+            textbox.delete("1.0", tk.END)
+            textbox.insert("1.0", f"Error: {record['error']}")
+
+    def show_compare_result(self, job, index):
+        if job["id"] != self.compare_job_id:
+            return
+        self.compare_panes[index]["renderer"].cancel()
+        self.fill_compare_pane(job, index)
+        if job["records"][index]["winner"] and job["id"] == self.selected_job_id:
+            self.show_result(job["formatted"])
+            self.tabview.set("Optimized Query")
+
+    def use_compare_result(self, index):
+        job = self.jobs.get(self.compare_job_id)
+        if job is not None and job["pane_formatted"][index] is not None:
+            self.show_result(job["pane_formatted"][index])
+            self.tabview.set("Optimized Query")
 
     def copy_to_clipboard(self, text):
         self.clipboard_clear()
         self.clipboard_append(text.strip())
 
-if __name__ == "__main__":
-    app = QueryTuneApp()
+startup_timer.mark("imports")
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(prog=AppConfig.APP_NAME, description="AI SQL Optimizer")
+    parser.add_argument("--batch", metavar="INPUT", help="Run headless on a directory of .sql files or a JSONL file of queries")
+    parser.add_argument("--output", default="querytune_report.jsonl", help="JSONL report (also used to resume)")
+    parser.add_argument("--csv", metavar="PATH", help="Also export the report as CSV")
+    parser.add_argument("--resume", action="store_true", help="Skip queries already completed in the report")
+    parser.add_argument("--mode", choices=["optimize", "explain"], help="Default request mode (optimize)")
+    parser.add_argument("--context", metavar="FILE", help="Context (DDL, table sizes) sent with every query")
+    parser.add_argument("--schema", action="append", metavar="PATH", help="DDL file or folder; the referenced tables are added to each query's context")
+    parser.add_argument("--model", help="Override the configured model")
+    parser.add_argument("--db-type", choices=AppConfig.DB_OPTIONS, help="Override the configured database type")
+    parser.add_argument("--url", help="Override the configured API endpoint URL")
+    parser.add_argument("--concurrency", type=int, help="Parallel requests per endpoint")
+    parser.add_argument("--endpoint-limit", action="append", metavar="URL=N", help="Per-endpoint concurrency override")
+    parser.add_argument("--no-cache", action="store_true", help="Always ask the AI, ignoring the response cache")
+    parser.add_argument("--no-history", action="store_true", help="Do not write results to the history database")
+    parser.add_argument("--startup-report", action="store_true", help="Print cold-start timings once the window is ready, then quit")
+    args = parser.parse_args(argv)
+
+    if args.batch:
+        return run_batch_cli(args)
+
+    app = QueryTuneApp(startup_report=args.startup_report)
     app.mainloop()
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())